@@ -0,0 +1,91 @@
+import os
+import sys
+import math
+import time
+import random
+import resource
+from pathlib import Path
+from contextlib import contextmanager
+
+from . import metrics
+
+
+
+def generate_tree(root: Path, *, depth: int = 3, fanout: int = 4, files: int = 8, size_median: int = 16*1024,
+				  size_sigma: float = 2., max_size: int = 16*1024*1024, duplicate_ratio: float = 0.2,
+				  hardlink_ratio: float = 0.05, seed: int = 0) -> dict[str, int]:
+	'''
+	Creates a reproducible synthetic tree below `root` with `fanout` subdirectories per directory (down to `depth`) and
+	`files` files in every directory. File sizes are log-normal (around `size_median`, capped at `max_size`), and each
+	file is a copy of an earlier file with probability `duplicate_ratio`, or a hardlink to one with `hardlink_ratio`.
+	'''
+	rng = random.Random(seed)
+	originals = []
+	stats = {'dirs': 0, 'files': 0, 'bytes': 0, 'duplicates': 0, 'hardlinks': 0}
+
+	level = [root]
+	for current in range(depth + 1):
+		children = []
+		for directory in level:
+			directory.mkdir(parents=True, exist_ok=True)
+			stats['dirs'] += 1
+			for i in range(files):
+				path = directory / f'f{i}.bin'
+				choice = rng.random()
+				if len(originals) and choice < hardlink_ratio:
+					os.link(rng.choice(originals)[0], path)
+					stats['hardlinks'] += 1
+					size = path.stat().st_size
+				elif len(originals) and choice < hardlink_ratio + duplicate_ratio:
+					_, size, content_seed = rng.choice(originals)
+					path.write_bytes(random.Random(content_seed).randbytes(size))
+					stats['duplicates'] += 1
+				else:
+					size = min(int(rng.lognormvariate(math.log(size_median), size_sigma)), max_size)
+					content_seed = rng.getrandbits(64)
+					path.write_bytes(random.Random(content_seed).randbytes(size))
+					originals.append((path, size, content_seed))
+				stats['files'] += 1
+				stats['bytes'] += size
+			if current < depth:
+				children.extend(directory / f'd{i}' for i in range(fanout))
+		level = children
+	return stats
+
+
+
+def peak_rss() -> int:
+	'''peak resident set size (in bytes) of this process or any of its (finished) children'''
+	scale = 1 if sys.platform == 'darwin' else 1024
+	return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+					   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+
+@contextmanager
+def measure(files: int, size: int):
+	'''
+	Collects the duration, throughput, number of SQL statements executed (see `metrics.current`) and the time breakdown
+	of the enclosed phase into the yielded dict, together with the peak RSS of the whole process so far and by how much
+	the phase raised it (the peak never goes down, so a phase using less memory than an earlier one adds 0).
+	'''
+	result = {}
+	before = metrics.current().state()
+	rss_before = peak_rss()
+	start = time.perf_counter()
+	try:
+		yield result
+	finally:
+		duration = time.perf_counter() - start
+		phase = metrics.Metrics()
+		phase.merge(metrics.current().state())
+		phase.merge({key: {name: -value for name, value in values.items()} for key, values in before.items()})
+		result.update({
+			'seconds': duration,
+			'files/s': files / duration if duration else None,
+			'MB/s': size / duration / 1e6 if duration else None,
+			'queries': phase.counts.get('sql', 0),
+			'breakdown': phase.breakdown(),
+			'peak-rss': peak_rss(),
+		})
+		result['peak-rss-increase'] = result['peak-rss'] - rss_before
@@ -0,0 +1,35 @@
+import pytest
+
+from .processing import mark_crawl, process_marked
+
+
+@pytest.fixture
+def sample_tree(tmp_path):
+    root = tmp_path / 'root'
+    for sub in ['a', 'b', 'a/c']:
+        (root / sub).mkdir(parents=True)
+    (root / 'x.txt').write_text('Hello, world!')
+    (root / 'a' / 'x.txt').write_text('Hello, world!')
+    (root / 'a' / 'c' / 'y.txt').write_text('something else')
+    (root / 'b' / 'y.txt').write_text('something else')
+    (root / 'b' / 'empty').mkdir()
+    return root
+
+
+@pytest.fixture
+def run_add():
+    def run_add(db, root, **kwargs):
+        marked, skipped = [], []
+        mark_crawl(db, marked, skipped, root, ignore_names=set())
+        for mark, savepath, info in process_marked(db, marked, set(), **kwargs):
+            assert info is not None
+            db.save_file_info(savepath, info)
+        return marked
+    return run_add
+
+
+@pytest.fixture
+def snapshot():
+    def snapshot(db, root):
+        return {str(item.path): (item.code, item.count, item.size) for item in db.find_all(root)}
+    return snapshot
@@ -1,12 +1,25 @@
 import os
+import heapq
+import time
+import threading
 from pathlib import Path
+from urllib.parse import quote
 import sqlite3
 from dataclasses import dataclass
 from datetime import datetime
-from functools import lru_cache
+from collections import OrderedDict
+from array import array
+import numpy as np
 import omnifig as fig
 
 from . import misc
+from .metrics import Metrics, current as current_metrics
+
+
+# how much of a file was read to compute its hash (files whose size or sample is unique are never fully read)
+TIER_SIZE = 0
+TIER_SAMPLE = 1
+TIER_FULL = 2
 
 
 @dataclass
@@ -16,6 +29,8 @@ class RowInfo:
 	count: int = None
 	size: int = None
 	modtime: float = None
+	inode: int = None
+	tier: int = None
 
 	@property
 	def modified(self):
@@ -26,47 +41,568 @@ class RowInfo:
 			self.path = Path(self.path)
 
 
+
+class RowTable:
+	'''
+	Compact columnar set of rows: directory paths, names and codes are stored once each and referenced by id, while
+	the metadata are numpy arrays (where missing counts, inodes and tiers are -1 and missing modification times are nan).
+	'''
+	__slots__ = ('dirs', 'names', 'codes', 'parent', 'name', 'code', 'count', 'size', 'modtime', 'inode', 'tier')
+
+	def __init__(self, dirs: list[str], names: list[str], codes: list[str], parent: np.ndarray, name: np.ndarray,
+				 code: np.ndarray, count: np.ndarray, size: np.ndarray, modtime: np.ndarray, inode: np.ndarray,
+				 tier: np.ndarray):
+		self.dirs, self.names, self.codes = dirs, names, codes
+		self.parent, self.name, self.code = parent, name, code
+		self.count, self.size, self.modtime, self.inode, self.tier = count, size, modtime, inode, tier
+
+	@classmethod
+	def from_rows(cls, rows):
+		'''builds the table from `(dir_path, name, hash, count, size, modtime, inode, tier)` rows'''
+		ids = {'dirs': {}, 'names': {}, 'codes': {}}
+		columns = [array('q') for _ in range(3)] + [array('q'), array('q'), array('d'), array('q'), array('q')]
+		for dir_path, name, hash_code, *metadata in rows:
+			for key, column, value in zip(ids, columns, (dir_path, name, hash_code)):
+				table = ids[key]
+				index = table.get(value)
+				if index is None:
+					index = table[value] = len(table)
+				column.append(index)
+			count, size, modtime, inode, tier = metadata
+			columns[3].append(-1 if count is None else count)
+			columns[4].append(0 if size is None else size)
+			columns[5].append(float('nan') if modtime is None else modtime)
+			columns[6].append(-1 if inode is None else inode)
+			columns[7].append(-1 if tier is None else tier)
+		codes = [None if code is None else code.hex() for code in ids['codes']]
+		return cls(list(ids['dirs']), list(ids['names']), codes,
+				   *[np.frombuffer(column, dtype=np.float64 if column.typecode == 'd' else np.int64)
+					 for column in columns])
+
+	def __len__(self):
+		return len(self.parent)
+
+	def path(self, index: int) -> Path:
+		name = self.names[self.name[index]]
+		directory = self.dirs[self.parent[index]]
+		return Path(os.path.join(directory, name) if name else directory)
+
+	def row(self, index: int) -> RowInfo:
+		def optional(value):
+			return None if value < 0 else int(value)
+		modtime = float(self.modtime[index])
+		return RowInfo(self.path(index), self.codes[self.code[index]], optional(self.count[index]),
+					   int(self.size[index]), None if np.isnan(modtime) else modtime, optional(self.inode[index]),
+					   optional(self.tier[index]))
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self.row(index)
+
+
+
+class _TimedCursor(sqlite3.Cursor):
+	'''cursor recording the time spent executing and fetching in the metrics of its connection'''
+	def execute(self, sql, parameters=()):
+		with self.connection.metrics.timer('sql'):
+			return super().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		with self.connection.metrics.timer('sql'):
+			return super().executemany(sql, parameters)
+
+	def fetchone(self):
+		with self.connection.metrics.timer('sql', count=False):
+			return super().fetchone()
+
+	def fetchmany(self, size=None):
+		with self.connection.metrics.timer('sql', count=False):
+			return super().fetchmany(self.arraysize if size is None else size)
+
+	def fetchall(self):
+		with self.connection.metrics.timer('sql', count=False):
+			return super().fetchall()
+
+
+
+class _TimedConnection(sqlite3.Connection):
+	metrics: Metrics = None
+
+	def cursor(self, factory=_TimedCursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		return self.cursor().executemany(sql, parameters)
+
+	def commit(self):
+		with self.metrics.timer('commit'):
+			return super().commit()
+
+	def __exit__(self, *args):
+		with self.metrics.timer('commit'):
+			return super().__exit__(*args)
+
+
+
+class RowCache:
+	'''Bounded LRU cache of the rows looked up by path (absent rows are cached as None).'''
+	_missing = object()
+
+	def __init__(self, maxsize: int = 100000, metrics: Metrics | None = None):
+		self.maxsize = maxsize
+		self.metrics = metrics
+		self.hits = 0
+		self.misses = 0
+		self._rows = OrderedDict()
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		return {'maxsize': self.maxsize}
+
+	def __setstate__(self, state):
+		self.__init__(state['maxsize'])
+
+	def __len__(self):
+		return len(self._rows)
+
+	def get(self, key: str):
+		'''returns the cached row or `RowCache._missing`'''
+		with self._lock:
+			row = self._rows.get(key, self._missing)
+			if row is self._missing:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self._rows.move_to_end(key)
+		if self.metrics is not None:
+			self.metrics.add('cache-misses' if row is self._missing else 'cache-hits')
+		return row
+
+	def put(self, key: str, row: RowInfo | None):
+		if self.maxsize <= 0:
+			return
+		with self._lock:
+			self._rows[key] = row
+			self._rows.move_to_end(key)
+			while len(self._rows) > self.maxsize:
+				self._rows.popitem(last=False)
+
+	def invalidate(self, key: str):
+		with self._lock:
+			self._rows.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._rows.clear()
+
+	def stats(self) -> dict[str, int]:
+		return {'hits': self.hits, 'misses': self.misses, 'size': len(self._rows), 'maxsize': self.maxsize}
+
+
+
+def hash_file(file_path: Path, stat: os.stat_result, algorithm: str, *, chunksize: int = 1024*1024,
+			  mmap_threshold: int | None = None, tiered: bool = False,
+			  metrics: Metrics | None = None) -> tuple[Path, tuple[str, tuple]]:
+	'''
+	Info of a file as `FileDatabase.process_file` computes it, but only given the hashing settings (see
+	`FileDatabase.hash_settings`), so worker processes do not need the database.
+	'''
+	metrics = current_metrics() if metrics is None else metrics
+	if tiered:
+		file_hash, tier = misc.size_hash(stat.st_size, algorithm), TIER_SIZE
+	else:
+		with metrics.timer('hash', cpu=True):
+			file_hash = misc.file_hash(file_path, algorithm, chunksize=chunksize, mmap_threshold=mmap_threshold)
+		metrics.add('hashed-bytes', stat.st_size)
+		tier = TIER_FULL
+
+	metadata = None, stat.st_size, stat.st_mtime, stat.st_ino, tier
+	return file_path, (file_hash, metadata)
+
+
 @fig.component('file-db')
 class FileDatabase(fig.Configurable):
-	def __init__(self, db_path: Path | str = misc.data_root()/'files.db', chunksize: int = 1024*1024):
+	def __init__(self, db_path: Path | str = misc.data_root()/'files.db', chunksize: int = 1024*1024, *,
+				 batch_size: int = 1, flush_interval: float | None = None, cache_size: int = 64*1024,
+				 tiered: bool = False, sample_size: int = 64*1024, algorithm: str | None = None,
+				 mmap_threshold: int | None = None, row_cache_size: int = 100000, metrics: Metrics | None = None,
+				 dir_hash: str | None = None, read_only: bool = False, timeout: float = 30.):
+		'''
+		`algorithm` selects the hasher (see `misc.available_hashers`), which defaults to the one already used in the
+		database, as all reports in a database must use the same algorithm for the codes to be comparable. The same
+		holds for `dir_hash`: "sorted" hashes the sorted codes of the contents of a directory, while "multiset" combines
+		them with `misc.multiset_hash` so the ancestors of changed paths can be updated in O(depth) (see
+		`update_ancestors`).
+
+		With `tiered` files are initially only identified by their size, and `resolve_tiers` only reads (a head/tail
+		sample of `sample_size` bytes of, and if necessary all of) files whose size collides with another file.
+
+		Rows passed to `save_file_info` are buffered and written in a single transaction once `batch_size` rows are
+		pending or `flush_interval` seconds have passed since the last flush (call `flush` or `close` when done).
+		`cache_size` is the SQLite page cache size in KiB, and up to `row_cache_size` rows returned by `find_path` are kept
+		in memory (see `prefetch`).
+
+		Hashing, stat calls, SQL statements, commits and cache lookups are recorded in `metrics` (by default the
+		process-wide `metrics.current()`).
+
+		Every thread gets its own connection (see `conn`), which waits up to `timeout` seconds for locks held by other
+		connections. With `read_only` the database is opened with `mode=ro`, so (thanks to WAL) queries can run while
+		another process is writing, but nothing can be saved.
+		'''
 		self.db_path = Path(db_path).absolute()
 		self.chunksize = chunksize
-		self.conn = sqlite3.connect(str(self.db_path))
+		self.batch_size = max(batch_size, 1)
+		self.flush_interval = flush_interval
+		self.cache_size = cache_size
+		self.tiered = tiered
+		self.sample_size = sample_size
+		self.mmap_threshold = mmap_threshold
+		self.metrics = current_metrics() if metrics is None else metrics
+		self.read_only = read_only
+		self.timeout = timeout
+		self._local = threading.local()
+		self._connections = []
+		self._lock = threading.Lock()
+		self._write_lock = threading.RLock() # for the buffered rows
+		if read_only and not self.db_path.exists():
+			raise FileNotFoundError(f'Cannot open missing database {self.db_path} read-only')
 		self.init_database()
+		self.algorithm = self._check_algorithm(algorithm)
+		self.dir_hash = self._check_dir_hash(dir_hash)
 		self._report_id = None
+		self._dir_ids = {}
+		self.row_cache = RowCache(row_cache_size, self.metrics)
+		self._pending = {}
+		self._queued = False
+		self._last_flush = time.time()
+
+
+	def __getstate__(self):
+		# worker processes only hash files, so the connections are not shared with them
+		state = self.__dict__.copy()
+		for key in ['_local', '_connections', '_lock', '_write_lock']:
+			del state[key]
+		state['_dir_ids'] = {}
+		state['_pending'] = {}
+		state['row_cache'] = RowCache(0)
+		state['metrics'] = Metrics() # collected separately (see `processing.process_marked`)
+		return state
+
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._local = threading.local()
+		self._connections = []
+		self._lock = threading.Lock()
+		self._write_lock = threading.RLock()
+
+
+	@property
+	def conn(self) -> sqlite3.Connection:
+		'''the connection of the current thread (opened on first use)'''
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			if self.read_only:
+				conn = sqlite3.connect(f'file:{quote(str(self.db_path))}?mode=ro', uri=True, timeout=self.timeout,
+									   factory=_TimedConnection, check_same_thread=False)
+			else:
+				conn = sqlite3.connect(str(self.db_path), timeout=self.timeout, factory=_TimedConnection,
+									   check_same_thread=False)
+			conn.metrics = self.metrics
+			self._configure_connection(conn)
+			self._local.conn = conn
+			with self._lock:
+				self._connections.append(conn)
+		return conn
 
 
 	_RowInfo = RowInfo
+	_metadata_columns = ('filecount', 'filesize', 'modification_time', 'inode', 'tier')
+	_schema_version = 2
+	_select_rows = ('SELECT d.path, f.name, f.hash, f.filecount, f.filesize, f.modification_time, f.inode, f.tier '
+					'FROM files f JOIN dirs d ON f.parent = d.id')
+	_fetch_size = 10000
+	def _configure_connection(self, conn: sqlite3.Connection):
+		if self.read_only:
+			conn.execute('PRAGMA query_only=ON')
+		else:
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('PRAGMA synchronous=NORMAL')
+		conn.execute(f'PRAGMA cache_size={-int(self.cache_size)}')
+		conn.execute('PRAGMA temp_store=MEMORY')
+
+
 	def init_database(self):
 		conn = self.conn
+		if self.is_legacy(conn):
+			raise ValueError(f'{self.db_path} uses the old schema (convert it with the `migrate` script first)')
+		if self.read_only:
+			tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+			columns = {row[1] for row in conn.execute('PRAGMA table_info(reports)')}
+			if not {'reports', 'dirs', 'files', 'clusters', 'sizes', 'queue', 'minhashes', 'lsh', 'chunks'} <= tables \
+					or 'dir_hash' not in columns:
+				raise ValueError(f'{self.db_path} must be opened for writing once (to create or update its tables) '
+								 f'before it can be opened read-only')
+			return
 		cursor = conn.cursor()
 		cursor.execute('''
 		    CREATE TABLE IF NOT EXISTS reports (
 		        id INTEGER PRIMARY KEY AUTOINCREMENT,
 		        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
-		        description TEXT
+		        description TEXT,
+		        algorithm TEXT,
+		        dir_hash TEXT
 		    )''')
+		self._ensure_columns('reports', algorithm='TEXT', dir_hash='TEXT')
+		# every directory path is only stored once, and rows are identified by their parent directory and name
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS dirs (
+				id INTEGER PRIMARY KEY,
+				path TEXT NOT NULL UNIQUE
+			)''')
 		cursor.execute('''
 			CREATE TABLE IF NOT EXISTS files (
-				path TEXT PRIMARY KEY,
+				id INTEGER PRIMARY KEY,
+				parent INTEGER NOT NULL,
+				name TEXT NOT NULL,
 				report INTEGER NOT NULL,
 				status TEXT,
-				hash TEXT,
+				hash BLOB,
 				filecount INTEGER,
 				filesize INTEGER,
 				modification_time REAL,
+				inode INTEGER,
+				tier INTEGER,
+				UNIQUE (parent, name),
+				FOREIGN KEY (parent) REFERENCES dirs(id),
 				FOREIGN KEY (report) REFERENCES reports(id)
 			)''')
+		cursor.execute(f'PRAGMA user_version = {self._schema_version}')
 		cursor.execute('''
 			CREATE INDEX IF NOT EXISTS idx_hash ON files(hash);
 			''')
+		cursor.execute(f'''
+			CREATE INDEX IF NOT EXISTS idx_partial ON files(filesize) WHERE tier < {TIER_FULL};
+			''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_filesize ON files(filesize) WHERE filecount IS NULL')
+		self._init_clusters()
+		self._init_sizes()
+		self._init_minhashes()
+		self._init_chunks()
+		# paths marked by an `add` run which were not processed yet (in processing order)
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS queue (
+				id INTEGER PRIMARY KEY,
+				report INTEGER NOT NULL,
+				root TEXT NOT NULL,
+				path TEXT NOT NULL,
+				is_dir INTEGER NOT NULL,
+				known INTEGER NOT NULL,
+				names TEXT,
+				mode INTEGER,
+				inode INTEGER,
+				device INTEGER,
+				filesize INTEGER,
+				modification_time REAL,
+				FOREIGN KEY (report) REFERENCES reports(id)
+			)''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_queue_path ON queue(path)')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_queue_root ON queue(root)')
 		conn.commit()
 
 
+	# rows which can be reported as duplicates (`row` is NEW or OLD in the triggers)
+	_cluster_condition = ("{row}.hash IS NOT NULL AND {row}.filesize > 0 AND {row}.status = 'completed' "
+						  f'AND COALESCE({{row}}.tier, {TIER_FULL}) = {TIER_FULL}')
+	def _init_clusters(self):
+		'''
+		The clusters table holds the number and total size of the rows with each (fully resolved) hash, and is kept up to
+		date by triggers, so duplicates can be found without aggregating the files table.
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='clusters_insert'")
+		trigger = cursor.fetchone()
+		if trigger is not None and 'status' not in trigger[0]: # older triggers also counted quarantined rows
+			for name in ['clusters_insert', 'clusters_delete', 'clusters_update_old', 'clusters_update_new']:
+				cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+			cursor.execute('DROP TABLE IF EXISTS clusters')
+		cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='clusters'")
+		exists = cursor.fetchone()[0]
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS clusters (
+				hash BLOB PRIMARY KEY,
+				members INTEGER NOT NULL,
+				total_size INTEGER NOT NULL
+			)''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_clusters ON clusters(members) WHERE members > 1')
+
+		add = '''
+			INSERT INTO clusters (hash, members, total_size) VALUES (NEW.hash, 1, NEW.filesize)
+				ON CONFLICT (hash) DO UPDATE SET members = members + 1, total_size = total_size + excluded.total_size;
+		'''
+		remove = '''
+			UPDATE clusters SET members = members - 1, total_size = total_size - OLD.filesize WHERE hash = OLD.hash;
+			DELETE FROM clusters WHERE hash = OLD.hash AND members <= 0;
+		'''
+		new, old = self._cluster_condition.format(row='NEW'), self._cluster_condition.format(row='OLD')
+		update = 'UPDATE OF hash, filesize, tier, status'
+		for name, event, condition, body in [
+			('clusters_insert', 'INSERT', new, add),
+			('clusters_delete', 'DELETE', old, remove),
+			('clusters_update_old', update, old, remove),
+			('clusters_update_new', update, new, add),
+		]:
+			cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON files WHEN {condition} '
+						   f'BEGIN {body} END')
+
+		if not exists:
+			cursor.execute('INSERT INTO clusters (hash, members, total_size) '
+						   'SELECT hash, COUNT(*), SUM(filesize) FROM files '
+						   f'WHERE {self._cluster_condition.format(row="files")} GROUP BY hash')
+
+
+	# files which can collide by size (`row` is NEW or OLD in the triggers)
+	_size_condition = "{row}.filecount IS NULL AND {row}.filesize IS NOT NULL AND {row}.status = 'completed'"
+	def _init_sizes(self):
+		'''
+		The sizes table holds the number of files of each size (kept up to date by triggers like the clusters), so
+		colliding sizes (see `resolve_tiers` and `unresolved`) can be found without aggregating the files table.
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='sizes'")
+		exists = cursor.fetchone()[0]
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS sizes (
+				filesize INTEGER PRIMARY KEY,
+				members INTEGER NOT NULL
+			)''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_sizes ON sizes(members) WHERE members > 1')
+
+		add = '''
+			INSERT INTO sizes (filesize, members) VALUES (NEW.filesize, 1)
+				ON CONFLICT (filesize) DO UPDATE SET members = members + 1;
+		'''
+		remove = '''
+			UPDATE sizes SET members = members - 1 WHERE filesize = OLD.filesize;
+			DELETE FROM sizes WHERE filesize = OLD.filesize AND members <= 0;
+		'''
+		new, old = self._size_condition.format(row='NEW'), self._size_condition.format(row='OLD')
+		update = 'UPDATE OF filesize, filecount, status'
+		for name, event, condition, body in [
+			('sizes_insert', 'INSERT', new, add),
+			('sizes_delete', 'DELETE', old, remove),
+			('sizes_update_old', update, old, remove),
+			('sizes_update_new', update, new, add),
+		]:
+			cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON files WHEN {condition} '
+						   f'BEGIN {body} END')
+
+		if not exists:
+			cursor.execute('INSERT INTO sizes (filesize, members) SELECT filesize, COUNT(*) FROM files '
+						   f'WHERE {self._size_condition.format(row="files")} GROUP BY filesize')
+
+
+	def _init_minhashes(self):
+		'''
+		MinHash signatures of directory rows (with the hash they were computed for, so outdated signatures can be
+		found) and their LSH band buckets (see `similarity.index_directories`). Both are dropped with their row.
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS minhashes (
+				file INTEGER PRIMARY KEY,
+				hash BLOB,
+				signature BLOB NOT NULL,
+				FOREIGN KEY (file) REFERENCES files(id)
+			)''')
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS lsh (
+				band INTEGER NOT NULL,
+				bucket INTEGER NOT NULL,
+				file INTEGER NOT NULL,
+				PRIMARY KEY (band, bucket, file),
+				FOREIGN KEY (file) REFERENCES files(id)
+			) WITHOUT ROWID''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_lsh_file ON lsh(file)')
+		cursor.execute('CREATE TRIGGER IF NOT EXISTS minhashes_delete AFTER DELETE ON files BEGIN '
+					   'DELETE FROM minhashes WHERE file = OLD.id; DELETE FROM lsh WHERE file = OLD.id; END')
+
+
+	def _init_chunks(self):
+		'''
+		Content-defined chunks of large files (see `misc.file_chunks`), which are dropped when their row is removed or
+		its hash changes.
+		'''
+		cursor = self.conn.cursor()
+		cursor.execute('''
+			CREATE TABLE IF NOT EXISTS chunks (
+				file INTEGER NOT NULL,
+				offset INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				hash BLOB NOT NULL,
+				PRIMARY KEY (file, offset),
+				FOREIGN KEY (file) REFERENCES files(id)
+			) WITHOUT ROWID''')
+		cursor.execute('CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks(hash)')
+		cursor.execute('CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON files BEGIN '
+					   'DELETE FROM chunks WHERE file = OLD.id; END')
+		cursor.execute('CREATE TRIGGER IF NOT EXISTS chunks_update AFTER UPDATE OF hash ON files '
+					   'WHEN OLD.hash IS NOT NEW.hash BEGIN DELETE FROM chunks WHERE file = OLD.id; END')
+
+
+	@staticmethod
+	def is_legacy(conn: sqlite3.Connection) -> bool:
+		'''whether the database stores full paths and hex hashes (see `migrate_database`)'''
+		return 'path' in {row[1] for row in conn.execute('PRAGMA table_info(files)')}
+
+
+	def _ensure_columns(self, table: str, **columns: str) -> list[str]:
+		'''adds any missing columns to an existing table (for databases created by older versions)'''
+		cursor = self.conn.cursor()
+		existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+		added = []
+		for name, decl in columns.items():
+			if name not in existing:
+				cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+				added.append(name)
+		return added
+
+
+	def _check_algorithm(self, algorithm: str | None = None) -> str:
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT DISTINCT COALESCE(algorithm, 'md5') FROM reports")
+		used = [row[0] for row in cursor.fetchall()]
+		if algorithm is None:
+			algorithm = used[0] if len(used) else 'md5'
+		misc.get_hasher(algorithm)
+		if len(used) > 1 or (len(used) and used[0] != algorithm):
+			raise ValueError(f'Database {self.db_path} uses {", ".join(used)} so it cannot be used with {algorithm}')
+		return algorithm
+
+
+	_dir_hashes = ('sorted', 'multiset')
+	def _check_dir_hash(self, dir_hash: str | None = None) -> str:
+		cursor = self.conn.cursor()
+		cursor.execute("SELECT DISTINCT COALESCE(dir_hash, 'sorted') FROM reports")
+		used = [row[0] for row in cursor.fetchall()]
+		if dir_hash is None:
+			dir_hash = used[0] if len(used) else 'sorted'
+		if dir_hash not in self._dir_hashes:
+			raise ValueError(f'Unknown directory hash: {dir_hash!r} (expected one of {", ".join(self._dir_hashes)})')
+		if len(used) > 1 or (len(used) and used[0] != dir_hash):
+			raise ValueError(f'Database {self.db_path} uses {", ".join(used)} directory hashes '
+							 f'so it cannot be used with {dir_hash}')
+		return dir_hash
+
+
 	def create_report_id(self, description: str | None = None):
 		conn = self.conn
 		cursor = conn.cursor()
-		cursor.execute('INSERT INTO reports (description) VALUES (?)', (description,))
+		cursor.execute('INSERT INTO reports (description, algorithm, dir_hash) VALUES (?, ?, ?)',
+					   (description, self.algorithm, self.dir_hash))
 		conn.commit()
 		report_id = cursor.lastrowid
 		return report_id
@@ -76,171 +612,897 @@ class FileDatabase(fig.Configurable):
 		self._report_id = report_id
 	def get_report_id(self, description: str = None) -> int:
 		if self._report_id is None:
+			if self.read_only:
+				raise ValueError(f'{self.db_path} was opened read-only')
 			self._report_id = self.create_report_id(description)
 		return self._report_id
 
 
-	def compute_hash(self, file_path: Path) -> str:
-		return misc.md5_file_hash(file_path, chunksize=self.chunksize)
+	def compute_hash(self, file_path: Path, size: int | None = None) -> str:
+		with self.metrics.timer('hash', cpu=True):
+			code = misc.file_hash(file_path, self.algorithm, chunksize=self.chunksize,
+								  mmap_threshold=self.mmap_threshold)
+		if size is not None:
+			self.metrics.add('hashed-bytes', size)
+		return code
 
 
-	@staticmethod
-	def compute_directory_hash(content_hashes: list[str]) -> str:
+	def compute_chunks(self, file_path: Path, size: int | None = None, *,
+					   chunk_size: int = 1024*1024) -> list[tuple[int, int, str]]:
+		'''content-defined chunks (of `chunk_size` bytes on average) of a file (see `misc.file_chunks`)'''
+		with self.metrics.timer('hash', cpu=True):
+			chunks = misc.file_chunks(file_path, self.algorithm, avg_size=chunk_size)
+		if size is not None:
+			self.metrics.add('chunked-bytes', size)
+		return chunks
+
+
+	def compute_directory_hash(self, content_hashes: list[str]) -> str:
+		if self.dir_hash == 'multiset':
+			return misc.multiset_hash(content_hashes, self.algorithm)
 		data = b''.join(bytes.fromhex(code) for code in sorted(content_hashes))
-		return misc.md5_hash(data)
+		return misc.hash_bytes(data, self.algorithm)
 
 
-	def compute_directory_info(self, dir_path: Path, content_info) -> tuple[Path, tuple[str, tuple]]:
+	def compute_directory_info(self, dir_path: Path, content_info,
+							   stat: os.stat_result | None = None) -> tuple[Path, tuple[str, tuple]]:
 		if len(content_info) == 0:
 			hashes = []
 			dirsize = 0
 			dircount = 0
 		else:
 			hashes, metadatas = zip(*content_info)
-			counts, sizes, _ = zip(*metadatas)
+			counts, sizes, *_ = zip(*metadatas)
 			dircount = sum(cnt or 1 for cnt in counts)
 			dirsize = sum(sizes)
 
 		directory_hash = self.compute_directory_hash(hashes)
-		modification_time = dir_path.stat().st_mtime
-		# modification_time = os.path.getmtime(dir_path)
+		if stat is None:
+			with self.metrics.timer('stat'):
+				stat = dir_path.stat()
 
-		metadata = dircount, dirsize, modification_time
+		metadata = dircount, dirsize, stat.st_mtime, stat.st_ino, None
 		return dir_path, (directory_hash, metadata)
 
 
-	def process_file(self, file_path: Path) -> tuple[Path, tuple[str, tuple]]:
-		file_hash = self.compute_hash(file_path)
+	def hash_settings(self) -> dict:
+		'''keyword arguments of `hash_file` to process files like this database'''
+		return {'algorithm': self.algorithm, 'chunksize': self.chunksize, 'mmap_threshold': self.mmap_threshold,
+				'tiered': self.tiered}
+
+
+	def process_file(self, file_path: Path, stat: os.stat_result | None = None) -> tuple[Path, tuple[str, tuple]]:
+		if stat is None:
+			with self.metrics.timer('stat'):
+				stat = file_path.stat()
+		return hash_file(file_path, stat, metrics=self.metrics, **self.hash_settings())
+
 
-		size, modification_time = file_path.stat().st_size, file_path.stat().st_mtime
-		# size, modification_time = os.path.getsize(file_path), os.path.getmtime(file_path)
-		metadata = None, size, modification_time
-		return file_path, (file_hash, metadata)
+	def process_dir(self, dir_path: Path, ignore_names, stat: os.stat_result | None = None, *,
+					names: list[str] | None = None, fresh: dict[str, tuple] | None = None) -> tuple[Path, tuple[str, tuple]]:
+		'''
+		Aggregates the contents of a directory from a single query for all its children in the database. The current
+		contents can be given as `names` (otherwise the directory is listed) and rows of children which no longer
+		exist are removed. `fresh` maps names to infos computed in the current run (which are used instead of the db).
+		Children recorded as failed or skipped are left out, while any other missing child raises a ValueError.
+		'''
+		if names is None:
+			with os.scandir(dir_path) as entries:
+				names = [entry.name for entry in entries
+						 if entry.name not in ignore_names and dir_path / entry.name != self.db_path]
 
+		stored = self._find_children_raw(dir_path)
+		current = set(names)
+		stale = [dir_path / name for name in stored if name not in current]
+		if len(stale):
+			self.remove_paths(stale)
 
-	def process_dir(self, dir_path: Path, ignore_names) -> tuple[Path, tuple[str, tuple]]:
 		contents = []
-		for content_path in dir_path.iterdir():
-			if content_path == self.db_path or content_path.name in ignore_names or not content_path.exists():
-				continue
-			rawinfo = self._find_path_raw(content_path)
+		excluded = None
+		for name in names:
+			rawinfo = None if fresh is None else fresh.get(name)
+			if rawinfo is None:
+				rawinfo = self._find_pending_raw(dir_path / name)
 			if rawinfo is None:
-				raise ValueError(f'Missing path: {content_path}')
+				rawinfo = stored.get(name)
+			if rawinfo is None:
+				if excluded is None:
+					excluded = self._find_excluded_children(dir_path)
+				if name in excluded:
+					continue
+				raise ValueError(f'Missing path: {dir_path / name}')
 			contents.append(rawinfo)
-		return self.compute_directory_info(dir_path, contents)
+		return self.compute_directory_info(dir_path, contents, stat=stat)
 
 
-	def save_file_info(self, file_path: Path | str, raw_info: tuple[str, tuple], status: str = 'completed'):
+	def refresh_ancestors(self, paths, ignore_names, previous: dict[Path, RowInfo | None] | None = None) -> int:
+		'''
+		Recomputes (bottom up) all directories in the database which contain any of the given paths from the stored
+		rows of their children (the directories are not listed again). With multiset directory hashes and the
+		`previous` rows of all `paths` (from `find_path`, so None for new paths), the ancestors are updated
+		incrementally instead (see `update_ancestors`).
+		'''
+		if self.dir_hash == 'multiset' and previous is not None:
+			def info(row):
+				return None if row is None else (row.code, (row.count, row.size))
+			return self.update_ancestors([(path, info(previous[path]), info(self.find_path(path))) for path in paths])
+		ancestors = {parent for path in paths for parent in Path(path).parents}
+		count = 0
+		for dir_path in sorted(ancestors, key=lambda p: len(p.parts), reverse=True):
+			if self.exists(dir_path):
+				children = self._find_current_children(dir_path)
+				contents = [info for name, info in children.items() if name not in ignore_names]
+				self.save_file_info(*self.compute_directory_info(dir_path, contents))
+				count += 1
+		return count
+
+
+	@staticmethod
+	def _contribution(info) -> tuple[list[str], int, int]:
+		'''codes, count and size a row (or None) adds to its parent'''
+		if info is None:
+			return [], 0, 0
+		hash_code, (count, size, *_) = info
+		return [hash_code], count or 1, size or 0
+
+
+	def update_directory(self, dir_path: Path, changes, stat: os.stat_result) -> tuple[Path, tuple[str, tuple]] | None:
+		'''
+		Info of a stored directory after the `(old_info, new_info)` changes of some of its children (old_info is None
+		for new children), so the other children are never read. Returns None unless the directory hash is a multiset,
+		the directory is stored and (judging by its modification time and inode in `stat`) no children were added or
+		removed since, and none of the changed children failed (`new_info` is None), so it has to be processed fully.
+		'''
+		if self.dir_hash != 'multiset':
+			return None
+		old = self._find_path_raw(dir_path)
+		if old is None:
+			return None
+		hash_code, (dircount, dirsize, modtime, inode, *_) = old
+		if self.stat_changed((dirsize, modtime, inode), stat, is_dir=True):
+			return None
+		added, removed, count, size = [], [], dircount or 0, dirsize or 0
+		for old_info, new_info in changes:
+			if new_info is None:
+				return None
+			new_codes, new_count, new_size = self._contribution(new_info)
+			old_codes, old_count, old_size = self._contribution(old_info)
+			added.extend(new_codes)
+			removed.extend(old_codes)
+			count += new_count - old_count
+			size += new_size - old_size
+		directory_hash = misc.multiset_hash(added, self.algorithm, base=hash_code, remove=removed)
+		return dir_path, (directory_hash, (count, size, stat.st_mtime, stat.st_ino, None))
+
+
+	def update_ancestors(self, changes) -> int:
+		'''
+		Applies `(path, old_info, new_info)` changes (either info is None if the path was added or removed) to all
+		stored ancestors by removing the old code from (and adding the new one to) the multiset hash, count and size of
+		each ancestor, so the siblings are never read. Returns the number of updated directories.
+		'''
+		if self.dir_hash != 'multiset':
+			raise ValueError(f'Incremental updates require multiset directory hashes (not {self.dir_hash})')
+		contribution = self._contribution
+
+		deltas = {} # directory -> (added codes, removed codes, count change, size change)
+		order = [] # deepest directories first
+		def push(path: Path, old, new):
+			parent = path.parent
+			if parent == path:
+				return
+			if parent not in deltas:
+				heapq.heappush(order, (-len(parent.parts), str(parent)))
+			added, removed, count, size = deltas.setdefault(parent, ([], [], 0, 0))
+			new_codes, new_count, new_size = contribution(new)
+			old_codes, old_count, old_size = contribution(old)
+			added.extend(new_codes)
+			removed.extend(old_codes)
+			deltas[parent] = added, removed, count + new_count - old_count, size + new_size - old_size
+
+		for path, old, new in changes:
+			if old != new:
+				push(Path(path), old, new)
+
+		updated = 0
+		while len(order):
+			dir_path = Path(heapq.heappop(order)[1])
+			added, removed, count, size = deltas.pop(dir_path)
+			old = self._find_path_raw(dir_path)
+			if old is None:
+				continue
+			hash_code, (dircount, dirsize, *rest) = old
+			new = (misc.multiset_hash(added, self.algorithm, base=hash_code, remove=removed),
+				   ((dircount or 0) + count, (dirsize or 0) + size, *rest))
+			self.save_file_info(dir_path, new)
+			push(dir_path, old, new)
+			updated += 1
+		return updated
+
+
+	def resolve_tiers(self, ignore_names, *, pbar=None) -> list[Path]:
+		'''
+		Promotes files whose size collides with another file to a sample hash, and files whose sample also collides to
+		a full content hash, then updates the ancestors of all promoted files. Returns the promoted paths.
+		'''
+		self.flush()
 		conn = self.conn
 		cursor = conn.cursor()
+		report_id = self.get_report_id()
+
+		# groups with new files, or with sampled files that may collide with newly fully hashed files
+		cursor.execute(f'''
+			SELECT f.filesize FROM sizes s CROSS JOIN files f ON f.filesize = s.filesize
+			WHERE s.members > 1 AND f.filecount IS NULL AND f.status = 'completed'
+			GROUP BY f.filesize HAVING MIN(COALESCE(f.tier, {TIER_FULL})) = {TIER_SIZE}
+				OR MAX(CASE WHEN COALESCE(f.tier, {TIER_FULL}) = {TIER_FULL} THEN f.report END)
+					> MIN(CASE WHEN f.tier = {TIER_SAMPLE} THEN f.report END)
+			''')
+		sizes = [row[0] for row in cursor.fetchall()]
 
+		promoted = []
+		updates = []
+		changes = []
+		for size in sizes if pbar is None else pbar(sizes):
+			cursor.execute('SELECT f.id, d.path, f.name, f.hash, f.tier FROM files f JOIN dirs d ON f.parent = d.id '
+						   'WHERE f.filesize=? AND f.filecount IS NULL AND f.status=?', (size, 'completed'))
+			samples = {}
+			for row_id, dir_path, name, hash_code, tier in cursor.fetchall():
+				path = Path(self._row_path(dir_path, name))
+				try:
+					with self.metrics.timer('hash', cpu=True):
+						sample = misc.sample_file_hash(path, size, self.sample_size, self.algorithm)
+				except OSError:
+					continue
+				self.metrics.add('hashed-bytes', min(size, 2 * self.sample_size))
+				samples.setdefault(sample, []).append((row_id, path, hash_code, TIER_FULL if tier is None else tier))
+
+			for sample, group in samples.items():
+				for row_id, path, hash_code, tier in group:
+					if len(group) > 1 and tier < TIER_FULL:
+						code = self.compute_hash(path, size)
+						updates.append((self._to_blob(code), TIER_FULL, report_id, row_id))
+						changes.append((path, size, self._to_hex(hash_code), code))
+						promoted.append(path)
+					elif tier == TIER_SIZE:
+						updates.append((self._to_blob(sample), TIER_SAMPLE, report_id, row_id))
+						changes.append((path, size, self._to_hex(hash_code), sample))
+						promoted.append(path)
+					elif tier == TIER_SAMPLE: # mark the group as checked against the current report
+						updates.append((hash_code, tier, report_id, row_id))
+
+		if len(updates):
+			with conn:
+				conn.executemany('UPDATE files SET hash=?, tier=?, report=? WHERE id=?', updates)
+			self.row_cache.clear()
+		if self.dir_hash == 'multiset':
+			self.update_ancestors([(path, (old, (None, size)), (new, (None, size))) for path, size, old, new in changes])
+		else:
+			self.refresh_ancestors(promoted, ignore_names)
+		self.flush()
+		return promoted
+
+
+	def has_partial_hashes(self) -> bool:
+		self.flush()
+		cursor = self.conn.cursor()
+		cursor.execute(f'SELECT 1 FROM files WHERE tier < {TIER_FULL} LIMIT 1')
+		return cursor.fetchone() is not None
+
+
+	def unresolved(self) -> int:
+		'''number of files which are only identified by their size but share it with another file'''
+		self.flush()
+		cursor = self.conn.cursor()
+		cursor.execute(f'''
+			SELECT COUNT(*) FROM sizes s CROSS JOIN files f ON f.filesize = s.filesize
+			WHERE s.members > 1 AND f.filecount IS NULL AND f.status = 'completed' AND f.tier = {TIER_SIZE}
+			''')
+		return cursor.fetchone()[0]
+
+
+	def save_file_info(self, file_path: Path | str, raw_info: tuple[str, tuple], status: str = 'completed'):
 		hash_code, metadata = raw_info
+		metadata = (*metadata, *[None] * (len(self._metadata_columns) - len(metadata)))
+
+		row = (str(file_path), self.get_report_id(), status, hash_code, *metadata)
+		with self._write_lock:
+			self._pending[row[0]] = row
+			self.row_cache.invalidate(row[0])
+			if len(self._pending) >= self.batch_size or (self.flush_interval is not None
+														 and time.time() - self._last_flush >= self.flush_interval):
+				self.flush()
+
+
+	def flush(self):
+		'''writes all buffered rows in a single transaction'''
+		with self._write_lock:
+			if len(self._pending):
+				with self.conn:
+					rows = [(*self._locate(path, create=True), report, status, self._to_blob(hash_code), *metadata)
+							for path, report, status, hash_code, *metadata in self._pending.values()]
+					self.conn.executemany('''
+						INSERT INTO files (parent, name, report, status, hash, filecount, filesize, modification_time,
+							inode, tier)
+						VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+						ON CONFLICT (parent, name) DO UPDATE SET report=excluded.report, status=excluded.status,
+							hash=excluded.hash, filecount=excluded.filecount, filesize=excluded.filesize,
+							modification_time=excluded.modification_time, inode=excluded.inode, tier=excluded.tier
+					''', rows)
+					if self._queued: # saved paths are done
+						self.conn.executemany('DELETE FROM queue WHERE path=?', ((path,) for path in self._pending))
+				self._pending.clear()
+			self._last_flush = time.time()
+
+
+	def enqueue(self, root: Path | str, items):
+		'''
+		Persists the work of an `add` run (in order), so it can be resumed. Each item is `(path, is_dir, known, names,
+		mode, inode, device, size, modification time)` and is removed from the queue when its row is saved.
+		'''
+		report_id = self.get_report_id()
+		with self.conn:
+			self.conn.execute('DELETE FROM queue WHERE root=?', (str(root),))
+			self.conn.executemany('INSERT INTO queue (report, root, path, is_dir, known, names, mode, inode, device, '
+								  'filesize, modification_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+								  ((report_id, str(root), str(path), is_dir, known,
+									None if names is None else '\0'.join(names), *stats)
+								   for path, is_dir, known, names, *stats in items))
+		self._queued = True
+
+
+	def queued(self, root: Path | str) -> tuple[int | None, list[tuple]]:
+		'''report id and remaining items (see `enqueue`) of an interrupted run on `root`'''
+		self.flush()
+		cursor = self.conn.execute('SELECT report, path, is_dir, known, names, mode, inode, device, filesize, '
+								   'modification_time FROM queue WHERE root=? ORDER BY id', (str(root),))
+		report_id, items = None, []
+		for report, path, is_dir, known, names, *stats in self._stream(cursor):
+			report_id = report
+			items.append((path, bool(is_dir), bool(known), None if names is None else tuple(names.split('\0'))
+						  if names else (), *stats))
+		if len(items):
+			self._queued = True
+		return report_id, items
+
+
+	def clear_queue(self, root: Path | str):
+		self.flush()
+		with self.conn:
+			self.conn.execute('DELETE FROM queue WHERE root=?', (str(root),))
+
+
+	def close(self):
+		'''writes all buffered rows and closes the connections of all threads'''
+		self.flush()
+		with self._lock:
+			connections, self._connections = self._connections, []
+		for conn in connections:
+			conn.close()
+		self._local = threading.local()
+
+
+	@staticmethod
+	def _to_blob(hash_code: str | None) -> bytes | None:
+		return None if hash_code is None else bytes.fromhex(hash_code)
+	@staticmethod
+	def _to_hex(blob: bytes | None) -> str | None:
+		return None if blob is None else blob.hex()
+
+
+	@staticmethod
+	def _split(path: Path | str) -> tuple[str, str]:
+		path = Path(path)
+		return str(path.parent), path.name
 
-		cursor.execute('''
-			INSERT OR REPLACE INTO files (path, report, status, hash, filecount, filesize, modification_time)
-			VALUES (?, ?, ?, ?, ?, ?, ?)
-		''', (str(file_path), self.get_report_id(), status, hash_code, *metadata))
-		conn.commit()
+
+	def _dir_id(self, dir_path: Path | str, create: bool = False) -> int | None:
+		dir_path = str(dir_path)
+		dir_id = self._dir_ids.get(dir_path)
+		if dir_id is None:
+			cursor = self.conn.cursor()
+			if create:
+				cursor.execute('INSERT OR IGNORE INTO dirs (path) VALUES (?)', (dir_path,))
+			cursor.execute('SELECT id FROM dirs WHERE path=?', (dir_path,))
+			row = cursor.fetchone()
+			if row is None:
+				return None
+			dir_id = self._dir_ids[dir_path] = row[0]
+		return dir_id
+
+
+	def _locate(self, path: Path | str, create: bool = False) -> tuple[int | None, str]:
+		'''id of the parent directory and name of `path`'''
+		parent, name = self._split(path)
+		return self._dir_id(parent, create=create), name
+
+
+	@staticmethod
+	def _subtree_clause(root: Path | str) -> tuple[str, tuple[str, ...]]:
+		'''
+		condition selecting `root` and everything inside it (as index-backed ranges on the directory paths), for
+		queries over `files f JOIN dirs d ON f.parent = d.id`
+		'''
+		parent, name = FileDatabase._split(root)
+		lower, upper = misc.subtree_bounds(root)
+		return ('((d.path = ? AND f.name = ?) OR d.path = ? OR (d.path >= ? AND d.path < ?))',
+				(parent, name, str(root), lower, upper))
+
+
+	@staticmethod
+	def _row_path(dir_path: str, name: str) -> str:
+		return os.path.join(dir_path, name) if name else dir_path
+
+
+	def _stream(self, cursor: sqlite3.Cursor):
+		'''yields the rows of the cursor without loading the whole result at once'''
+		while rows := cursor.fetchmany(self._fetch_size):
+			yield from rows
+
+
+	def _decode_row(self, row) -> tuple[str, str, list]:
+		dir_path, name, hash_code, *metadata = row
+		return self._row_path(dir_path, name), self._to_hex(hash_code), metadata
+
+
+	def remove_paths(self, paths):
+		'''removes the rows of the given paths and everything they contain'''
+		self.flush()
+		with self.conn:
+			for path in paths:
+				clause, params = self._subtree_clause(path)
+				self.conn.execute(f'DELETE FROM files WHERE id IN '
+								  f'(SELECT f.id FROM files f JOIN dirs d ON f.parent = d.id WHERE {clause})', params)
+				lower, upper = misc.subtree_bounds(path)
+				self.conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+								  (str(path), lower, upper))
+		self._dir_ids.clear()
+		self.row_cache.clear()
+
+
+	def move_paths(self, moves, status: tuple[str, str] | None = None):
+		'''
+		Updates the rows of the moved `(source, destination)` paths and everything they contain (in one transaction).
+		With `status = (old, new)` all moved rows with the status `old` get the status `new` (e.g. so quarantined copies
+		are not reported as duplicates).
+		'''
+		self.flush()
+		with self.conn:
+			for source, destination in moves:
+				parent, name = self._locate(source)
+				if parent is None:
+					continue
+				new_parent, new_name = self._locate(destination, create=True)
+				self.conn.execute('UPDATE files SET parent=?, name=? WHERE parent=? AND name=?',
+								  (new_parent, new_name, parent, name))
+				lower, upper = misc.subtree_bounds(source)
+				self.conn.execute('UPDATE dirs SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+								  (str(destination), len(str(source)) + 1, str(source), lower, upper))
+				if status is not None:
+					lower, upper = misc.subtree_bounds(destination)
+					self.conn.execute('UPDATE files SET status=? WHERE status=? AND ((parent=? AND name=?) OR parent IN '
+									  '(SELECT id FROM dirs WHERE path = ? OR (path >= ? AND path < ?)))',
+									  (status[1], status[0], new_parent, new_name, str(destination), lower, upper))
+		self._dir_ids.clear()
+		self.row_cache.clear()
+
+
+	def _find_pending_raw(self, path, status: str | None = 'completed') -> tuple[str, tuple] | None:
+		pending = self._pending.get(str(path))
+		if pending is not None and (status is None or pending[2] == status):
+			hash_code, *metadata = pending[3:4 + len(self._metadata_columns)]
+			return hash_code, metadata
+
+
+	def _find_children_raw(self, dir_path, status: str = 'completed') -> dict[str, tuple[str, tuple]]:
+		dir_id = self._dir_id(dir_path)
+		if dir_id is None:
+			return {}
+		cursor = self.conn.cursor()
+		cursor.execute('SELECT name, hash, filecount, filesize, modification_time, inode, tier '
+					   "FROM files WHERE parent=? AND name!='' AND status=?", (dir_id, status))
+		return {name: (self._to_hex(hash_code), metadata) for name, hash_code, *metadata in cursor.fetchall()}
+
+
+	def _find_pending_children(self, dir_path) -> dict[str, tuple]:
+		'''buffered rows of the direct children of `dir_path` by name'''
+		prefix = os.path.join(str(dir_path), '')
+		with self._write_lock:
+			return {path[len(prefix):]: row for path, row in self._pending.items()
+					if path.startswith(prefix) and os.sep not in path[len(prefix):]}
+
+
+	def _find_current_children(self, dir_path) -> dict[str, tuple[str, tuple]]:
+		'''like `_find_children_raw` but including buffered rows'''
+		children = self._find_children_raw(dir_path)
+		for name, (_, _, status, *row) in self._find_pending_children(dir_path).items():
+			if status == 'completed':
+				hash_code, *metadata = row[:1 + len(self._metadata_columns)]
+				children[name] = hash_code, metadata
+			else:
+				children.pop(name, None)
+		return children
+
+
+	def _find_excluded_children(self, dir_path) -> set[str]:
+		'''names of the children which failed or were skipped (including buffered rows)'''
+		excluded = set()
+		dir_id = self._dir_id(dir_path)
+		if dir_id is not None:
+			cursor = self.conn.execute("SELECT name FROM files WHERE parent=? AND status IN ('failed', 'skipped')",
+									   (dir_id,))
+			excluded.update(name for name, in cursor.fetchall())
+		for name, (_, _, status, *_) in self._find_pending_children(dir_path).items():
+			if status == 'completed':
+				excluded.discard(name)
+			else:
+				excluded.add(name)
+		return excluded
 
 
 	def _find_path_raw(self, path, status: str = 'completed') -> tuple[str, tuple] | None:
+		pending = self._find_pending_raw(path, status)
+		if pending is not None:
+			return pending
+
+		parent, name = self._locate(path)
+		if parent is None:
+			return None
+
 		conn = self.conn
 		cursor = conn.cursor()
 
-		query = ('SELECT hash, filecount, filesize, modification_time '
-				 'FROM files WHERE path=? AND status=?')
-		cursor.execute(query, (str(path), status))
-		if cursor.rowcount == 0:
-			return None
+		query = ('SELECT hash, filecount, filesize, modification_time, inode, tier '
+				 'FROM files WHERE parent=? AND name=? AND status=?')
+		cursor.execute(query, (parent, name, status))
 		rawinfo = cursor.fetchone()
 
 		if rawinfo is not None:
 			hash_code, *metadata = rawinfo
-			return hash_code, metadata
+			return self._to_hex(hash_code), metadata
 
 
-	@lru_cache(maxsize=None)
 	def find_path(self, path: Path | str) -> RowInfo | None:
-		rawinfo = self._find_path_raw(path)
-		if rawinfo is not None:
-			hash_code, metadata = rawinfo
-			return self._RowInfo(path, hash_code, *metadata)
+		key = str(path)
+		row = self.row_cache.get(key)
+		if row is RowCache._missing:
+			row = None
+			rawinfo = self._find_path_raw(path)
+			if rawinfo is not None:
+				hash_code, metadata = rawinfo
+				row = self._RowInfo(path, hash_code, *metadata)
+			self.row_cache.put(key, row)
+		return row
+
+
+	def prefetch(self, root: Path | str, status: str = 'completed') -> int:
+		'''loads the rows of `root` and everything inside it into the row cache with a single query'''
+		self.flush()
+		clause, params = self._subtree_clause(root)
+		cursor = self.conn.cursor()
+		cursor.execute(f'{self._select_rows} WHERE f.status=? AND {clause}', (status, *params))
+		count = 0
+		for row in self._stream(cursor):
+			path, hash_code, metadata = self._decode_row(row)
+			self.row_cache.put(path, self._RowInfo(path, hash_code, *metadata))
+			count += 1
+		return count
 
 
 	def find_duplicates(self, hash_code: str, path_prefix: Path | str = None) -> RowInfo:
+		self.flush()
 		conn = self.conn
 		cursor = conn.cursor()
 
 		if path_prefix is None:
-			query = ('SELECT path, filecount, filesize, modification_time '
-					 'FROM files WHERE hash=?')
-			cursor.execute(query, (hash_code,))
+			query = f'{self._select_rows} WHERE f.hash=?'
+			cursor.execute(query, (self._to_blob(hash_code),))
 
 		else:
-			query = ('SELECT path, filecount, filesize, modification_time '
-					 'FROM files WHERE hash=? AND path LIKE ?')
-			cursor.execute(query, (hash_code, f'{path_prefix}%'))
+			clause, params = self._subtree_clause(path_prefix)
+			query = f'{self._select_rows} WHERE f.hash=? AND {clause}'
+			cursor.execute(query, (self._to_blob(hash_code), *params))
 
-		for row in cursor.fetchall():
-			path, *metadata = row
+		for row in self._stream(cursor):
+			path, hash_code, metadata = self._decode_row(row)
 			yield self._RowInfo(path, hash_code, *metadata)
 
 
-	def find_all_duplicates(self, path_prefix: Path | str = None):
-		conn = self.conn
-		cursor = conn.cursor()
+	def _select_all(self, root: Path | str = None, status: str | None = 'completed',
+					duplicates: bool = False) -> sqlite3.Cursor:
+		self.flush()
+		query = self._select_rows
+		conditions, params = [], []
+		if duplicates and not root: # only read the rows of clusters with several members (through `idx_clusters`)
+			query = query.replace('FROM files f', 'FROM clusters c CROSS JOIN files f ON f.hash = c.hash')
+		elif duplicates:
+			query = f'{query} JOIN clusters c ON c.hash = f.hash'
+		if duplicates:
+			conditions.append(f'c.members > 1 AND {self._cluster_condition.format(row="f")}')
+		if status is not None:
+			conditions.append('f.status=?')
+			params.append(status)
+		if root:
+			clause, clause_params = self._subtree_clause(root)
+			conditions.append(clause)
+			params.extend(clause_params)
+		if len(conditions):
+			query = f'{query} WHERE {" AND ".join(conditions)}'
+		return self.conn.execute(query, params)
 
-		if path_prefix is None:
-			query = ('SELECT path, hash, filecount, filesize, modification_time '
-					 'FROM files '
-					 'WHERE hash IN (SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1) AND filesize > 0')
-			cursor.execute(query)
 
-		else:
-			query = ('SELECT path, hash, filecount, filesize, modification_time '
-					 'FROM files '
-					 'WHERE hash IN (SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1) '
-					 'AND filesize > 0 AND path LIKE ?')
-			cursor.execute(query, (f'{path_prefix}%',))
-
-		for row in cursor.fetchall():
-			path, hash_code, *metadata = row
+	def find_all_duplicates(self, path_prefix: Path | str = None):
+		cursor = self._select_all(path_prefix, status=None, duplicates=True)
+		for row in self._stream(cursor):
+			path, hash_code, metadata = self._decode_row(row)
 			yield self._RowInfo(path, hash_code, *metadata)
 
 
+	def find_clusters(self, min_members: int = 2):
+		'''yields `(code, members, total_size)` of all hashes shared by at least `min_members` rows, largest first'''
+		self.flush()
+		cursor = self.conn.cursor()
+		cursor.execute('SELECT hash, members, total_size FROM clusters WHERE members > 1 AND members >= ? '
+					   'ORDER BY total_size DESC', (min_members,))
+		for hash_code, members, total_size in self._stream(cursor):
+			yield self._to_hex(hash_code), members, total_size
+
+
 	def exists(self, path: Path | str, status: str = 'completed') -> bool:
+		if self._find_pending_raw(path, status) is not None:
+			return True
+
+		parent, name = self._locate(path)
+		if parent is None:
+			return False
+
 		conn = self.conn
 		cursor = conn.cursor()
 
 		if status is None:
-			query = 'SELECT COUNT(*) FROM files WHERE path=?'
-			cursor.execute(query, (str(path),))
+			query = 'SELECT COUNT(*) FROM files WHERE parent=? AND name=?'
+			cursor.execute(query, (parent, name))
 
 		else:
-			query = 'SELECT COUNT(*) FROM files WHERE path=? AND status=?'
-			cursor.execute(query, (str(path), status))
+			query = 'SELECT COUNT(*) FROM files WHERE parent=? AND name=? AND status=?'
+			cursor.execute(query, (parent, name, status))
 
 		count = cursor.fetchone()[0]
 		return count > 0
 
 
+	def changed(self, path: Path | str, stat: os.stat_result, is_dir: bool = False) -> bool:
+		'''whether the stored size, modification time or inode of `path` differ from `stat` (or `path` is missing)'''
+		rawinfo = self._find_path_raw(path)
+		if rawinfo is None:
+			return True
+		_, (_, size, modtime, inode, _) = rawinfo
+		return self.stat_changed((size, modtime, inode), stat, is_dir=is_dir)
+
+
+	@staticmethod
+	def stat_changed(stored: tuple[int, float, int | None], stat: os.stat_result, is_dir: bool = False) -> bool:
+		size, modtime, inode = stored
+		return (modtime != stat.st_mtime or (inode is not None and inode != stat.st_ino)
+				or (not is_dir and size != stat.st_size))
+
+
+	def known_paths(self, root: Path | str, with_stats: bool = False,
+					failed: set[str] | None = None) -> set[str] | dict[str, tuple]:
+		'''
+		Loads all completed paths in (and including) `root` with a single streaming query, optionally mapped to their
+		stored `(size, modification time, inode)`. Paths which failed or were skipped are added to `failed` if given.
+		'''
+		self.flush()
+		cursor = self.conn.cursor()
+		clause, params = self._subtree_clause(root)
+		statuses = ('completed', 'failed', 'skipped') if failed is not None else ('completed',)
+		cursor.execute('SELECT d.path, f.name, f.status, f.filesize, f.modification_time, f.inode '
+					   f'FROM files f JOIN dirs d ON f.parent = d.id '
+					   f'WHERE f.status IN ({", ".join("?" * len(statuses))}) AND {clause}', (*statuses, *params))
+		join = self._row_path
+		known = {} if with_stats else set()
+		for dir_path, name, status, *stats in self._stream(cursor):
+			path = join(dir_path, name)
+			if status != 'completed':
+				failed.add(path)
+			elif with_stats:
+				known[path] = tuple(stats)
+			else:
+				known.add(path)
+		return known
+
+
 	def find_all(self, root: Path | str = None, status: str = 'completed'):
-		conn = self.conn
-		cursor = conn.cursor()
+		cursor = self._select_all(root, status)
+		for row in self._stream(cursor):
+			path, hash_code, metadata = self._decode_row(row)
+			yield self._RowInfo(path, hash_code, *metadata)
+
 
+	_export_columns = ('path', 'code', 'count', 'size', 'modtime', 'inode', 'tier')
+	def export_columns(self, root: Path | str = None, status: str = 'completed', *,
+					   duplicates: bool = False) -> dict[str, list]:
+		'''
+		All rows (or only duplicates) under `root` as one list per `RowInfo` field, with paths and codes as str,
+		without creating a `RowInfo` per row.
+		'''
+		cursor = self._select_all(root, status if not duplicates else None, duplicates=duplicates)
+		columns = {name: [] for name in self._export_columns}
+		paths, codes, *rest = columns.values()
+		join, to_hex = self._row_path, self._to_hex
+		while rows := cursor.fetchmany(self._fetch_size):
+			dir_paths, names, hashes, *metadata = zip(*rows)
+			paths.extend(map(join, dir_paths, names))
+			codes.extend(map(to_hex, hashes))
+			for column, values in zip(rest, metadata):
+				column.extend(values)
+		return columns
+
+
+	def export_table(self, root: Path | str = None, status: str = 'completed', *,
+					 duplicates: bool = False) -> RowTable:
+		'''same as `export_columns` but as a compact `RowTable`'''
+		return RowTable.from_rows(self._stream(self._select_all(root, status if not duplicates else None,
+																 duplicates=duplicates)))
+
+
+	def export_frame(self, root: Path | str = None, status: str = 'completed', *, duplicates: bool = False):
+		'''same as `export_columns` but as a pandas DataFrame'''
+		import pandas as pd
+		return pd.DataFrame(self.export_columns(root, status, duplicates=duplicates))
+
+
+
+	def stale_minhashes(self, root: Path | str = None) -> dict[str, int]:
+		'''paths and ids of the (non-empty) directory rows under `root` without an up to date MinHash signature'''
+		self.flush()
+		query = ('SELECT d.path, f.name, f.id FROM files f JOIN dirs d ON f.parent = d.id '
+				 'LEFT JOIN minhashes m ON m.file = f.id WHERE f.filecount IS NOT NULL AND f.filesize > 0 '
+				 "AND f.status = 'completed' AND (m.hash IS NULL OR m.hash != f.hash)")
+		params = ()
 		if root:
-			query = ('SELECT path, hash, filecount, filesize, modification_time '
-					 'FROM files WHERE status=? AND path LIKE ?')
-			cursor.execute(query, (status, f'{root}%'))
+			clause, params = self._subtree_clause(root)
+			query = f'{query} AND {clause}'
+		return {self._row_path(dir_path, name): row_id
+				for dir_path, name, row_id in self._stream(self.conn.execute(query, params))}
 
-		else:
-			query = ('SELECT path, hash, filecount, filesize, modification_time '
-					 'FROM files WHERE status=?')
-			cursor.execute(query, (status,))
 
-		for row in cursor.fetchall():
-			path, hash_code, *metadata = row
-			yield self._RowInfo(path, hash_code, *metadata)
+	def save_minhashes(self, entries):
+		'''stores `(row id, hash, signature, buckets)` entries (replacing the previous signature and buckets)'''
+		entries = list(entries)
+		with self.conn:
+			self.conn.executemany('DELETE FROM lsh WHERE file=?', ((row_id,) for row_id, *_ in entries))
+			self.conn.executemany('INSERT OR REPLACE INTO minhashes (file, hash, signature) VALUES (?, ?, ?)',
+								  ((row_id, self._to_blob(hash_code), signature)
+								   for row_id, hash_code, signature, _ in entries))
+			self.conn.executemany('INSERT OR IGNORE INTO lsh (band, bucket, file) VALUES (?, ?, ?)',
+								  ((band, bucket, row_id) for row_id, *_, buckets in entries
+								   for band, bucket in enumerate(buckets)))
+
+
+	def _minhash_query(self, query: str, root: Path | str = None, suffix: str = '') -> sqlite3.Cursor:
+		self.flush()
+		query = (f'{query} JOIN files f ON f.id = m.file JOIN dirs d ON f.parent = d.id '
+				 "WHERE m.hash = f.hash AND f.status = 'completed'")
+		params = ()
+		if root:
+			clause, params = self._subtree_clause(root)
+			query = f'{query} AND {clause}'
+		return self.conn.execute(f'{query} {suffix}', params)
+
+
+	def find_minhashes(self, root: Path | str = None):
+		'''yields `(row id, path, hash, size, signature)` of all up to date signatures under `root`'''
+		cursor = self._minhash_query('SELECT m.file, d.path, f.name, f.hash, f.filesize, m.signature FROM minhashes m',
+									 root)
+		for row_id, dir_path, name, hash_code, size, signature in self._stream(cursor):
+			yield row_id, self._row_path(dir_path, name), self._to_hex(hash_code), size, signature
+
+
+	def find_buckets(self, root: Path | str = None):
+		'''yields the `(band, bucket, row id)` of all up to date signatures under `root` (grouped by bucket)'''
+		yield from self._stream(self._minhash_query('SELECT l.band, l.bucket, l.file FROM lsh l '
+													'JOIN minhashes m ON m.file = l.file', root,
+													'ORDER BY l.band, l.bucket'))
+
+
+
+	def unchunked(self, root: Path | str = None, min_size: int = 64*1024*1024) -> list[tuple[int, Path, int]]:
+		'''`(row id, path, size)` of the files of at least `min_size` bytes under `root` which were not chunked yet'''
+		self.flush()
+		query = ('SELECT f.id, d.path, f.name, f.filesize FROM files f JOIN dirs d ON f.parent = d.id '
+				 "WHERE f.filecount IS NULL AND f.filesize >= ? AND f.status = 'completed' "
+				 'AND NOT EXISTS (SELECT 1 FROM chunks c WHERE c.file = f.id)')
+		params = (max(min_size, 1),)
+		if root:
+			clause, clause_params = self._subtree_clause(root)
+			query = f'{query} AND {clause}'
+			params += clause_params
+		return [(row_id, Path(self._row_path(dir_path, name)), size)
+				for row_id, dir_path, name, size in self._stream(self.conn.execute(query, params))]
+
+
+	def save_chunks(self, row_id: int, chunks: list[tuple[int, int, str]]):
+		'''stores the `(offset, size, hash)` chunks of a file row'''
+		with self.conn:
+			self.conn.executemany('INSERT OR REPLACE INTO chunks (file, offset, size, hash) VALUES (?, ?, ?, ?)',
+								  ((row_id, offset, size, self._to_blob(hash_code)) for offset, size, hash_code in chunks))
+
+
+	def shared_chunks(self, path: Path | str) -> tuple[int, dict[Path, int]]:
+		'''
+		Bytes of a chunked file that also occur in any other chunked file, and in each of them (or `(0, {})` if the file
+		was not chunked).
+		'''
+		self.flush()
+		parent, name = self._locate(path)
+		row = None if parent is None else self.conn.execute(
+			'SELECT id FROM files WHERE parent=? AND name=?', (parent, name)).fetchone()
+		if row is None:
+			return 0, {}
+		row_id = row[0]
+		total = self.conn.execute(
+			'SELECT COALESCE(SUM(c.size), 0) FROM chunks c WHERE c.file = ? AND EXISTS (SELECT 1 FROM chunks o '
+			"JOIN files f ON f.id = o.file WHERE o.hash = c.hash AND o.file != c.file AND f.status = 'completed')",
+			(row_id,)).fetchone()[0]
+		cursor = self.conn.execute('''
+			SELECT d.path, f.name, SUM(c.size) FROM chunks c
+				JOIN (SELECT DISTINCT file, hash FROM chunks WHERE hash IN (SELECT hash FROM chunks WHERE file = ?)) o
+					ON o.hash = c.hash AND o.file != c.file
+				JOIN files f ON f.id = o.file JOIN dirs d ON f.parent = d.id
+			WHERE c.file = ? AND f.status = 'completed' GROUP BY o.file ORDER BY SUM(c.size) DESC
+			''', (row_id, row_id))
+		return total, {Path(self._row_path(dir_path, name)): size for dir_path, name, size in cursor.fetchall()}
+
+
+
+def migrate_database(db_path: Path | str, dest: Path | str | None = None, *, backup: bool = True,
+					 batch_size: int = 10000) -> tuple[int, int]:
+	'''
+	Converts a database using the old schema (full paths and hex hashes in every row) to the current one, returning the
+	size of the database file before and after. Without `dest` the database is replaced (keeping the old file as
+	`<name>.bak` if `backup`).
+	'''
+	db_path = Path(db_path).absolute()
+	target = db_path.with_name(f'{db_path.name}.migrating') if dest is None else Path(dest).absolute()
+	if target.exists():
+		raise FileExistsError(f'{target} already exists')
+
+	old = sqlite3.connect(str(db_path))
+	if not FileDatabase.is_legacy(old):
+		old.close()
+		raise ValueError(f'{db_path} already uses the current schema')
+	old.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+	before = db_path.stat().st_size
+
+	report_columns = {row[1] for row in old.execute('PRAGMA table_info(reports)')}
+	file_columns = {row[1] for row in old.execute('PRAGMA table_info(files)')}
+
+	new = FileDatabase(target, batch_size=batch_size)
+	with new.conn:
+		new.conn.executemany('INSERT INTO reports (id, created_at, description, algorithm) VALUES (?, ?, ?, ?)',
+							 old.execute('SELECT id, created_at, description, '
+										 f'{"algorithm" if "algorithm" in report_columns else "NULL"} FROM reports'))
 
+	columns = ', '.join(column if column in file_columns else 'NULL'
+						for column in ('path', 'report', 'status', 'hash', *FileDatabase._metadata_columns))
+	cursor = old.execute(f'SELECT {columns} FROM files')
+	while rows := cursor.fetchmany(batch_size):
+		for path, report, status, hash_code, *metadata in rows:
+			if hash_code is not None and len(hash_code) % 2: # old directory codes may have dropped a leading zero
+				hash_code = '0' + hash_code
+			new._pending[path] = (path, report, status, hash_code, *metadata)
+		new.flush()
+	old.close()
 
+	new.conn.execute('VACUUM')
+	new.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+	new.close()
+	after = target.stat().st_size
 
+	if dest is None:
+		if backup:
+			os.replace(db_path, db_path.with_name(f'{db_path.name}.bak'))
+		os.replace(target, db_path)
+	return before, after
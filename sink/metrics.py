@@ -0,0 +1,125 @@
+import time
+import cProfile
+import pstats
+import threading
+from pathlib import Path
+from functools import wraps
+from contextlib import contextmanager
+from omnibelt import save_json
+import omnifig as fig
+
+
+
+class Metrics:
+	'''
+	Thread-safe counters and timers for the hot paths (hashing, stat calls, SQL, commits and caches), used to tell
+	whether a run is I/O-, CPU- or DB-bound.
+	'''
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.counts = {}
+		self.seconds = {}
+		self.cpu_seconds = {}
+
+	def __getstate__(self):
+		return self.state()
+
+	def __setstate__(self, state):
+		self.__init__()
+		self.merge(state)
+
+	def add(self, name: str, amount: int = 1):
+		with self._lock:
+			self.counts[name] = self.counts.get(name, 0) + amount
+
+	@contextmanager
+	def timer(self, name: str, *, cpu: bool = False, count: bool = True):
+		'''accumulates the wall time (and thread CPU time if `cpu`) spent in the block under `name`'''
+		start = time.perf_counter()
+		cpu_start = time.thread_time() if cpu else None
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start, 1 if count else 0,
+						cpu=None if cpu_start is None else time.thread_time() - cpu_start)
+
+	def record(self, name: str, seconds: float, count: int = 1, *, cpu: float | None = None):
+		'''adds time measured elsewhere (e.g. accumulated in a tight loop)'''
+		with self._lock:
+			self.seconds[name] = self.seconds.get(name, 0.) + seconds
+			if count:
+				self.counts[name] = self.counts.get(name, 0) + count
+			if cpu is not None:
+				self.cpu_seconds[name] = self.cpu_seconds.get(name, 0.) + cpu
+
+	def state(self) -> dict[str, dict]:
+		with self._lock:
+			return {'counts': dict(self.counts), 'seconds': dict(self.seconds), 'cpu-seconds': dict(self.cpu_seconds)}
+
+	def merge(self, state: dict[str, dict]):
+		'''adds the counts and times of another `state` (e.g. from a worker process)'''
+		with self._lock:
+			for key, target in [('counts', self.counts), ('seconds', self.seconds), ('cpu-seconds', self.cpu_seconds)]:
+				for name, value in state.get(key, {}).items():
+					target[name] = target.get(name, 0) + value
+
+	def breakdown(self) -> dict[str, float]:
+		'''seconds spent waiting on the disk, computing hashes and in the database'''
+		seconds, cpu = self.seconds, self.cpu_seconds
+		return {
+			'io': seconds.get('hash', 0.) - cpu.get('hash', 0.) + seconds.get('stat', 0.),
+			'cpu': cpu.get('hash', 0.),
+			'db': seconds.get('sql', 0.) + seconds.get('commit', 0.),
+		}
+
+	def summary(self, **extra) -> dict:
+		breakdown = self.breakdown()
+		bound = max(breakdown, key=breakdown.get) if any(breakdown.values()) else None
+		return {**self.state(), 'breakdown': breakdown, 'bound': bound, **extra}
+
+
+
+_current = Metrics()
+
+def current() -> Metrics:
+	'''metrics shared by all `FileDatabase`s which are not given their own'''
+	return _current
+
+
+
+def instrumented(script):
+	'''
+	Adds `metrics-out` (path to dump the collected metrics as JSON) and `profile` (path to save a cProfile capture, whose
+	top entries are also printed) to a script. The script runs with fresh `current()` metrics, which are added to the
+	enclosing ones afterwards (so nested scripts are also counted by their caller).
+	'''
+	@wraps(script)
+	def run(cfg: fig.Configuration):
+		global _current
+		metrics_path = cfg.pull('metrics-out', None, silent=True)
+		profile_path = cfg.pull('profile', None, silent=True)
+		outer, _current = _current, Metrics()
+		profiler = None if profile_path is None else cProfile.Profile()
+		start = time.perf_counter()
+		try:
+			if profiler is not None:
+				profiler.enable()
+			return script(cfg)
+		finally:
+			duration = time.perf_counter() - start
+			if profiler is not None:
+				profiler.disable()
+				profiler.dump_stats(str(profile_path))
+				pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+				print(f'Profile saved to {profile_path}')
+			if metrics_path is not None:
+				summary = _current.summary(**{'script': script.__name__, 'total-seconds': duration})
+				Path(metrics_path).parent.mkdir(parents=True, exist_ok=True)
+				save_json(summary, metrics_path)
+				print(f'Metrics ({summary["bound"] or "idle"}-bound) saved to {metrics_path}')
+			outer.merge(_current.state())
+			_current = outer
+	return run
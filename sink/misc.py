@@ -1,5 +1,12 @@
+import os
+import math
+import time
+import mmap
 import hashlib
+import tempfile
 from pathlib import Path
+from functools import lru_cache
+import numpy as np
 
 
 
@@ -15,22 +22,273 @@ def data_root() -> Path:
 
 
 
+_hashers = {
+	'md5': hashlib.md5,
+	'sha1': hashlib.sha1,
+	'sha256': hashlib.sha256,
+	'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+
+try:
+	import xxhash
+except ImportError:
+	pass
+else:
+	_hashers.update({'xxh64': xxhash.xxh64, 'xxh3_64': xxhash.xxh3_64, 'xxh3_128': xxhash.xxh3_128})
+
+try:
+	import blake3
+except ImportError:
+	pass
+else:
+	_hashers['blake3'] = blake3.blake3
+
+
+
+def register_hasher(name: str, factory):
+	"""Registers a hashlib-style hasher factory (returning an object with `update` and `hexdigest`)."""
+	_hashers[name] = factory
+
+
+
+def available_hashers() -> list[str]:
+	return list(_hashers)
+
+
+
+def get_hasher(algorithm: str = 'md5'):
+	"""Returns a new hasher object for the given algorithm."""
+	try:
+		factory = _hashers[algorithm]
+	except KeyError:
+		raise ValueError(f'Unknown hash algorithm: {algorithm!r} (available: {", ".join(_hashers)})') from None
+	return factory()
+
+
+
+def file_hash(path: Path, algorithm: str = 'md5', chunksize: int = 1024*1024,
+			  mmap_threshold: int | None = None) -> str:
+	"""
+	Hashes the contents of a file reading into a single reusable buffer (or by mapping files of at least
+	`mmap_threshold` bytes into memory).
+	"""
+	hasher = get_hasher(algorithm)
+	with open(path, 'rb', buffering=0) as f:
+		if mmap_threshold is not None and os.fstat(f.fileno()).st_size >= max(mmap_threshold, 1):
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+				hasher.update(mm)
+		else:
+			buffer = bytearray(chunksize)
+			view = memoryview(buffer)
+			while True:
+				num = f.readinto(buffer)
+				if not num:
+					break
+				hasher.update(view[:num])
+	return hasher.hexdigest()
+
+
+
+@lru_cache(maxsize=None)
+def gear_table() -> np.ndarray:
+	'''random (but fixed) uint32 for every byte value used by the rolling hash of `chunk_cuts`'''
+	return np.array([int(hashlib.md5(bytes([value])).hexdigest()[:8], 16) for value in range(256)], dtype=np.uint32)
+
+
+
+def gear_hashes(data: np.ndarray) -> np.ndarray:
+	'''
+	Gear rolling hash (`h[i] = (h[i-1] << 1) + gear[data[i]]` as uint32, so each value only depends on the last 32
+	bytes) of every position of `data`, computed in 5 vectorized passes by doubling the window each time.
+	'''
+	hashes = np.take(gear_table(), data)
+	shifted = np.empty_like(hashes)
+	for shift in (1, 2, 4, 8, 16):
+		np.left_shift(hashes[:-shift], np.uint32(shift), out=shifted[:-shift])
+		np.add(hashes[shift:], shifted[:-shift], out=hashes[shift:])
+	return hashes
+
+
+
+def chunk_cuts(data: np.ndarray, avg_size: int, min_size: int, max_size: int, final: bool = True) -> list[int]:
+	'''
+	Content-defined chunk boundaries (end offsets) in `data`: positions where the top bits of the gear hash are all
+	zero (about one every `avg_size - min_size` bytes), at least `min_size` and at most `max_size` bytes apart. Unless
+	`final`, the bytes after the last boundary are left for the next call (prepended to more data).
+	'''
+	if not len(data):
+		return []
+	bits = max(1, round(math.log2(max(avg_size - min_size, 2))))
+	mask = np.uint32(((1 << bits) - 1) << (32 - bits))
+	candidates = np.flatnonzero((gear_hashes(data) & mask) == 0) + 1
+	cuts = []
+	last = 0
+	for end in candidates[candidates >= min_size].tolist():
+		while end - last > max_size:
+			last += max_size
+			cuts.append(last)
+		if end - last >= min_size:
+			cuts.append(end)
+			last = end
+	while len(data) - last > max_size:
+		last += max_size
+		cuts.append(last)
+	if final and last < len(data):
+		cuts.append(len(data))
+	return cuts
+
+
+
+def file_chunks(path: Path, algorithm: str = 'md5', *, avg_size: int = 1024*1024, min_size: int | None = None,
+				max_size: int | None = None, blocksize: int = 16*1024*1024) -> list[tuple[int, int, str]]:
+	'''
+	Splits a file into content-defined chunks (see `chunk_cuts`, by default between a quarter and four times
+	`avg_size`), so inserting or removing bytes only changes the chunks around the edit. Returns the offset, size and
+	hash of each chunk. The file is read in blocks of `blocksize` (the boundaries do not depend on it).
+	'''
+	min_size = max(avg_size // 4, 64) if min_size is None else min_size
+	max_size = avg_size * 4 if max_size is None else max_size
+	chunks = []
+	offset = 0
+	carry = b''
+	with open(path, 'rb') as f:
+		while True:
+			block = f.read(blocksize)
+			buffer = carry + block if len(carry) else block
+			view = memoryview(buffer)
+			start = 0
+			for end in chunk_cuts(np.frombuffer(buffer, dtype=np.uint8), avg_size, min_size, max_size, not block):
+				chunks.append((offset + start, end - start, hash_bytes(view[start:end], algorithm)))
+				start = end
+			offset += start
+			carry = bytes(view[start:])
+			if not block:
+				return chunks
+
+
+
 def md5_file_hash(path: Path, chunksize: int = 1024*1024) -> str:
-	hasher = hashlib.md5()
+	return file_hash(path, 'md5', chunksize=chunksize)
+
+
+
+def hash_bytes(data: bytes, algorithm: str = 'md5') -> str:
+	hasher = get_hasher(algorithm)
+	hasher.update(data)
+	return hasher.hexdigest()
+
+
+
+def sample_file_hash(path: Path, size: int, sample_size: int = 64*1024, algorithm: str = 'md5') -> str:
+	"""Hashes the size of the file together with its first and last `sample_size` bytes."""
+	hasher = get_hasher(algorithm)
+	hasher.update(f'sample:{size}:'.encode())
 	with path.open('rb') as f:
-		while True:
-			data = f.read(chunksize)
-			if not data:
-				break
-			hasher.update(data)
+		hasher.update(f.read(sample_size))
+		if size > sample_size:
+			f.seek(max(size - sample_size, sample_size))
+			hasher.update(f.read(sample_size))
 	return hasher.hexdigest()
 
 
 
+def size_hash(size: int, algorithm: str = 'md5') -> str:
+	"""Placeholder code for a file that is only known by its size."""
+	return hash_bytes(f'size:{size}'.encode(), algorithm)
+
+
+
 def md5_hash(data: bytes) -> str:
-	hasher = hashlib.md5()
-	hasher.update(data)
-	return hasher.hexdigest()
+	return hash_bytes(data, 'md5')
+
+
+
+def benchmark_hashers(path: Path | None = None, *, size: int = 256*1024*1024, algorithms: list[str] | None = None,
+					  chunksizes: tuple[int, ...] = (64*1024, 256*1024, 1024*1024, 4*1024*1024),
+					  include_mmap: bool = True, repeats: int = 3) -> list[tuple[str, str, float]]:
+	"""
+	Measures the throughput (in bytes per second, best of `repeats`) of hashing `path` (or a temporary file of `size`
+	random bytes) for each algorithm and chunksize. Returns `(algorithm, read mode, throughput)` sorted fastest first.
+	"""
+	if algorithms is None:
+		algorithms = available_hashers()
+
+	tmp = None
+	if path is None:
+		tmp = tempfile.NamedTemporaryFile(delete=False)
+		with tmp:
+			block = os.urandom(min(size, 16*1024*1024))
+			for _ in range(size // len(block)):
+				tmp.write(block)
+		path = Path(tmp.name)
+
+	try:
+		total = path.stat().st_size
+		modes = [(f'{chunksize//1024}KiB', dict(chunksize=chunksize)) for chunksize in chunksizes]
+		if include_mmap:
+			modes.append(('mmap', dict(mmap_threshold=0)))
+		results = []
+		for algorithm in algorithms:
+			for label, kwargs in modes:
+				best = None
+				for _ in range(repeats):
+					start = time.perf_counter()
+					file_hash(path, algorithm, **kwargs)
+					elapsed = time.perf_counter() - start
+					best = elapsed if best is None else min(best, elapsed)
+				results.append((algorithm, label, total / max(best, 1e-9)))
+	finally:
+		if tmp is not None:
+			os.unlink(tmp.name)
+
+	results.sort(key=lambda r: r[2], reverse=True)
+	return results
+
+
+
+def subtree_bounds(root: Path | str) -> tuple[str, str]:
+	"""
+	Half-open range `[lower, upper)` of the (string) paths strictly inside `root`, so that subtrees can be selected
+	using an index. Only whole components match (so `/data/foo` does not contain `/data/foobar`).
+	"""
+	root = str(root)
+	prefix = root if root.endswith(os.sep) else root + os.sep
+	return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+
+
+# filesystems whose files are read over the network
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', '9p', 'fuse.sshfs', 'fuse.rclone', 'ceph',
+					   'glusterfs', 'fuse.glusterfs'}
+
+@lru_cache(maxsize=None)
+def device_kind(device: int) -> str:
+	'''
+	Whether the device (as in `st_dev`) is a "network" filesystem or an "ssd" or "hdd" block device (Linux only,
+	otherwise "unknown").
+	'''
+	major, minor = os.major(device), os.minor(device)
+	try:
+		with open('/proc/self/mountinfo', 'r') as f:
+			for line in f:
+				fields = line.split()
+				if fields[2] == f'{major}:{minor}':
+					if fields[fields.index('-') + 1] in NETWORK_FILESYSTEMS:
+						return 'network'
+					break
+	except (OSError, ValueError, IndexError):
+		pass
+	block = Path(f'/sys/dev/block/{major}:{minor}')
+	try:
+		block = block.resolve(strict=True)
+	except OSError:
+		return 'unknown'
+	for candidate in [block, block.parent]: # partitions only have a queue on their disk
+		try:
+			return 'hdd' if (candidate / 'queue' / 'rotational').read_text().strip() == '1' else 'ssd'
+		except OSError:
+			continue
+	return 'unknown'
 
 
 
@@ -59,3 +317,20 @@ def int2hex(val: int) -> str:
 
 
 
+
+
+
+MULTISET_SALT = b'omni-sink:multiset:'
+
+def multiset_hash(codes, algorithm: str = 'md5', *, base: str | None = None, remove=()) -> str:
+	'''
+	Order independent hash of a multiset of hex digests: the sum (modulo the digest size) of the salted hashes of all
+	`codes`. Starting from `base` (the hash of an earlier multiset) codes can be added and `remove`d in O(changes).
+	'''
+	digits = len(hash_bytes(b'', algorithm))
+	total = 0 if base is None else hex2int(base)
+	for code in codes:
+		total += hex2int(hash_bytes(MULTISET_SALT + bytes.fromhex(code), algorithm))
+	for code in remove:
+		total -= hex2int(hash_bytes(MULTISET_SALT + bytes.fromhex(code), algorithm))
+	return int2hex(total % (1 << (4 * digits))).zfill(digits)
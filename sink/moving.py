@@ -0,0 +1,357 @@
+import os
+import json
+import shutil
+import errno
+import filecmp
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import misc
+from .database import FileDatabase
+
+
+
+def copy_file(src: Path, dst: Path, chunksize: int = 64*1024*1024):
+	'''copies the contents and metadata of a file using `copy_file_range` or `sendfile` where available'''
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		remaining = os.fstat(fsrc.fileno()).st_size
+		for name in ['copy_file_range', 'sendfile']:
+			fn = getattr(os, name, None)
+			if fn is None:
+				continue
+			try:
+				while remaining > 0:
+					if name == 'sendfile':
+						sent = fn(fdst.fileno(), fsrc.fileno(), None, min(chunksize, remaining))
+					else:
+						sent = fn(fsrc.fileno(), fdst.fileno(), min(chunksize, remaining))
+					if sent == 0:
+						break
+					remaining -= sent
+				break
+			except OSError as e:
+				if e.errno not in {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}:
+					raise
+		if remaining > 0: # no kernel copy available (the offsets of both files are where the kernel copy stopped)
+			shutil.copyfileobj(fsrc, fdst, chunksize)
+	shutil.copystat(src, dst)
+
+
+
+def copy_tree(src: Path, dst: Path):
+	if src.is_dir() and not src.is_symlink():
+		shutil.copytree(src, dst, symlinks=True, copy_function=copy_file)
+	elif src.is_symlink():
+		os.symlink(os.readlink(src), dst)
+	else:
+		copy_file(src, dst)
+
+
+
+def move_path(src: Path, dst: Path) -> bool:
+	'''
+	Moves `src` to `dst` (returns whether it was a rename). Across devices the copy is written next to `dst` first and
+	only renamed into place once complete, after which `src` is removed.
+	'''
+	if os.lstat(src).st_dev == os.stat(dst.parent).st_dev:
+		os.rename(src, dst)
+		return True
+	partial = dst.with_name(f'{dst.name}.partial')
+	if partial.exists() or partial.is_symlink():
+		remove_path(partial)
+	copy_tree(src, partial)
+	os.rename(partial, dst)
+	remove_path(src)
+	return False
+
+
+
+def remove_path(path: Path):
+	if path.is_dir() and not path.is_symlink():
+		shutil.rmtree(path)
+	else:
+		path.unlink()
+
+
+
+class MoveJournal:
+	'''
+	Write-ahead log of moves (as JSON lines): each move is recorded (and synced) before it starts and marked as done
+	afterwards, so an interrupted run can be resumed or undone.
+	'''
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self.started = {}
+		self.done = set()
+		self.undone = set()
+		if self.path.exists():
+			with open(self.path, 'r') as f:
+				for line in f:
+					if not line.strip():
+						continue
+					try:
+						entry = json.loads(line)
+					except json.JSONDecodeError: # only the last line can be torn
+						continue
+					src = entry['src']
+					if entry['op'] == 'start':
+						self.started[src] = entry['dst']
+						self.undone.discard(src)
+					elif entry['op'] == 'done':
+						self.done.add(src)
+						self.undone.discard(src)
+					elif entry['op'] == 'undone':
+						self.undone.add(src)
+						self.done.discard(src)
+		self._file = None
+
+	def _write(self, op: str, moves):
+		if self._file is None:
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			self._file = open(self.path, 'a')
+		for src, dst in moves:
+			self._file.write(json.dumps({'op': op, 'src': str(src), 'dst': str(dst)}) + '\n')
+		self._file.flush()
+		os.fsync(self._file.fileno())
+
+	def start(self, moves):
+		self._write('start', moves)
+		self.started.update((str(src), str(dst)) for src, dst in moves)
+		self.undone.difference_update(str(src) for src, _ in moves)
+
+	def finish(self, moves):
+		self._write('done', moves)
+		self.done.update(str(src) for src, _ in moves)
+
+	def revert(self, moves):
+		self._write('undone', moves)
+		for src, _ in moves:
+			self.undone.add(str(src))
+			self.done.discard(str(src))
+
+	def pending(self) -> list[tuple[Path, Path]]:
+		'''moves which were started but never marked as done (or undone)'''
+		return [(Path(src), Path(dst)) for src, dst in self.started.items()
+				if src not in self.done and src not in self.undone]
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+
+def _settle(src: Path, dst: Path) -> bool:
+	'''completes an interrupted move, returns whether `src` is now at `dst`'''
+	partial = dst.with_name(f'{dst.name}.partial')
+	if partial.exists():
+		remove_path(partial)
+	if not (src.exists() or src.is_symlink()):
+		return dst.exists() or dst.is_symlink()
+	if dst.exists(): # the copy was renamed into place, but the source was not removed yet
+		remove_path(src)
+		return True
+	return False
+
+
+
+def move_paths(moves: list[tuple[Path, Path]], journal: MoveJournal, *, workers: int = 8,
+			   db: FileDatabase | None = None, status: tuple[str, str] | None = None, batch_size: int = 1000,
+			   failed: list | None = None, pbar=None) -> list[tuple[Path, Path]]:
+	'''
+	Moves all `(source, destination)` pairs which are not done according to the `journal`. Renames (on the same
+	device) happen on the calling thread, while copies across devices run in a pool of `workers` threads. Moves are
+	journaled and (if a `db` is given) the rows of the moved paths are updated in batches of `batch_size` (see
+	`FileDatabase.move_paths` for `status`).
+
+	Moves which fail are left as started in the journal (so running again retries them). Their `(source,
+	destination, error)` are added to `failed` if given, otherwise the first error is raised once the successful moves
+	of its batch are committed.
+	'''
+	def commit(finished):
+		journal.finish(finished)
+		if db is not None:
+			db.move_paths(finished, status)
+		if pbar is not None:
+			pbar.update(len(finished))
+
+	moved = []
+	todo = []
+	for src, dst in moves:
+		if str(src) in journal.done:
+			if pbar is not None:
+				pbar.update(1)
+		elif str(src) in journal.started and _settle(src, dst):
+			commit([(src, dst)])
+			moved.append((src, dst))
+		else:
+			todo.append((src, dst))
+
+	with ThreadPoolExecutor(max(workers, 1)) as executor:
+		for start in range(0, len(todo), batch_size):
+			batch = todo[start:start + batch_size]
+			journal.start(batch)
+			finished = []
+			errors = []
+			copies = {}
+			for src, dst in batch:
+				try:
+					dst.parent.mkdir(parents=True, exist_ok=True)
+					if os.lstat(src).st_dev == os.stat(dst.parent).st_dev:
+						os.rename(src, dst)
+						finished.append((src, dst))
+					else:
+						copies[executor.submit(move_path, src, dst)] = src, dst
+				except OSError as error:
+					errors.append((src, dst, error))
+			for future in as_completed(copies):
+				try:
+					future.result()
+				except OSError as error:
+					errors.append((*copies[future], error))
+				else:
+					finished.append(copies[future])
+			commit(finished)
+			moved.extend(finished)
+			if len(errors):
+				if failed is None:
+					raise errors[0][-1]
+				failed.extend(errors)
+	return moved
+
+
+
+def undo_moves(journal: MoveJournal, *, db: FileDatabase | None = None, status: tuple[str, str] | None = None,
+			   workers: int = 8, failed: list | None = None, pbar=None) -> int:
+	'''
+	moves everything the `journal` recorded as done (or interrupted) back to where it came from (see `move_paths` for
+	`failed`)
+	'''
+	for src, dst in journal.pending():
+		if _settle(src, dst):
+			journal.finish([(src, dst)])
+	back = [(Path(dst), Path(src)) for src, dst in reversed(journal.started.items()) if src in journal.done]
+	restore = MoveJournal(journal.path.with_name(f'{journal.path.stem}-undo{journal.path.suffix}'))
+	errors = []
+	try:
+		moved = move_paths(back, restore, workers=workers, db=db, status=status, failed=errors, pbar=pbar)
+	finally:
+		restore.close()
+	journal.revert([(dst, src) for src, dst in moved])
+	if len(errors): # the undo journal is kept, so the failed moves are retried next time
+		if failed is None:
+			raise errors[0][-1]
+		failed.extend(errors)
+	else:
+		restore.path.unlink(missing_ok=True)
+	return len(moved)
+
+
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+
+def reflink(src: Path, dst: Path):
+	'''creates `dst` as a copy-on-write clone of `src` (raises OSError if the filesystem does not support it)'''
+	import fcntl
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+
+def same_content(a: Path, b: Path, verify: str | None = 'hash', algorithm: str = 'md5',
+				 digests: dict[Path, str] | None = None) -> bool:
+	'''compares two files by `verify` ("hash", "bytes" or None to only compare sizes)'''
+	if a.stat().st_size != b.stat().st_size:
+		return False
+	if verify == 'hash':
+		if digests is None:
+			digests = {}
+		for path in [a, b]:
+			if path not in digests:
+				digests[path] = misc.file_hash(path, algorithm)
+		return digests[a] == digests[b]
+	if verify == 'bytes':
+		return filecmp.cmp(a, b, shallow=False)
+	if verify is None:
+		return True
+	raise ValueError(f'Unknown verification: {verify!r} (expected "hash", "bytes" or None)')
+
+
+
+def link_file(keep: Path, target: Path, mode: str = 'auto') -> str:
+	'''
+	Replaces `target` with a reflink (which keeps the metadata of `target`) or a hardlink to `keep`, returns the kind of
+	link that was made. With mode "auto" a reflink is tried first. The link is created next to `target` and then
+	atomically renamed over it.
+	'''
+	if mode not in {'auto', 'reflink', 'hardlink'}:
+		raise ValueError(f'Unknown link mode: {mode!r} (expected "auto", "reflink" or "hardlink")')
+	tmp = target.with_name(f'.{target.name}.sink-link')
+	if tmp.exists() or tmp.is_symlink():
+		tmp.unlink()
+	kind = None
+	if mode in {'auto', 'reflink'}:
+		try:
+			reflink(keep, tmp)
+			shutil.copystat(target, tmp)
+			kind = 'reflink'
+		except (OSError, ImportError):
+			tmp.unlink(missing_ok=True)
+			if mode == 'reflink':
+				raise
+	if kind is None:
+		os.link(keep, tmp)
+		kind = 'hardlink'
+	os.replace(tmp, target)
+	return kind
+
+
+
+def link_pairs(keep: Path, target: Path) -> list[tuple[Path, Path]]:
+	'''pairs of files to link (directories are matched by relative path, so only files present in both are linked)'''
+	if not target.is_dir():
+		return [(keep, target)]
+	pairs = []
+	for root, dirs, files in os.walk(target):
+		for name in files:
+			path = Path(root) / name
+			other = keep / path.relative_to(target)
+			if other.is_file() and not path.is_symlink():
+				pairs.append((other, path))
+	return pairs
+
+
+
+def link_duplicates(groups: list[list[Path]], *, mode: str = 'auto', verify: str | None = 'hash',
+					algorithm: str = 'md5', db: FileDatabase | None = None, pbar=None) -> dict[str, list]:
+	'''
+	Replaces every path after the first of each group with links to the first one (files are verified by `verify`
+	first). Returns the linked, skipped (mismatched, or already the same inode) and failed `(keep, target)` pairs. If a
+	`db` is given the rows of linked files are updated with their new stats.
+	'''
+	results = {'reflink': [], 'hardlink': [], 'skipped': [], 'failed': []}
+	for group in groups:
+		keep, *targets = group
+		digests = {}
+		for target in targets:
+			for source, path in link_pairs(keep, target):
+				try:
+					source_stat, stat = source.stat(), path.stat()
+					if (source_stat.st_dev, source_stat.st_ino) == (stat.st_dev, stat.st_ino) \
+							or not same_content(source, path, verify, algorithm, digests):
+						results['skipped'].append((source, path))
+					else:
+						results[link_file(source, path, mode)].append((source, path))
+						if db is not None:
+							row = db.find_path(path)
+							if row is not None:
+								stat = path.stat()
+								db.save_file_info(path, (row.code, (row.count, stat.st_size, stat.st_mtime,
+																	stat.st_ino, row.tier)))
+				except OSError:
+					results['failed'].append((source, path))
+			if pbar is not None:
+				pbar.update(1)
+	if db is not None:
+		db.flush()
+	return results
@@ -1,46 +1,466 @@
+import os
+import time
+import heapq
+import stat as statlib
 from pathlib import Path
+from typing import NamedTuple
+from collections import deque
+from contextlib import nullcontext
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
 import omnifig as fig
 
 from . import misc
-from .database import FileDatabase, RowInfo
+from .database import FileDatabase, RowInfo, RowTable, hash_file
+from .metrics import Metrics
 
 
 
-def recursive_mark_crawl(db: FileDatabase, marked_paths: list[Path], skipped: list[Path],
-						 path: Path, ignore_names: set[str], *, pbar=None):
-	'''post order traversal of the file tree, marking all files for processing'''
-	if path != db.db_path and path.name not in ignore_names and path.exists() and not db.exists(path):
-		try:
-			if path.is_dir():
-				for sub in path.iterdir():
-					recursive_mark_crawl(db, marked_paths, skipped, sub, ignore_names, pbar=pbar)
+class Mark(NamedTuple):
+	'''A path marked for processing, together with the metadata collected while crawling.'''
+	path: Path
+	is_dir: bool
+	stat: os.stat_result
+	names: tuple[str, ...] | None = None # contents of a directory
+	known: bool = False # whether the path was already in the database
 
-		except PermissionError:
-			skipped.append(path)
-			if pbar is not None:
-				pbar.update(1)
 
-		else:
-			marked_paths.append(path)
+
+def mark_crawl(db: FileDatabase, marked_paths: list[Mark], skipped: list[Path],
+			   root: Path, ignore_names: set[str], *, refresh: bool = False, retry: bool = False, pbar=None) -> bool:
+	'''
+	Iterative post order traversal of the file tree (using `os.scandir`), marking all new files for processing
+	(returns whether `root` was marked). The type and stat of each entry are only collected once and are kept in the
+	`Mark` to be used for processing. Symlinks to directories are not followed, and entries which cannot be read (e.g.
+	symlink loops) are skipped.
+
+	In `refresh` mode paths already in the database are revisited, and only marked if their size, modification time or
+	inode changed (or, for directories, if any of their contents were marked).
+
+	All paths already in the database under `root` are loaded up front, so marking only needs a single query. Paths
+	which previously failed or were skipped are ignored unless `retry`.
+	'''
+	failed = None if retry else set()
+	known_paths = db.known_paths(root, with_stats=refresh, failed=failed)
+	stat_calls, stat_time = 0, 0.
+
+	def changed(path: Path, stat: os.stat_result, is_dir: bool = False) -> bool:
+		stored = known_paths.get(str(path))
+		return stored is None or db.stat_changed(stored, stat, is_dir=is_dir)
+
+	def skip(path: Path):
+		skipped.append(path)
+		if pbar is not None:
+			pbar.update(1)
+
+	def visit(path: Path, is_dir: bool, stat: os.stat_result) -> bool | None:
+		'''marks `path` unless it needs to be crawled first, returns whether it was marked (None if it was skipped)'''
+		known = str(path) in known_paths
+		if known and not refresh:
+			return False
+		if is_dir:
+			try:
+				with os.scandir(path) as entries:
+					entries = list(entries)
+			except OSError:
+				skip(path)
+				return None
+			stack.append((path, stat, iter(entries), [not known], known, []))
+			return False
+		if not known or changed(path, stat):
+			marked_paths.append(Mark(path, False, stat, known=known))
 			if pbar is not None:
 				pbar.update(1)
+			return True
+		return False
+
+	if root == db.db_path or root.name in ignore_names or (failed and str(root) in failed):
+		return False
+	try:
+		root_stat = root.stat()
+	except FileNotFoundError:
+		return False
+	except OSError:
+		skip(root)
+		return False
+
+	stack = []
+	marked = bool(visit(root, statlib.S_ISDIR(root_stat.st_mode), root_stat))
+	while len(stack):
+		path, stat, entries, state, known, names = stack[-1]
+		entry = next(entries, None)
+
+		if entry is None: # all contents are done
+			stack.pop()
+			marked = state[0] or (refresh and changed(path, stat, is_dir=True))
+			if marked:
+				marked_paths.append(Mark(path, True, stat, tuple(names), known))
+				if pbar is not None:
+					pbar.update(1)
+				if len(stack):
+					stack[-1][3][0] = True
+
+		elif entry.name not in ignore_names:
+			sub = path / entry.name
+			if sub == db.db_path or (failed and str(sub) in failed):
+				continue
+			stat_calls += 1
+			start = time.perf_counter()
+			try:
+				is_dir = entry.is_dir()
+				if is_dir and entry.is_symlink(): # never followed, as they can form loops
+					continue
+				sub_stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			except OSError: # e.g. no permission or a symlink loop
+				skip(sub)
+				continue
+			finally:
+				stat_time += time.perf_counter() - start
+			result = visit(sub, is_dir, sub_stat)
+			if result is not None:
+				names.append(entry.name)
+				state[0] = state[0] or result
+
+	db.metrics.record('stat', stat_time, stat_calls + 1)
+	return marked
+
+
+
+def queue_marks(db: FileDatabase, root: Path, marks: list[Mark]):
+	'''persists the marks of a run (see `resume_marks`)'''
+	db.enqueue(root, ((mark.path, mark.is_dir, mark.known, mark.names, mark.stat.st_mode, mark.stat.st_ino,
+					   mark.stat.st_dev, mark.stat.st_size, mark.stat.st_mtime) for mark in marks))
+
+
+
+def resume_marks(db: FileDatabase, root: Path) -> list[Mark]:
+	'''
+	Marks left in the queue by an interrupted run on `root` (saving a row removes it from the queue), continuing the
+	report of that run.
+	'''
+	report_id, items = db.queued(root)
+	if report_id is not None:
+		db.set_report_id(report_id)
+	return [Mark(Path(path), is_dir, os.stat_result((mode, inode, device, 0, 0, 0, size, 0, mtime, 0)), names, known)
+			for path, is_dir, known, names, mode, inode, device, size, mtime in items]
+
+
+
+def _process_mark(db: FileDatabase, mark: Mark, ignore_names: set[str], fresh: dict[str, tuple | None] | None = None,
+				  previous: dict[str, tuple | None] | None = None) -> tuple[Path, tuple[str, tuple] | None]:
+	'''
+	`fresh` maps the names of children processed in this run to their infos (None if they failed), and `previous` to
+	their rows before (None if they were new), which allows updating known directories incrementally (see
+	`FileDatabase.update_directory`).
+	'''
+	try:
+		if mark.is_dir:
+			if not mark.known and mark.names is not None and fresh is not None \
+					and all(fresh.get(name) is not None for name in mark.names):
+				# a new directory whose contents were all just processed (so there is nothing to query)
+				return db.compute_directory_info(mark.path, [fresh[name] for name in mark.names], stat=mark.stat)
+			if mark.known and fresh and previous is not None:
+				updated = db.update_directory(mark.path, [(previous.get(name), info) for name, info in fresh.items()],
+											  mark.stat)
+				if updated is not None:
+					return updated
+			return db.process_dir(mark.path, ignore_names, stat=mark.stat, names=mark.names, fresh=fresh)
+		elif statlib.S_ISREG(mark.stat.st_mode):
+			return db.process_file(mark.path, stat=mark.stat)
+	except OSError:
+		pass
+	return mark.path, None
+
+
+
+def _process_file_in_worker(path: Path, stat: os.stat_result, settings: dict):
+	'''
+	Runs in worker processes, which only get the hashing `settings` of the database (instead of the whole database)
+	and send the collected metrics back.
+	'''
+	metrics = Metrics()
+	return hash_file(path, stat, metrics=metrics, **settings), metrics.state()
+
+
+
+# how many files may be read concurrently from each kind of device (see `misc.device_kind`)
+DEVICE_LIMITS = {'ssd': 8, 'hdd': 1, 'network': 4, 'unknown': 4}
+
+class IOScheduler:
+	'''
+	Queues reads per device (`st_dev`), handing them out in inode order (as a proxy for the physical layout) without
+	exceeding the number of concurrent reads allowed for each device. Spinning disks are only read one file at a time,
+	while SSDs and network filesystems are read in parallel.
+	'''
+	def __init__(self, limits: dict[str, int] | None = None):
+		self.limits = {**DEVICE_LIMITS, **(limits or {})}
+		self.queues = {}
+		self.active = {}
+		self._waiting = 0
+
+	def limit(self, device: int) -> int:
+		return max(1, self.limits.get(misc.device_kind(device), self.limits['unknown']))
+
+	def push(self, device: int, inode: int, item):
+		heapq.heappush(self.queues.setdefault(device, []), (inode, self._waiting, item))
+		self._waiting += 1
+
+	def pop(self) -> list[tuple[int, object]]:
+		'''all `(device, item)` which can start now (the caller must `release` the device once each is done)'''
+		started = []
+		for device, queue in self.queues.items():
+			active = self.active.get(device, 0)
+			limit = self.limit(device)
+			while queue and active < limit:
+				started.append((device, heapq.heappop(queue)[-1]))
+				active += 1
+			self.active[device] = active
+		self._waiting -= len(started)
+		return started
+
+	def release(self, device: int):
+		self.active[device] -= 1
+
+	def waiting(self, device: int) -> int:
+		return len(self.queues.get(device, ()))
+
+	def __len__(self):
+		return self._waiting
+
 
 
+def process_marked(db: FileDatabase, marked_paths: list[Mark], ignore_names: set[str], *,
+				   workers: int = 0, pool: str = 'thread', io_limits: dict[str, int] | None = None,
+				   window: int | None = None):
+	'''
+	Processes the marked paths (in post order) yielding `(mark, savepath, info)` where `info` is None on failure.
 
-def recursive_leaves_crawl(leaves: list[Path], path: Path, terminals: dict[Path, str],
-						   pbar=None, get_increment=None):
-	if path in terminals or path.is_file():
+	With `workers > 0` files are hashed concurrently in a thread or process pool, while each directory is only
+	processed (on the calling thread) after all its marked children have been yielded, so the caller (the single DB
+	writer) must save each result before requesting the next one.
+
+	Files are read through an `IOScheduler` (with the per-device `io_limits`) in inode order. The marks of each device
+	are read through their own cursor, which keeps up to `window` (default `64 * workers`) upcoming files of that
+	device queued, so marks from several roots on different disks are read in parallel (no matter their order in
+	`marked_paths`) while each spinning disk is read sequentially.
+
+	The infos of all processed paths are kept until their parent directory is processed, so directories only need to
+	query the database for contents that were not processed in this run.
+	'''
+	if workers and pool not in {'thread', 'process'}:
+		raise ValueError(f'Unknown pool type: {pool!r} (expected "thread" or "process")')
+
+	marked_dirs = {mark.path for mark in marked_paths if mark.is_dir}
+	fresh = {}
+	# rows of the known children of known directories before they are replaced (see `_process_mark`)
+	previous = {} if db.dir_hash == 'multiset' else None
+	known_dirs = {mark.path for mark in marked_paths if mark.is_dir and mark.known} if previous is not None else ()
+
+	def collect(mark: Mark, savepath: Path, info):
+		parent = savepath.parent
+		if parent in marked_dirs:
+			fresh.setdefault(parent, {})[savepath.name] = info
+			if parent in known_dirs and mark.known:
+				previous.setdefault(parent, {})[savepath.name] = db._find_path_raw(savepath)
+
+	def process(mark: Mark):
+		savepath, info = _process_mark(db, mark, ignore_names, fresh.pop(mark.path, {}),
+									   None if previous is None else previous.pop(mark.path, {}))
+		collect(mark, savepath, info)
+		return savepath, info
+
+	remaining = {}
+	streams = {} # the marks of each device (in post order)
+	for mark in marked_paths:
+		parent = mark.path.parent
+		if parent != mark.path:
+			remaining[parent] = remaining.get(parent, 0) + 1
+		streams.setdefault(mark.stat.st_dev, deque()).append(mark)
+
+	in_flight = {}
+	deferred = {}
+	ready = deque()
+	scheduler = IOScheduler(io_limits)
+	settings = db.hash_settings()
+	window = max(1, 64 * max(workers, 1) if window is None else window)
+
+	def finish(path: Path):
+		parent = path.parent
+		if parent in remaining:
+			remaining[parent] -= 1
+			if remaining[parent] == 0:
+				del remaining[parent]
+				if parent in deferred:
+					ready.append(deferred.pop(parent))
+
+	def advance():
+		'''moves the cursor of every device forward until its window is full (or a directory can be processed)'''
+		for device, stream in list(streams.items()):
+			while stream and scheduler.waiting(device) < window and not ready:
+				mark = stream.popleft()
+				if mark.is_dir:
+					if mark.path in remaining:
+						deferred[mark.path] = mark
+					else:
+						ready.append(mark)
+				elif statlib.S_ISREG(mark.stat.st_mode):
+					scheduler.push(device, mark.stat.st_ino, mark)
+				else:
+					collect(mark, mark.path, None)
+					yield mark.path, mark.path, None
+					finish(mark.path)
+			if not stream:
+				del streams[device]
+
+	executor_type = ThreadPoolExecutor if pool == 'thread' else ProcessPoolExecutor
+	with executor_type(workers) if workers else nullcontext() as executor:
+		while True:
+			yield from advance()
+
+			for device, mark in scheduler.pop():
+				if not workers: # read right away, but still in inode order
+					savepath, info = process(mark)
+					scheduler.release(device)
+					yield mark.path, savepath, info
+					finish(mark.path)
+					continue
+				if pool == 'process':
+					future = executor.submit(_process_file_in_worker, mark.path, mark.stat, settings)
+				else:
+					future = executor.submit(db.process_file, mark.path, mark.stat)
+				in_flight[future] = mark, device
+
+			while ready:
+				mark = ready.popleft()
+				yield mark.path, *process(mark)
+				finish(mark.path)
+
+			if in_flight:
+				done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+				for future in done:
+					mark, device = in_flight.pop(future)
+					scheduler.release(device)
+					try:
+						result = future.result()
+						if pool == 'process':
+							result, state = result
+							db.metrics.merge(state)
+						savepath, info = result
+					except OSError:
+						savepath, info = mark.path, None
+					collect(mark, savepath, info)
+					yield mark.path, savepath, info
+					finish(mark.path)
+			elif not streams and not ready and not len(scheduler):
+				break
+
+	if len(deferred):
+		raise RuntimeError(f'{len(deferred)} directories were never finalized')
+
+
+
+def _compute_chunks_in_worker(path: Path, size: int, algorithm: str, chunk_size: int):
+	'''runs in worker processes (see `_process_file_in_worker`)'''
+	metrics = Metrics()
+	with metrics.timer('hash', cpu=True):
+		chunks = misc.file_chunks(path, algorithm, avg_size=chunk_size)
+	metrics.add('chunked-bytes', size)
+	return chunks, metrics.state()
+
+
+
+def chunk_files(db: FileDatabase, root: Path | None = None, min_size: int = 64*1024*1024, *,
+				chunk_size: int = 1024*1024, workers: int = 0, pool: str = 'thread', pbar=None) -> int:
+	'''
+	Splits all files of at least `min_size` bytes under `root` which were not chunked yet into content-defined chunks
+	(in a thread or process pool with `workers > 0`, while the chunks are saved on the calling thread). Files which
+	cannot be read are skipped. Returns the number of chunked files.
+	'''
+	if workers and pool not in {'thread', 'process'}:
+		raise ValueError(f'Unknown pool type: {pool!r} (expected "thread" or "process")')
+	todo = db.unchunked(root, min_size)
+	if pbar is not None:
+		pbar.reset(total=sum(size for _, _, size in todo))
+
+	count = 0
+	def save(row_id: int, size: int, chunks):
+		nonlocal count
+		if chunks is not None:
+			db.save_chunks(row_id, chunks)
+			count += 1
 		if pbar is not None:
-			pbar.set_description(f'{" "*(10-len(leaves))}{len(leaves)} leaves')
-			pbar.update(get_increment(path))
-		leaves.append(path)
-	else:
-		for sub in path.iterdir():
-			recursive_leaves_crawl(leaves, sub, terminals=terminals, pbar=pbar, get_increment=get_increment)
+			pbar.update(size)
+
+	if not workers:
+		for row_id, path, size in todo:
+			try:
+				chunks = db.compute_chunks(path, size, chunk_size=chunk_size)
+			except OSError:
+				chunks = None
+			save(row_id, size, chunks)
+		return count
+
+	executor_type = ThreadPoolExecutor if pool == 'thread' else ProcessPoolExecutor
+	with executor_type(workers) as executor:
+		futures = {}
+		for row_id, path, size in todo:
+			if pool == 'process':
+				future = executor.submit(_compute_chunks_in_worker, path, size, db.algorithm, chunk_size)
+			else:
+				future = executor.submit(db.compute_chunks, path, size, chunk_size=chunk_size)
+			futures[future] = row_id, size
+		for future in as_completed(futures):
+			row_id, size = futures[future]
+			try:
+				chunks = future.result()
+				if pool == 'process':
+					chunks, state = chunks
+					db.metrics.merge(state)
+			except OSError:
+				chunks = None
+			save(row_id, size, chunks)
+	return count
+
+
+
+def stored_leaves(db: FileDatabase, root: Path, terminals: dict[Path, str], *, use_bytes: bool = True,
+				  pbar=None) -> list[RowInfo]:
+	'''
+	Pre order selection of all files and terminals which are not inside a terminal, using only the rows stored in the
+	database (loaded in one query), so the filesystem is never accessed.
+	'''
+	columns = db.export_columns(root)
+	paths, counts, sizes = columns['path'], columns['count'], columns['size']
+	terminal_paths = {str(path) for path in terminals}
+
+	leaves = []
+	inside = None
+	for i in sorted(range(len(paths)), key=lambda i: paths[i].split(os.sep)):
+		path = paths[i]
+		if inside is not None and path.startswith(inside):
+			continue
+		is_terminal = path in terminal_paths
+		if is_terminal:
+			inside = misc.subtree_bounds(path)[0]
+		if is_terminal or counts[i] is None:
+			leaves.append(RowInfo(path, *[columns[key][i] for key in db._export_columns[1:]]))
+			if pbar is not None:
+				pbar.set_description(f'{" "*(10-len(leaves))}{len(leaves)} leaves')
+				pbar.update((sizes[i] if use_bytes else counts[i] or 1) or 0)
+	return leaves
 
 
 
-def identify_duplicates(clusters: dict[str, list[RowInfo]], *, pbar=None):
+def identify_duplicates(clusters: dict[str, list[RowInfo]] | RowTable, *, pbar=None):
+	'''
+	Splits the groups of rows with the same code into accepts (same name, size and modification time), maybe (same size)
+	and rejects. For a `RowTable` the groups are computed in a vectorized way and each maps to an array of row indices.
+	'''
+	if isinstance(clusters, RowTable):
+		return _identify_table_duplicates(clusters)
+
 	accepts = {}
 	maybe = {}
 	rejects = {}
@@ -63,6 +483,28 @@ def identify_duplicates(clusters: dict[str, list[RowInfo]], *, pbar=None):
 
 
 
+def _identify_table_duplicates(table: RowTable):
+	accepts, maybe, rejects = {}, {}, {}
+	if not len(table):
+		return accepts, maybe, rejects
+
+	order = np.argsort(table.code, kind='stable')
+	codes = table.code[order]
+	starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+
+	def uniform(values: np.ndarray) -> np.ndarray:
+		values = values[order]
+		return np.minimum.reduceat(values, starts) == np.maximum.reduceat(values, starts)
+
+	same_size = uniform(table.size)
+	same_all = same_size & uniform(table.name) & uniform(np.nan_to_num(table.modtime, nan=-np.inf))
+
+	for code, rows, size, identical in zip(codes[starts], np.split(order, starts[1:]), same_size, same_all):
+		(accepts if identical else maybe if size else rejects)[table.codes[code]] = rows
+	return accepts, maybe, rejects
+
+
+
 @fig.component('default-ordering')
 class PathOrdering(fig.Configurable):
 	@staticmethod
@@ -1,95 +1,145 @@
 from pathlib import Path
-import shutil, sys, os, time
+import shutil, sys, os, time, io, tempfile, contextlib
 from tqdm import tqdm
 import textwrap
 from omnibelt import save_json, load_json
 from tabulate import tabulate
 from datetime import datetime, timedelta
 import omnifig as fig
-from functools import lru_cache
 import humanize
 
-from .database import FileDatabase
+from .database import FileDatabase, migrate_database
 from . import misc
-from .processing import recursive_mark_crawl, identify_duplicates, recursive_leaves_crawl, PathOrdering
+from .bench import generate_tree, measure
+from .metrics import instrumented
+from .similarity import index_directories, similar_directories
+from .moving import MoveJournal, move_paths, undo_moves, link_duplicates
+from .processing import (mark_crawl, identify_duplicates, stored_leaves, process_marked, queue_marks, resume_marks,
+						 chunk_files, PathOrdering)
 
 
 
 @fig.script('add', description='Process a given path (recursively add info to database)')
+@instrumented
 def add_path_to_db(cfg: fig.Configuration):
 
 	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
 	chunksize : int = cfg.pull('chunksize', 1024*1024)
-	db = FileDatabase(db_path, chunksize=chunksize)
+	batch_size : int = cfg.pull('batch-size', 1000)
+	flush_interval : float = cfg.pull('flush-interval', 10.)
+	tiered : bool = cfg.pull('tiered', False)
+	algorithm : str = cfg.pull('algorithm', None)
+	mmap_threshold : int = cfg.pull('mmap-threshold', None)
+	dir_hash : str = cfg.pull('dir-hash', None)
+	db = FileDatabase(db_path, chunksize=chunksize, batch_size=batch_size, flush_interval=flush_interval,
+					  tiered=tiered, algorithm=algorithm, mmap_threshold=mmap_threshold, dir_hash=dir_hash)
 
 	ignore_path_names = cfg.pull('ignore-path-names',
 								 ['omni-sink-quarantine', '$RECYCLE.BIN', 'Recovery'])
 	ignore_path_names = set(ignore_path_names)
 	report_description = cfg.pull('description', None)
 
+	refresh: bool = cfg.pull('refresh', False)
+	resume: bool = cfg.pull('resume', True)
+	retry: bool = cfg.pull('retry', False)
+
 	pbar: bool = cfg.pull('pbar', True)
+	workers: int = cfg.pull('workers', 0)
+	pool: str = cfg.pull('pool', 'thread') if workers else None
+
+	io_limits: dict[str, int] = cfg.pull('io-limits', None)
+	chunk_threshold: int = cfg.pull('chunk-threshold', None)
+	chunk_size: int = cfg.pull('chunk-size', 1024*1024)
 
-	base_path: Path = Path(cfg.pulls('path', 'p')).absolute()
+	roots = cfg.pulls('path', 'p')
+	roots = [Path(root).absolute() for root in (roots if isinstance(roots, (list, tuple)) else [roots])]
+	roots = [root for root in roots if not any(other != root and other in root.parents for other in roots)]
+	roots = list(dict.fromkeys(roots))
+	base_path = Path(os.path.commonpath(roots))
 
 	marked_paths = []
-	skipped_paths = []
-	itr = tqdm(desc='Marking items') if pbar else None
-	recursive_mark_crawl(db, marked_paths, skipped_paths, base_path, ignore_names=ignore_path_names, pbar=itr)
-	if pbar:
-		itr.close()
-		time.sleep(0.05) # to allow the previous tqdm to close
-
-	print(f'Skipped {len(skipped_paths)} items due to permission errors.')
-	if len(skipped_paths):
-		print(tabulate([[str(path)] for path in skipped_paths], headers=['Skipped Paths']))
-		print()
+	for root in roots:
+		marks = resume_marks(db, root) if resume else []
+		if len(marks):
+			print(f'Resuming interrupted run of {root} with {len(marks)} items left to process')
+		else:
+			skipped_paths = []
+			itr = tqdm(desc=f'Marking items in {root}') if pbar else None
+			mark_crawl(db, marks, skipped_paths, root, ignore_names=ignore_path_names, refresh=refresh,
+					   retry=retry, pbar=itr)
+			if pbar:
+				itr.close()
+				time.sleep(0.05) # to allow the previous tqdm to close
+
+			print(f'Skipped {len(skipped_paths)} items which could not be read.')
+			if len(skipped_paths):
+				print(tabulate([[str(path)] for path in skipped_paths], headers=['Skipped Paths']))
+				print()
+
+			db.get_report_id(report_description)
+			for path in skipped_paths:
+				db.save_file_info(path, (None, ()), status='skipped')
+			queue_marks(db, root, marks)
+		marked_paths.extend(marks)
 
 	total = len(marked_paths)
 	print(f'Found {total} items to process')
 
 	report_id = db.get_report_id(report_description)
-	print(f'Starting processing {base_path} ({total} items) with report-id {report_id}')
+	previous = {root: db.find_path(root) for root in roots}
+	print(f'Starting processing {", ".join(map(str, roots))} ({total} items) with report-id {report_id}')
 
 	start = time.time()
 
 	failures = []
 
-	itr = marked_paths
-	if pbar:
-		itr = tqdm(marked_paths)
-		itr.reset()
+	itr = tqdm(total=total) if pbar else None
 
 	try:
-		for mark in itr:
+		for mark, savepath, info in process_marked(db, marked_paths, ignore_path_names, workers=workers, pool=pool,
+												   io_limits=io_limits):
 			if pbar:
+				itr.update(1)
 				itr.set_description(f'{len(failures)} | {mark.relative_to(base_path)}')
 
-			try:
-				if mark.is_file():
-					savepath, info = db.process_file(mark)
-				elif mark.is_dir():
-					savepath, info = db.process_dir(mark, ignore_path_names)
-				else:
-					# raise ValueError(f"Unknown path type: {mark}")
-					failures.append(mark)
-					continue
-
-			except PermissionError:
+			if info is None:
 				failures.append(mark)
-
+				db.save_file_info(mark, (None, ()), status='failed')
 			else:
 				db.save_file_info(savepath, info)
 
+		if pbar:
+			itr.close()
+
 	except KeyboardInterrupt:
 		if pbar:
 			itr.close()
 		print('Interrupted. Saving database.')
-		# db.close()
+		db.close()
 
 		end = time.time()
 		print(f'Processing took {humanize.precisedelta(timedelta(seconds=end-start))}')
 		raise
 
+	finally: # keep everything processed so far (a resumed run continues from there)
+		db.flush()
+
+	if total > 0:
+		db.refresh_ancestors(roots, ignore_path_names, previous=previous)
+	if db.has_partial_hashes():
+		promoted = db.resolve_tiers(ignore_path_names,
+									pbar=(lambda sizes: tqdm(sizes, 'Resolving sizes')) if pbar else None)
+		print(f'Promoted {humanize.intcomma(len(promoted))} files with colliding sizes')
+	if chunk_threshold is not None:
+		itr = tqdm(desc='Chunking', unit='B', unit_scale=True, unit_divisor=1024) if pbar else None
+		chunked = sum(chunk_files(db, root, chunk_threshold, chunk_size=chunk_size, workers=workers, pool=pool,
+								  pbar=itr) for root in roots)
+		if pbar:
+			itr.close()
+		print(f'Chunked {humanize.intcomma(chunked)} files of at least {humanize.naturalsize(chunk_threshold)}')
+	for root in roots:
+		db.clear_queue(root)
+	db.close()
 	end = time.time()
 
 	print(f'Processing took {humanize.precisedelta(timedelta(seconds=end-start))}')
@@ -97,17 +147,19 @@ def add_path_to_db(cfg: fig.Configuration):
 	if len(failures):
 		print(tabulate([[str(path)] for path in failures], headers=['Failed Paths']))
 
-	print(f'Done processing {base_path}')
+	print(f'Done processing {", ".join(map(str, roots))}')
 
 
 
 @fig.script('dedupe', description='Finds and record duplicates items')
+@instrumented
 def find_path_duplicates(cfg: fig.Configuration):
 
 	candidates_path = Path(cfg.pulls('candidate-path', 'out', default=misc.data_root() / 'candidates.json'))
 
 	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
-	db = FileDatabase(db_path)
+	row_cache_size : int = cfg.pull('row-cache-size', 100000)
+	db = FileDatabase(db_path, row_cache_size=row_cache_size, read_only=True)
 
 	# @lru_cache(maxsize=None)
 	# def get_size(p: Path):
@@ -127,6 +179,10 @@ def find_path_duplicates(cfg: fig.Configuration):
 	base = db.find_path(base_path)
 	if base is None:
 		raise ValueError(f'No info found in database for {base_path} (run `add` first)')
+	unresolved = db.unresolved() if db.has_partial_hashes() else 0
+	if unresolved:
+		print(f'WARNING: {humanize.intcomma(unresolved)} files with colliding sizes were never hashed '
+			  f'(rerun `add` to resolve them)')
 
 	# base_code, (base_isdir, base_count, base_size, base_modtime) = info
 
@@ -134,49 +190,40 @@ def find_path_duplicates(cfg: fig.Configuration):
 	print(tabulate([['Size', humanize.naturalsize(base.size)],
 					['Count', humanize.intcomma(base.count)]]))
 
-	@lru_cache(maxsize=None)
-	def get_increment(path: Path):
-		item = db.find_path(path)
-		return item.size if use_bytes else item.count
-
 	print(f'Collecting all groups of items with identical hashes within {base.path} (this may take a while)')
 
 	start = time.time()
 
-	codes = {}
-	for item in db.find_all_duplicates(base.path):
-		codes.setdefault(item.code, []).append(item)
+	table = db.export_table(base.path, duplicates=True)
 
-	print(f'{len(codes)} hashes with more than one entry')
+	print(f'{len(table.codes)} hashes with more than one entry')
 
-	duplicates, possible, rejects = identify_duplicates(codes, pbar=tqdm if pbar else None)
+	duplicates, possible, rejects = identify_duplicates(table)
 
 	print(f'Found {humanize.intcomma(len(duplicates))} duplicate items '
 		  f'({humanize.intcomma(len(possible))} possible, {humanize.intcomma(len(rejects))} rejects)')
 
-	leaves = []
-
-	terminals = {item.code: code for code, group in duplicates.items() for item in group}
-	terminals.update({item.path: code for code, group in possible.items() for item in group})
+	terminals = {table.path(index): code for code, rows in duplicates.items() for index in rows}
+	terminals.update({table.path(index): code for code, rows in possible.items() for index in rows})
 
 	print(f'Finding leaves with {humanize.intcomma(len(terminals))} distinct terminals.')
 
 	pbar_args = {'total': base.size, 'unit': 'B', 'unit_scale': True, 'unit_divisor': 1024} \
 		if use_bytes else {'total': base.count, 'unit': 'item'}
 	itr = tqdm(**pbar_args) if pbar else None
-	recursive_leaves_crawl(leaves, base.path, terminals=terminals, pbar=itr, get_increment=get_increment)
+	leaves = stored_leaves(db, base.path, terminals, use_bytes=use_bytes, pbar=itr)
 	if pbar: itr.close()
 
 	print(f'Found {len(leaves)} leaves')
 
 	new_size = 0
 	cands = {}
-	for path in leaves:
-		code = terminals.get(path, None)
+	for leaf in leaves:
+		code = terminals.get(leaf.path, None)
 		if code not in cands:
-			new_size += db.find_path(path).size
+			new_size += leaf.size
 		if code is not None:
-			cands.setdefault(code, []).append(path)
+			cands.setdefault(code, []).append(leaf.path)
 
 	end = time.time()
 	print(f'Processing took {humanize.precisedelta(timedelta(seconds=end-start))}')
@@ -208,7 +255,70 @@ def find_path_duplicates(cfg: fig.Configuration):
 
 
 
+@fig.script('similar', description='Find pairs of directories with mostly the same contents')
+@instrumented
+def find_similar_directories(cfg: fig.Configuration):
+	out_path = cfg.pulls('out', 'similar-path', default=None)
+
+	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
+	db = FileDatabase(db_path)
+
+	base_path = cfg.pulls('path', 'p', default=None)
+	if base_path is not None:
+		base_path = Path(base_path).absolute()
+	threshold : float = cfg.pull('threshold', 0.8)
+	min_size : int = cfg.pull('min-size', 1024*1024)
+	limit : int = cfg.pull('limit', 20)
+	max_bucket : int = cfg.pull('max-bucket', 100)
+
+	start = time.time()
+	updated = index_directories(db, base_path)
+	print(f'Indexed {humanize.intcomma(updated)} directories')
+
+	pairs = similar_directories(db, base_path, threshold, min_size=min_size, max_bucket=max_bucket)
+	end = time.time()
+	print(f'Found {humanize.intcomma(len(pairs))} pairs of directories with a similarity of at least {threshold} '
+		  f'in {humanize.precisedelta(timedelta(seconds=end-start))}')
+
+	if len(pairs):
+		print(tabulate([[*pair['paths'], f'{pair["jaccard"]:.2f}', humanize.naturalsize(pair['shared'])]
+						for pair in pairs[:limit]], headers=['Directory', 'Other', 'Jaccard', 'Shared']))
+
+	if out_path is not None:
+		save_json(pairs, out_path)
+		print(f'Similar directories saved to {out_path}')
+	db.close()
+	return pairs
+
+
+
+@fig.script('shared', description='Report how many bytes a (chunked) file shares with other files')
+@instrumented
+def shared_bytes(cfg: fig.Configuration):
+	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
+	db = FileDatabase(db_path, read_only=True)
+	path = Path(cfg.pulls('path', 'p')).absolute()
+	limit : int = cfg.pull('limit', 20)
+
+	info = db.find_path(path)
+	if info is None:
+		raise ValueError(f'No info found in database for {path} (run `add` first)')
+	total, others = db.shared_chunks(path)
+	db.close()
+	if not total and not len(others):
+		print(f'{path} shares no chunks with other files (files are only chunked by `add` with `chunk-threshold`)')
+		return total, others
+
+	print(f'{path} shares {humanize.naturalsize(total)} of {humanize.naturalsize(info.size)} '
+		  f'({total / info.size * 100:.1f}%) with {humanize.intcomma(len(others))} other files')
+	print(tabulate([[str(other), humanize.naturalsize(size)] for other, size in list(others.items())[:limit]],
+				   headers=['File', 'Shared']))
+	return total, others
+
+
+
 @fig.script('quarantine')
+@instrumented
 def quarantine_targets(cfg: fig.Configuration):
 
 	candidates_path = Path(cfg.pulls('candidate-path', 'in', default=misc.data_root() / 'candidates.json'))
@@ -219,26 +329,31 @@ def quarantine_targets(cfg: fig.Configuration):
 			quarantine_root = Path(base_path).absolute() / 'omni-sink-quarantine'
 		else:
 			raise ValueError('Must provide either `quarantine-root` or `path`')
+	quarantine_root = Path(quarantine_root)
 
 	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
-	db = FileDatabase(db_path)
+	row_cache_size : int = cfg.pull('row-cache-size', 100000)
+	db = FileDatabase(db_path, row_cache_size=row_cache_size)
 
 	pbar: bool = cfg.pull('pbar', True)
 	show_top = cfg.pull('show-top', 10)
 	auto_confirm = cfg.pull('auto-confirm', False)
-
-	groups = load_json(candidates_path)
-	groups = [[Path(path) for path in group] for group in groups]
-
-	print(f'Preparing {len(groups)} candidate groups of duplicates.')
-
-	cfg.push('sorter._type', 'default-ordering', overwrite=False, silent=True)
-	sorter: PathOrdering = cfg.pull('sorter')
-
-	for group in tqdm(groups, 'Identifying Targets') if pbar else groups:
-		sorter.inplace(group, get_info=db.find_path)
-	groups.sort(key=lambda group: db.find_path(group[0]).size, reverse=True)
+	workers : int = cfg.pull('workers', 8)
+	ignore_path_names = set(cfg.pull('ignore-path-names', ['omni-sink-quarantine', '$RECYCLE.BIN', 'Recovery']))
+
+	journal = MoveJournal(quarantine_root / 'journal.jsonl')
+	if len(journal.pending()):
+		info = load_json(quarantine_root / 'info.json')
+		quarantine_dir = quarantine_root / 'content'
+		moves = [(Path(path), quarantine_dir / name) for name, path in info['quarantine'].items()]
+		print(f'Resuming interrupted quarantine of {len(moves)} items to {quarantine_dir}')
+		return _run_moves(db, journal, moves, ignore_path_names, workers=workers, pbar=pbar)
+
+	groups = _ordered_groups(cfg, db, candidates_path, pbar=pbar)
 	kill_list = [target for group in groups for target in group[1:]]
+	if not len(kill_list):
+		print('Nothing to quarantine.')
+		return {}
 	kill_size = sum(db.find_path(path).size for path in kill_list)
 	base_path = Path(os.path.commonpath([str(path) for path in kill_list]))
 
@@ -246,7 +361,9 @@ def quarantine_targets(cfg: fig.Configuration):
 	print(f'Found {humanize.intcomma(len(kill_list))} items to quarantine. '
 		  f'Total size: {humanize.naturalsize(kill_size)}')
 
-	fixed = {}
+	# names of earlier runs are kept, so nothing already in the quarantine is overwritten
+	previous = load_json(quarantine_root / 'info.json') if (quarantine_root / 'info.json').exists() else {}
+	fixed = {name: Path(path) for name, path in previous.get('quarantine', {}).items()}
 	reverse_fixed = {}
 	for path in kill_list:
 		name = path.name
@@ -285,26 +402,258 @@ def quarantine_targets(cfg: fig.Configuration):
 				print('Invalid input.')
 
 	quarantine_dir.mkdir(parents=True, exist_ok=True)
+	if 'base-path' in previous:
+		base_path = Path(os.path.commonpath([previous['base-path'], str(base_path)]))
 	save_json({
 		'base-path': str(base_path),
 		'timestamp': datetime.now().isoformat(),
 		'quarantine': {str(fixed): str(path) for fixed, path in fixed.items()},
-		'groups': [[str(path) for path in group] for group in groups],
+		'groups': previous.get('groups', []) + [[str(path) for path in group] for group in groups],
 	}, quarantine_root / 'info.json')
 
 	print(f'Quarantining {len(kill_list)} items to {quarantine_dir}')
-	for path in tqdm(kill_list, 'Quarantining') if pbar else kill_list:
-		dest = quarantine_dir / reverse_fixed[path]
-		shutil.move(str(path), str(dest))
+	_run_moves(db, journal, [(path, quarantine_dir / reverse_fixed[path]) for path in kill_list], ignore_path_names,
+			   workers=workers, pbar=pbar)
+	return {name: path for path, name in reverse_fixed.items()}
 
-	return fixed
 
 
+def _ordered_groups(cfg: fig.Configuration, db: FileDatabase, candidates_path: Path, *,
+					pbar: bool = True) -> list[list[Path]]:
+	'''loads the candidate groups with the item to keep first (see `PathOrdering`), largest groups first'''
+	groups = load_json(candidates_path)
+	groups = [[Path(path) for path in group] for group in groups]
+
+	print(f'Preparing {len(groups)} candidate groups of duplicates.')
+	if len(groups): # the rows of all candidates are looked up repeatedly (here and by the caller)
+		db.prefetch(os.path.commonpath([str(path) for group in groups for path in group]))
+
+	cfg.push('sorter._type', 'default-ordering', overwrite=False, silent=True)
+	sorter: PathOrdering = cfg.pull('sorter')
+
+	for group in tqdm(groups, 'Identifying Targets') if pbar else groups:
+		sorter.inplace(group, get_info=db.find_path)
+	groups.sort(key=lambda group: db.find_path(group[0]).size, reverse=True)
+	return groups
+
+
+
+def _run_moves(db: FileDatabase, journal: MoveJournal, moves, ignore_path_names, *, workers: int = 8,
+			   pbar: bool = True):
+	itr = tqdm(total=len(moves), desc='Quarantining') if pbar else None
+	failed = []
+	try:
+		moved = move_paths(moves, journal, workers=workers, db=db, status=('completed', 'quarantined'),
+						   failed=failed, pbar=itr)
+	finally:
+		journal.close()
+		if itr is not None:
+			itr.close()
+	db.refresh_ancestors([src for src, _ in moved], ignore_path_names)
+	db.close()
+	print(f'Moved {humanize.intcomma(len(moved))} items')
+	if len(failed):
+		print(f'Failed to move {humanize.intcomma(len(failed))} items (retried when run again)')
+		print(tabulate([[str(src), str(error)] for src, _, error in failed], headers=['Failed Paths', 'Error']))
+	return moved
+
+
+
+@fig.script('link', description='Replace duplicates with reflinks or hardlinks to the kept copy')
+@instrumented
+def link_targets(cfg: fig.Configuration):
+	candidates_path = Path(cfg.pulls('candidate-path', 'in', default=misc.data_root() / 'candidates.json'))
+
+	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
+	db = FileDatabase(db_path)
+
+	pbar : bool = cfg.pull('pbar', True)
+	mode : str = cfg.pull('mode', 'auto')
+	verify : str = cfg.pull('verify', 'hash')
+	auto_confirm : bool = cfg.pull('auto-confirm', False)
+
+	groups = _ordered_groups(cfg, db, candidates_path, pbar=pbar)
+	targets = [target for group in groups for target in group[1:]]
+	if not len(targets):
+		print('Nothing to link.')
+		return {}
+	total = sum(db.find_path(path).size for path in targets)
 
+	print()
+	print(f'Will replace {humanize.intcomma(len(targets))} items with {mode} links '
+		  f'(freeing up to {humanize.naturalsize(total)}, verified by {verify or "size"})')
+	if not auto_confirm:
+		while True:
+			confirm = input('Confirm? [y/n] ').lower()
+			if confirm in ['y', 'yes']:
+				break
+			elif confirm in ['n', 'no']:
+				print('Linking aborted.')
+				return
+			else:
+				print('Invalid input.')
 
+	itr = tqdm(total=len(targets), desc='Linking') if pbar else None
+	try:
+		results = link_duplicates(groups, mode=mode, verify=verify, algorithm=db.algorithm, db=db, pbar=itr)
+	finally:
+		if itr is not None:
+			itr.close()
+		db.close()
 
+	print(tabulate([[kind, humanize.intcomma(len(pairs))] for kind, pairs in results.items()],
+				   headers=['Result', 'Files']))
+	if len(results['failed']):
+		print(tabulate([[str(path)] for _, path in results['failed']], headers=['Failed Paths']))
+	return results
 
 
 
+@fig.script('restore', description='Undo a (possibly interrupted) quarantine')
+@instrumented
+def restore_quarantine(cfg: fig.Configuration):
+	quarantine_root = cfg.pulls('quarantine-root', 'in', default=None)
+	if quarantine_root is None:
+		base_path = cfg.pulls('path', 'p', default=None, silent=True)
+		if base_path is None:
+			raise ValueError('Must provide either `quarantine-root` or `path`')
+		quarantine_root = Path(base_path).absolute() / 'omni-sink-quarantine'
+	quarantine_root = Path(quarantine_root)
+
+	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
+	db = FileDatabase(db_path)
+	pbar : bool = cfg.pull('pbar', True)
+	workers : int = cfg.pull('workers', 8)
+	ignore_path_names = set(cfg.pull('ignore-path-names', ['omni-sink-quarantine', '$RECYCLE.BIN', 'Recovery']))
+
+	journal = MoveJournal(quarantine_root / 'journal.jsonl')
+	itr = tqdm(desc='Restoring') if pbar else None
+	failed = []
+	try:
+		count = undo_moves(journal, db=db, status=('quarantined', 'completed'), workers=workers, failed=failed,
+						   pbar=itr)
+	finally:
+		journal.close()
+		if itr is not None:
+			itr.close()
+	db.refresh_ancestors([Path(src) for src in journal.undone], ignore_path_names)
+	db.close()
+	if not journal.done and not journal.pending(): # everything is back, so no earlier run can be resumed
+		(quarantine_root / 'info.json').unlink(missing_ok=True)
+	print(f'Restored {humanize.intcomma(count)} items from {quarantine_root}')
+	if len(failed):
+		print(f'Failed to restore {humanize.intcomma(len(failed))} items (retried when run again)')
+		print(tabulate([[str(dst), str(error)] for _, dst, error in failed], headers=['Failed Paths', 'Error']))
+	return count
+
+
+
+@fig.script('tune-hash', description='Benchmark hash algorithms and read chunksizes on this machine')
+@instrumented
+def tune_hashing(cfg: fig.Configuration):
+	path = cfg.pulls('path', 'p', default=None)
+	if path is not None:
+		path = Path(path).absolute()
+	size : int = cfg.pull('size', 256*1024*1024)
+	algorithms = cfg.pull('algorithms', None)
+	chunksizes = cfg.pull('chunksizes', [64*1024, 256*1024, 1024*1024, 4*1024*1024])
+	repeats : int = cfg.pull('repeats', 3)
+
+	results = misc.benchmark_hashers(path, size=size, algorithms=algorithms, chunksizes=tuple(chunksizes),
+									 repeats=repeats)
+
+	print(tabulate([[algorithm, mode, f'{humanize.naturalsize(speed, binary=True)}/s']
+					for algorithm, mode, speed in results], headers=['Algorithm', 'Read', 'Throughput']))
+
+	algorithm, mode, speed = results[0]
+	print()
+	print(f'Fastest: {algorithm} with {mode} reads ({humanize.naturalsize(speed, binary=True)}/s)')
+	return results
 
 
+
+@fig.script('migrate', description='Convert a database to the current (compact) schema')
+@instrumented
+def migrate_db(cfg: fig.Configuration):
+	db_path : Path = Path(cfg.pull('db-path', misc.data_root()/'files.db'))
+	dest : str = cfg.pull('out', None)
+	backup : bool = cfg.pull('backup', True)
+
+	before, after = migrate_database(db_path, dest, backup=backup)
+
+	print(f'Migrated {db_path}{"" if dest is None else f" to {dest}"}: '
+		  f'{humanize.naturalsize(before, binary=True)} -> {humanize.naturalsize(after, binary=True)}')
+	return before, after
+
+
+
+@fig.script('bench', description='Benchmark add/dedupe/quarantine on a reproducible synthetic tree')
+@instrumented
+def run_benchmark(cfg: fig.Configuration):
+	root = cfg.pull('root', None)
+	keep : bool = cfg.pull('keep', False)
+	workdir = Path(tempfile.mkdtemp(prefix='sink-bench-')) if root is None else Path(root).absolute()
+	tree_args = {
+		'depth': cfg.pull('depth', 3),
+		'fanout': cfg.pull('fanout', 4),
+		'files': cfg.pull('files', 8),
+		'size_median': cfg.pull('size-median', 16*1024),
+		'size_sigma': cfg.pull('size-sigma', 2.),
+		'max_size': cfg.pull('max-size', 16*1024*1024),
+		'duplicate_ratio': cfg.pull('duplicate-ratio', 0.2),
+		'hardlink_ratio': cfg.pull('hardlink-ratio', 0.05),
+		'seed': cfg.pull('seed', 0),
+	}
+	phases : list[str] = cfg.pull('phases', ['add', 'dedupe', 'quarantine'])
+	add_args : dict = cfg.pull('add-args', {})
+	history_path = Path(cfg.pull('history', misc.data_root() / 'bench.json'))
+	label : str = cfg.pull('label', None)
+
+	tree = workdir / 'tree'
+	if tree.exists():
+		raise FileExistsError(f'{tree} already exists')
+	print(f'Generating synthetic tree in {tree}')
+	stats = generate_tree(tree, **tree_args)
+	print(tabulate([[key, humanize.intcomma(value)] for key, value in stats.items()]))
+
+	common = {'db-path': str(workdir / 'files.db'), 'path': str(tree), 'pbar': False}
+	phase_args = {
+		'add': {**common, **add_args},
+		'dedupe': {**common, 'out': str(workdir / 'candidates.json')},
+		'quarantine': {**common, 'in': str(workdir / 'candidates.json'), 'quarantine-root': str(workdir / 'quarantine'),
+					   'auto-confirm': True, 'show-top': None},
+	}
+
+	results = {}
+	try:
+		for phase in phases:
+			with measure(stats['files'], stats['bytes']) as results[phase]:
+				with contextlib.redirect_stdout(io.StringIO()):
+					fig.quick_run(phase, **phase_args[phase])
+	finally:
+		if not keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	history = load_json(history_path) if history_path.exists() else []
+	previous = history[-1]['phases'] if len(history) else {}
+	entry = {'timestamp': datetime.now().isoformat(), 'label': label, 'tree': {**tree_args, **stats},
+			 'phases': results}
+	history.append(entry)
+	history_path.parent.mkdir(parents=True, exist_ok=True)
+	save_json(history, history_path)
+
+	def change(phase, key):
+		old = previous.get(phase, {}).get(key)
+		new = results[phase][key]
+		return '' if not old or new is None else f'{(new - old) / old * 100:+.1f}%'
+
+	print(tabulate([[phase, f'{result["seconds"]:.2f}', f'{result["files/s"]:.0f}', change(phase, 'files/s'),
+					 f'{result["MB/s"]:.1f}', humanize.intcomma(result['queries']),
+					 humanize.naturalsize(result['peak-rss-increase'], binary=True),
+					 humanize.naturalsize(result['peak-rss'], binary=True),
+					 max(result['breakdown'], key=result['breakdown'].get)]
+					for phase, result in results.items()],
+				   headers=['Phase', 'Seconds', 'Files/s', 'vs. last', 'MB/s', 'Queries', 'Peak RSS +',
+							'Process Peak RSS', 'Bound']))
+	print(f'Results appended to {history_path}')
+	return entry
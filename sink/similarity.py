@@ -0,0 +1,177 @@
+import os
+from pathlib import Path
+from collections import Counter
+import numpy as np
+
+from .database import FileDatabase, RowTable
+
+
+
+PERMUTATIONS = 128 # length of each MinHash signature
+BANDS = 32 # LSH bands (of `PERMUTATIONS // BANDS` values each), so pairs above a Jaccard of ~0.42 are likely candidates
+_EMPTY = np.iinfo(np.uint32).max
+
+def _mix(values: np.ndarray) -> np.ndarray:
+	'''splitmix64 finalizer (a bijection on uint64 which scatters every input bit over the whole output)'''
+	values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return values ^ (values >> np.uint64(31))
+
+
+
+def _salts(permutations: int, seed: int) -> np.ndarray:
+	return np.random.default_rng(seed).integers(0, np.iinfo(np.uint64).max, size=permutations, dtype=np.uint64,
+												endpoint=True)
+
+
+
+def _reduce_into(signatures: np.ndarray, targets: np.ndarray, values: np.ndarray):
+	'''`signatures[targets] = min(signatures[targets], values)` where targets may repeat'''
+	if len(targets) == 0:
+		return
+	order = np.argsort(targets, kind='stable')
+	targets = targets[order]
+	starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+	reduced = np.minimum.reduceat(values[order], starts, axis=0)
+	signatures[targets[starts]] = np.minimum(signatures[targets[starts]], reduced)
+
+
+
+def minhash_signatures(table: RowTable, *, permutations: int = PERMUTATIONS, seed: int = 0,
+					   chunksize: int = 1 << 16) -> tuple[np.ndarray, np.ndarray]:
+	'''
+	MinHash signatures of the set of (non-empty) file codes below every directory row of `table`, which must contain
+	whole subtrees (e.g. from `FileDatabase.export_table`). Returns the indices of the directory rows and their
+	signatures (`permutations` uint32 each, directories without any files are all `_EMPTY`).
+	'''
+	rows = np.flatnonzero(table.count >= 0)
+	paths = [str(table.path(index)) for index in rows]
+	dir_index = {path: i for i, path in enumerate(paths)}
+	# directory row of every entry in `table.dirs` (-1 if the directory itself is not in the table)
+	owner = np.array([dir_index.get(path, -1) for path in table.dirs], dtype=np.int64)
+	signatures = np.full((len(rows), permutations), _EMPTY, dtype=np.uint32)
+	if len(rows) == 0:
+		return rows, signatures
+
+	salts = _salts(permutations, seed)
+	values = np.array([0 if code is None else int(code[:16].ljust(16, '0'), 16) for code in table.codes],
+					  dtype=np.uint64)
+	files = np.flatnonzero((table.count < 0) & (table.size > 0) & (owner[table.parent] >= 0))
+	for start in range(0, len(files), chunksize):
+		chunk = files[start:start + chunksize]
+		hashed = (_mix(values[table.code[chunk]][:, None] ^ salts[None, :]) >> np.uint64(32)).astype(np.uint32)
+		_reduce_into(signatures, owner[table.parent[chunk]], hashed)
+
+	# every directory includes the files of its subdirectories (deepest first)
+	depth = np.array([path.count(os.sep) for path in paths])
+	parent = owner[table.parent[rows]]
+	parent[parent == np.arange(len(rows))] = -1 # the filesystem root is its own parent
+	for level in np.unique(depth)[::-1]:
+		children = np.flatnonzero((depth == level) & (parent >= 0))
+		_reduce_into(signatures, parent[children], signatures[children])
+	return rows, signatures
+
+
+
+def band_buckets(signatures: np.ndarray, bands: int = BANDS) -> np.ndarray:
+	'''hashes each band of the signatures into an (int64) bucket'''
+	width = signatures.shape[1] // bands
+	buckets = np.empty((len(signatures), bands), dtype=np.uint64)
+	for band in range(bands):
+		bucket = np.full(len(signatures), band, dtype=np.uint64)
+		for column in signatures[:, band * width:(band + 1) * width].T:
+			bucket = _mix(bucket ^ column.astype(np.uint64))
+		buckets[:, band] = bucket
+	return buckets.view(np.int64)
+
+
+
+def index_directories(db: FileDatabase, root: Path | str = None, *, permutations: int = PERMUTATIONS,
+					  bands: int = BANDS, seed: int = 0) -> int:
+	'''
+	Updates the MinHash signatures and LSH buckets of all directories under `root` whose hash changed since they were
+	last indexed (in one pass over all rows under `root`). Returns the number of updated directories.
+	'''
+	stale = db.stale_minhashes(root)
+	if not len(stale):
+		return 0
+	table = db.export_table(root)
+	rows, signatures = minhash_signatures(table, permutations=permutations, seed=seed)
+	buckets = band_buckets(signatures, bands)
+	entries = []
+	for i, index in enumerate(rows):
+		row_id = stale.get(str(table.path(index)))
+		if row_id is not None:
+			empty = (signatures[i] == _EMPTY).all()
+			entries.append((row_id, table.codes[table.code[index]], signatures[i].tobytes(),
+							[] if empty else buckets[i].tolist()))
+	db.save_minhashes(entries)
+	return len(entries)
+
+
+
+def _contents(db: FileDatabase, path: str) -> Counter:
+	'''number of (non-empty) files below `path` with each `(code, size)`'''
+	return Counter((item.code, item.size) for item in db.find_all(path) if item.count is None and item.size)
+
+
+
+def similar_directories(db: FileDatabase, root: Path | str = None, threshold: float = 0.8, *,
+						min_size: int = 0, margin: float = 0.1, max_bucket: int = 100) -> list[dict]:
+	'''
+	Pairs of directories under `root` (largest shared size first) whose sets of file codes have a Jaccard similarity of
+	at least `threshold`. Candidates are the pairs sharing an LSH bucket (see `index_directories`), which are filtered by
+	their estimated similarity (with a `margin` for the estimation error) before the exact similarity and the shared
+	bytes are computed from the stored rows.
+	Directories with the same code are only paired through one representative (and reported with each copy), and
+	buckets holding more than `max_bucket` representatives are skipped (such pairs usually also share a smaller
+	bucket), so the number of candidates stays roughly linear in the number of directories.
+	Identical directories (see `dedupe`) and directories containing one another are skipped.
+	'''
+	signatures = {}
+	copies = {} # code -> row ids of all directories with that code (the first one represents them)
+	for row_id, path, code, size, signature in db.find_minhashes(root):
+		copies.setdefault(code, []).append(row_id)
+		signatures[row_id] = path, code, size, np.frombuffer(signature, dtype=np.uint32)
+
+	candidates = set()
+	def collect(group):
+		if len(group) <= max_bucket:
+			group.sort()
+			candidates.update((a, b) for i, a in enumerate(group) for b in group[i + 1:])
+
+	group, key = [], None
+	for band, bucket, row_id in db.find_buckets(root):
+		if (band, bucket) != key:
+			collect(group)
+			group, key = [], (band, bucket)
+		if copies[signatures[row_id][1]][0] == row_id:
+			group.append(row_id)
+	collect(group)
+
+	contents = {}
+	def get_contents(path):
+		if path not in contents:
+			contents[path] = _contents(db, path)
+		return contents[path]
+
+	pairs = []
+	for a, b in candidates:
+		(path_a, code_a, size_a, sig_a), (path_b, code_b, size_b, sig_b) = signatures[a], signatures[b]
+		if code_a == code_b or min(size_a, size_b) < min_size or np.mean(sig_a == sig_b) < threshold - margin:
+			continue
+		first, second = get_contents(path_a), get_contents(path_b)
+		union = len(first.keys() | second.keys())
+		jaccard = len(first.keys() & second.keys()) / union if union else 1.
+		if jaccard < threshold:
+			continue
+		shared = sum(min(count, second[key]) * key[1] for key, count in first.items() if key in second)
+		for copy_a in copies[code_a]:
+			for copy_b in copies[code_b]:
+				path_a, path_b = signatures[copy_a][0], signatures[copy_b][0]
+				if Path(path_a) in Path(path_b).parents or Path(path_b) in Path(path_a).parents:
+					continue
+				pairs.append({'paths': sorted([path_a, path_b]), 'jaccard': jaccard, 'shared': shared,
+							  'sizes': [size_a, size_b] if path_a < path_b else [size_b, size_a]})
+	pairs.sort(key=lambda pair: (-pair['shared'], -pair['jaccard'], pair['paths']))
+	return pairs
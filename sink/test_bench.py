@@ -0,0 +1,32 @@
+import omnifig as fig
+
+from . import scripts
+from .bench import generate_tree
+from .misc import file_hash
+
+
+def tree_contents(root):
+    return {path.relative_to(root).as_posix(): file_hash(path) for path in root.rglob('*') if path.is_file()}
+
+
+def test_generate_tree_is_reproducible(tmp_path):
+    args = dict(depth=2, fanout=2, files=4, size_median=256, duplicate_ratio=0.3, hardlink_ratio=0.2, seed=3)
+    stats = generate_tree(tmp_path / 'a', **args)
+    generate_tree(tmp_path / 'b', **args)
+    assert stats['dirs'] == 7 and stats['files'] == 28
+    assert stats['duplicates'] > 0 and stats['hardlinks'] > 0
+    assert tree_contents(tmp_path / 'a') == tree_contents(tmp_path / 'b')
+    generate_tree(tmp_path / 'c', **{**args, 'seed': 4})
+    assert tree_contents(tmp_path / 'a') != tree_contents(tmp_path / 'c')
+
+
+def test_bench_records_history(tmp_path):
+    history = tmp_path / 'history.json'
+    for _ in range(2):
+        entry = fig.quick_run('bench', **{'history': str(history), 'root': str(tmp_path / f'run{_}'), 'depth': 1,
+                                          'fanout': 2, 'files': 3, 'size-median': 128})
+    assert set(entry['phases']) == {'add', 'dedupe', 'quarantine'}
+    assert entry['phases']['add']['queries'] > 0 and entry['phases']['add']['peak-rss'] > 0
+    assert all(0 <= phase['peak-rss-increase'] <= phase['peak-rss'] for phase in entry['phases'].values())
+    assert len(scripts.load_json(history)) == 2
+    assert not (tmp_path / 'run0').exists()
@@ -0,0 +1,344 @@
+import hashlib
+import pytest
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import FileDatabase, migrate_database, hash_file
+
+
+def stored_count(db):
+    conn = sqlite3.connect(str(db.db_path))
+    count = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_batched_writes(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=3)
+    assert db.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    db.save_file_info('/data/a', ('00', (None, 1, 0., None)))
+    db.save_file_info('/data/b', ('01', (None, 2, 0., None)))
+    assert stored_count(db) == 0
+    assert db.exists('/data/a')
+    assert db.find_path('/data/b').size == 2
+
+    db.save_file_info('/data/c', ('02', (None, 3, 0., None)))
+    assert stored_count(db) == 3
+
+    db.save_file_info('/data/d', ('03', (None, 4, 0., None)))
+    db.close()
+    assert stored_count(db) == 4
+
+
+def test_flush_interval(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=1000, flush_interval=0.)
+    db.save_file_info('/data/a', ('00', (None, 1, 0., None)))
+    assert stored_count(db) == 1
+
+
+def test_queries_see_buffered_rows(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=1000)
+    db.save_file_info('/data/a', ('00', (None, 1, 0., None)))
+    db.save_file_info('/data/b', ('00', (None, 1, 0., None)))
+    assert sorted(str(item.path) for item in db.find_all_duplicates('/data')) == ['/data/a', '/data/b']
+
+
+def test_tiered_hashing(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'a').mkdir(parents=True)
+    (root / 'b').mkdir()
+    (root / 'a' / 'same.bin').write_bytes(b'x' * 1000)
+    (root / 'b' / 'same.bin').write_bytes(b'x' * 1000)
+    (root / 'a' / 'sample.bin').write_bytes(b'y' * 1000)
+    (root / 'a' / 'unique.bin').write_bytes(b'z' * 10)
+
+    db = FileDatabase(tmp_path / 'files.db', tiered=True, sample_size=16)
+    for path in [root / 'a' / 'same.bin', root / 'a' / 'sample.bin', root / 'a' / 'unique.bin', root / 'a',
+                 root / 'b' / 'same.bin', root / 'b', root]:
+        if path.is_dir():
+            db.save_file_info(*db.process_dir(path, set()))
+        else:
+            db.save_file_info(*db.process_file(path))
+    assert db.unresolved() == 3
+
+    promoted = db.resolve_tiers(set())
+    assert len(promoted) == 3
+    assert db.unresolved() == 0
+    assert not db.resolve_tiers(set())
+
+    full = FileDatabase(tmp_path / 'full.db')
+    tiers = {}
+    for item in db.find_all(root):
+        if item.count is None:
+            assert item.tier is not None
+            tiers[item.path.relative_to(root).as_posix()] = item.tier
+            if item.tier == 2:
+                assert item.code == full.compute_hash(item.path)
+    assert tiers == {'a/same.bin': 2, 'b/same.bin': 2, 'a/sample.bin': 1, 'a/unique.bin': 0}
+    assert sorted(item.path.name for item in db.find_all_duplicates(root)) == ['same.bin', 'same.bin']
+
+    root_code = {item.path: item.code for item in db.find_all(root)}[root]
+    (root / 'b' / 'new.bin').write_bytes(b'y' * 1000)
+    full.save_file_info(*full.process_file(root / 'b' / 'new.bin'))
+    db.save_file_info(*db.process_file(root / 'b' / 'new.bin'))
+    db.save_file_info(*db.process_dir(root / 'b', set()))
+    assert len(db.resolve_tiers(set())) == 2
+    assert db.find_path(root / 'a' / 'sample.bin').tier == 2
+    assert {item.path: item.code for item in db.find_all(root)}[root] != root_code
+
+
+def test_algorithm_is_fixed_per_database(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'hello')
+
+    db = FileDatabase(tmp_path / 'files.db', algorithm='sha1')
+    db.save_file_info(*db.process_file(path))
+    assert db.find_path(path).code == hashlib.sha1(b'hello').hexdigest()
+    db.close()
+
+    assert FileDatabase(tmp_path / 'files.db').algorithm == 'sha1'
+    with pytest.raises(ValueError):
+        FileDatabase(tmp_path / 'files.db', algorithm='md5')
+
+
+def test_migrate_legacy_database(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'old.db'))
+    conn.execute('CREATE TABLE reports (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 'created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, description TEXT)')
+    conn.execute('CREATE TABLE files (path TEXT PRIMARY KEY, report INTEGER NOT NULL, status TEXT, hash TEXT, '
+                 'filecount INTEGER, filesize INTEGER, modification_time REAL)')
+    conn.execute("INSERT INTO reports (description) VALUES ('old')")
+    conn.executemany("INSERT INTO files VALUES (?, 1, 'completed', ?, ?, ?, 0.)",
+                     [('/data', 'abc', 2, 3), ('/data/a', '01', None, 1), ('/data/b', '02', None, 2)])
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(ValueError):
+        FileDatabase(tmp_path / 'old.db')
+
+    before, after = migrate_database(tmp_path / 'old.db')
+    assert (tmp_path / 'old.db.bak').exists()
+    assert before > 0 and after > 0
+
+    db = FileDatabase(tmp_path / 'old.db')
+    assert db.algorithm == 'md5'
+    assert sorted(db._find_children_raw('/data')) == ['a', 'b']
+    assert db.find_path('/data/a').inode is None
+    assert db.find_path('/data/b').code == '02'
+    assert db.find_path('/data').code == '0abc'
+    assert db.conn.execute('SELECT typeof(hash) FROM files LIMIT 1').fetchone()[0] == 'blob'
+
+
+def test_subtree_queries_are_separator_correct(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db')
+    for path in ['/data/foo', '/data/foo/a', '/data/foobar', '/data/foobar/a', '/data/foo-1']:
+        db.save_file_info(path, ('00', (None, 1, 0.)))
+    assert sorted(str(item.path) for item in db.find_all('/data/foo')) == ['/data/foo', '/data/foo/a']
+    assert sorted(str(item.path) for item in db.find_duplicates('00', '/data/foo')) == ['/data/foo', '/data/foo/a']
+    assert db.known_paths('/data/foobar') == {'/data/foobar', '/data/foobar/a'}
+
+    clause, params = db._subtree_clause('/data/foo')
+    plan = db.conn.execute(f'EXPLAIN QUERY PLAN SELECT * FROM files f JOIN dirs d ON f.parent = d.id WHERE {clause}',
+                           params).fetchall()
+    assert not any('SCAN' in step[-1] for step in plan)
+
+
+def test_clusters_follow_writes(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db')
+    db.save_file_info('/data/a', ('00', (None, 1, 0.)))
+    db.save_file_info('/data/b', ('00', (None, 1, 0.)))
+    db.save_file_info('/data/c', ('01', (None, 5, 0.)))
+    db.save_file_info('/data/e', ('02', (None, 0, 0.)))
+    db.save_file_info('/data/f', ('02', (None, 0, 0.)))
+    assert list(db.find_clusters()) == [('00', 2, 2)]
+
+    db.save_file_info('/data/b', ('01', (None, 5, 0.)))
+    assert list(db.find_clusters()) == [('01', 2, 10)]
+    assert sorted(str(item.path) for item in db.find_all_duplicates()) == ['/data/b', '/data/c']
+
+    db.remove_paths(['/data/c'])
+    assert list(db.find_clusters()) == []
+    assert db.conn.execute('SELECT members FROM clusters WHERE hash=?', (bytes.fromhex('00'),)).fetchone() == (1,)
+
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    list(db.find_all_duplicates('/data'))
+    assert not any('GROUP BY' in query for query in queries)
+
+    queries.clear()
+    list(db.find_all_duplicates())
+    db.conn.set_trace_callback(None)
+    plan = db.conn.execute(f'EXPLAIN QUERY PLAN {queries[-1]}').fetchall()
+    assert 'idx_clusters' in plan[0][-1] # only the rows of clusters are read (not the whole files table)
+
+
+def test_sizes_follow_writes(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', tiered=True)
+    for name, size in [('a', 7), ('b', 7), ('c', 9)]:
+        db.save_file_info(f'/data/{name}', ('00', (None, size, 0., 0, 0)))
+    db.save_file_info('/data', ('01', (3, 23, 0., 0, None)))
+    db.save_file_info('/data/d', (None, ()), status='failed')
+
+    def sizes():
+        db.flush()
+        return dict(db.conn.execute('SELECT filesize, members FROM sizes').fetchall())
+    assert sizes() == {7: 2, 9: 1}
+    assert db.unresolved() == 2
+    db.save_file_info('/data/b', ('00', (None, 9, 0., 0, 0)))
+    assert sizes() == {7: 1, 9: 2}
+    db.remove_paths(['/data/c'])
+    assert sizes() == {7: 1, 9: 1}
+    assert db.unresolved() == 0
+
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    db.unresolved()
+    assert not any('GROUP BY' in query for query in queries)
+
+
+def test_row_cache(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', row_cache_size=2)
+    db.save_file_info('/data', ('00', (2, 3, 0.)))
+    db.save_file_info('/data/a', ('01', (None, 1, 0.)))
+    db.save_file_info('/data/b', ('02', (None, 2, 0.)))
+
+    assert db.find_path('/data/a').code == '01'
+    assert db.find_path('/data/a').code == '01'
+    assert db.row_cache.stats()['hits'] == 1
+
+    db.save_file_info('/data/a', ('03', (None, 1, 0.)))
+    assert db.find_path('/data/a').code == '03'
+    assert db.find_path('/data/missing') is None
+    db.save_file_info('/data/missing', ('04', (None, 1, 0.)))
+    assert db.find_path('/data/missing').code == '04'
+    assert len(db.row_cache) == 2
+
+    db.row_cache.maxsize = 10
+    db.row_cache.clear()
+    assert db.prefetch('/data') == 4
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    assert db.find_path('/data/b').size == 2
+    assert not queries
+
+    db.remove_paths(['/data/b'])
+    assert db.find_path('/data/b') is None
+
+
+def test_streaming_and_export(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db')
+    db._fetch_size = 2
+    db.save_file_info('/data', ('0a', (3, 4, 0.)))
+    for name, code, size in [('a', '00', 1), ('b', '00', 1), ('c', '01', 2)]:
+        db.save_file_info(f'/data/{name}', (code, (None, size, 1.)))
+    db.save_file_info('/other', ('00', (None, 1, 1.)))
+
+    assert len(list(db.find_all('/data'))) == 4
+
+    columns = db.export_columns('/data')
+    assert sorted(columns) == sorted(['path', 'code', 'count', 'size', 'modtime', 'inode', 'tier'])
+    assert sorted(zip(columns['path'], columns['code'], columns['size'])) == [
+        ('/data', '0a', 4), ('/data/a', '00', 1), ('/data/b', '00', 1), ('/data/c', '01', 2)]
+
+    frame = db.export_frame(duplicates=True)
+    assert sorted(frame['path']) == ['/data/a', '/data/b', '/other']
+    assert (frame['size'] == 1).all()
+
+
+def test_multiset_directory_hashes(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'x.txt').write_text('same')
+    (root / 'a' / 'y.txt').write_text('same')
+    (root / 'a' / 'b' / 'z.txt').write_text('other')
+    order = [root / 'a' / 'b' / 'z.txt', root / 'a' / 'b', root / 'a' / 'y.txt', root / 'a', root / 'x.txt', root]
+
+    def add(db):
+        for path in order:
+            db.save_file_info(*(db.process_dir(path, set()) if path.is_dir() else db.process_file(path)))
+
+    def snapshot(db):
+        return {item.path: (item.code, item.count, item.size) for item in db.find_all(root)}
+
+    db = FileDatabase(tmp_path / 'files.db', dir_hash='multiset')
+    code = db.compute_hash(root / 'x.txt')
+    assert db.compute_directory_hash([code, code]) != db.compute_directory_hash([])
+    assert db.compute_directory_hash([code]) != code
+    add(db)
+
+    target = root / 'a' / 'b' / 'z.txt'
+    previous = db.find_path(target)
+    target.write_text('changed')
+    db.save_file_info(*db.process_file(target))
+    with monkeypatch.context() as m:
+        m.setattr('os.scandir', None) # siblings are never listed
+        assert db.refresh_ancestors([target], set(), previous={target: previous}) == 3
+
+    full = FileDatabase(tmp_path / 'full.db', dir_hash='multiset')
+    add(full)
+    assert snapshot(db) == snapshot(full)
+
+    tiered = FileDatabase(tmp_path / 'tiered.db', dir_hash='multiset', tiered=True, sample_size=1)
+    add(tiered)
+    assert len(tiered.resolve_tiers(set())) == 2
+    incremental = snapshot(tiered)
+    for path in order:
+        if path.is_dir():
+            tiered.save_file_info(*tiered.process_dir(path, set()))
+    assert snapshot(tiered) == incremental
+    assert incremental[root / 'x.txt'] == snapshot(full)[root / 'x.txt']
+
+    db.close()
+    with pytest.raises(ValueError):
+        FileDatabase(tmp_path / 'files.db', dir_hash='sorted')
+
+
+def test_connections_per_thread(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=1000)
+    for i in range(100):
+        db.save_file_info(f'/data/{i}', (f'{i:02x}', (None, i, 0.)))
+    db.flush()
+
+    def lookup(i):
+        return db.conn, db.find_path(f'/data/{i}').size
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lookup, range(100)))
+    assert [size for _, size in results] == list(range(100))
+    assert len({id(conn) for conn, _ in results} | {id(db.conn)}) > 1
+    db.close()
+
+
+def test_workers_only_get_hash_settings(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=1000)
+    for i in range(100):
+        db.save_file_info(f'/data/{i}', (f'{i:02x}', (None, i, 0.)))
+    copy = pickle.loads(pickle.dumps(db))
+    assert not copy._pending and not copy._dir_ids
+
+    (tmp_path / 'data.bin').write_bytes(b'x' * 1000)
+    stat = (tmp_path / 'data.bin').stat()
+    assert hash_file(tmp_path / 'data.bin', stat, **db.hash_settings()) == db.process_file(tmp_path / 'data.bin')
+    db.close()
+
+
+def test_read_only_while_writing(tmp_path):
+    writer = FileDatabase(tmp_path / 'files.db')
+    writer.save_file_info('/data/a', ('00', (None, 1, 0.)))
+
+    reader = FileDatabase(tmp_path / 'files.db', read_only=True, timeout=0.1)
+    writer.conn.execute('BEGIN IMMEDIATE')
+    writer.conn.execute("UPDATE files SET filesize = 2 WHERE name = 'a'")
+    assert reader.find_path('/data/a').size == 1 # not blocked by the open write transaction
+    writer.conn.commit()
+    reader.row_cache.clear()
+    assert reader.find_path('/data/a').size == 2
+
+    with pytest.raises(ValueError):
+        reader.save_file_info('/data/b', ('01', (None, 1, 0.)))
+    with pytest.raises(sqlite3.OperationalError):
+        reader.conn.execute('DELETE FROM files')
+    with pytest.raises(FileNotFoundError):
+        FileDatabase(tmp_path / 'other.db', read_only=True)
@@ -0,0 +1,45 @@
+import json
+import pickle
+import omnifig as fig
+
+from . import scripts, metrics
+from .database import FileDatabase
+from .metrics import Metrics
+
+
+def test_timers_and_merging():
+    a = Metrics()
+    with a.timer('hash', cpu=True):
+        sum(range(10000))
+    a.add('hashed-bytes', 10)
+    b = pickle.loads(pickle.dumps(a))
+    b.merge(a.state())
+    assert b.counts == {'hash': 2, 'hashed-bytes': 20}
+    assert b.cpu_seconds['hash'] > 0
+    assert set(b.breakdown()) == {'io', 'cpu', 'db'}
+
+
+def test_database_records_metrics(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(b'x' * 100)
+    m = Metrics()
+    db = FileDatabase(tmp_path / 'files.db', metrics=m)
+    db.save_file_info(*db.process_file(path))
+    db.find_path(path)
+    db.find_path(path)
+    assert m.counts['hashed-bytes'] == 100 and m.counts['stat'] == 1
+    assert m.counts['sql'] > 0 and m.counts['commit'] > 0
+    assert m.counts['cache-hits'] == 1 and m.counts['cache-misses'] == 1
+
+
+def test_scripts_dump_metrics_and_profile(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'a.txt').write_text('hello')
+    fig.quick_run('add', **{'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False,
+                            'metrics-out': str(tmp_path / 'metrics.json'), 'profile': str(tmp_path / 'add.prof')})
+    summary = json.loads((tmp_path / 'metrics.json').read_text())
+    assert summary['counts']['hashed-bytes'] == 5
+    assert summary['bound'] in {'io', 'cpu', 'db'}
+    assert (tmp_path / 'add.prof').exists()
+    assert metrics.current().counts.get('hashed-bytes', 0) >= 5
@@ -5,6 +5,7 @@ from . import misc
 from .misc import xor_hexdigests  # assuming your function is in 'your_module.py'
 import os
 import tempfile
+import numpy as np
 
 
 
@@ -75,3 +76,68 @@ def test_small_file(setup_temp_files):
 
 
 
+
+
+@pytest.mark.parametrize('algorithm', ['md5', 'sha1', 'blake2b'])
+def test_file_hash_algorithms(tmp_path, algorithm):
+    data = os.urandom(100_000)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+
+    expected = misc.hash_bytes(data, algorithm)
+    assert misc.file_hash(path, algorithm, chunksize=4096) == expected
+    assert misc.file_hash(path, algorithm, mmap_threshold=0) == expected
+    assert misc.file_hash(path, algorithm, chunksize=1 << 20) == expected
+
+
+def test_empty_file_hash(tmp_path):
+    path = tmp_path / 'empty'
+    path.write_bytes(b'')
+    assert misc.file_hash(path, mmap_threshold=0) == misc.md5_hash(b'')
+
+
+def test_unknown_hasher():
+    with pytest.raises(ValueError):
+        misc.get_hasher('crc-0')
+
+
+def test_benchmark_hashers():
+    results = misc.benchmark_hashers(size=1 << 20, algorithms=['md5', 'sha1'], chunksizes=(4096,), repeats=1)
+    assert len(results) == 4
+    assert results[0][2] >= results[-1][2]
+
+
+def test_subtree_bounds():
+    lower, upper = misc.subtree_bounds(os.path.join(os.sep, 'data', 'foo'))
+    inside = [os.path.join(os.sep, 'data', 'foo', name) for name in ['a', 'zzz', 'a b', '~']]
+    outside = [os.path.join(os.sep, 'data', name) for name in ['foo', 'foobar', 'foo-1', 'foo.txt', 'fop']]
+    assert all(lower <= path < upper for path in inside)
+    assert not any(lower <= path < upper for path in outside)
+    assert misc.subtree_bounds(os.sep)[0] == os.sep
+
+
+def test_device_kind(tmp_path):
+    assert misc.device_kind(os.stat(tmp_path).st_dev) in {'ssd', 'hdd', 'network', 'unknown'}
+
+
+def test_gear_hashes_match_rolling_hash():
+    data = np.random.default_rng(0).integers(0, 256, 1000, dtype=np.uint8)
+    table, value = misc.gear_table(), 0
+    for byte, expected in zip(data, misc.gear_hashes(data)):
+        value = ((value << 1) + int(table[byte])) & 0xffffffff
+        assert value == expected
+
+
+def test_file_chunks(tmp_path):
+    data = np.random.default_rng(0).integers(0, 256, 1 << 20, dtype=np.uint8).tobytes()
+    (tmp_path / 'a.bin').write_bytes(data)
+    (tmp_path / 'b.bin').write_bytes(data[:5000] + b'inserted' + data[5000:])
+
+    chunks = misc.file_chunks(tmp_path / 'a.bin', avg_size=16 * 1024)
+    assert chunks == misc.file_chunks(tmp_path / 'a.bin', avg_size=16 * 1024, blocksize=10000)
+    assert [offset for offset, *_ in chunks] == [0] + list(np.cumsum([size for _, size, _ in chunks])[:-1])
+    assert sum(size for _, size, _ in chunks) == len(data)
+    assert all(4 * 1024 <= size <= 64 * 1024 for _, size, _ in chunks[:-1])
+
+    edited = misc.file_chunks(tmp_path / 'b.bin', avg_size=16 * 1024)
+    assert len({code for *_, code in chunks} - {code for *_, code in edited}) == 1
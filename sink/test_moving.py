@@ -0,0 +1,160 @@
+import os
+import json
+import pytest
+import omnifig as fig
+
+from . import scripts, moving
+from .database import FileDatabase
+from .moving import MoveJournal, copy_file, move_paths, link_duplicates
+
+
+def test_copy_file(tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    (tmp_path / 'src.bin').write_bytes(data)
+    os.utime(tmp_path / 'src.bin', (1000, 2000))
+    copy_file(tmp_path / 'src.bin', tmp_path / 'dst.bin', chunksize=1024 * 1024)
+    assert (tmp_path / 'dst.bin').read_bytes() == data
+    assert (tmp_path / 'dst.bin').stat().st_mtime == 2000
+
+
+def test_resume_interrupted_moves(tmp_path):
+    for name in 'abc':
+        (tmp_path / name).write_text(name)
+    out = tmp_path / 'out'
+    moves = [(tmp_path / name, out / name) for name in 'abc']
+
+    journal = MoveJournal(tmp_path / 'journal.jsonl')
+    journal.start(moves[:2])
+    out.mkdir()
+    os.rename(tmp_path / 'a', out / 'a') # interrupted before it was marked as done
+    journal.close()
+
+    journal = MoveJournal(tmp_path / 'journal.jsonl')
+    assert [src.name for src, _ in journal.pending()] == ['a', 'b']
+    moved = move_paths(moves, journal)
+    journal.close()
+    assert sorted(src.name for src, _ in moved) == ['a', 'b', 'c']
+    assert sorted(path.name for path in out.iterdir()) == ['a', 'b', 'c']
+    assert not MoveJournal(tmp_path / 'journal.jsonl').pending()
+
+
+def test_failed_copies_keep_finished_moves(tmp_path, monkeypatch):
+    for name in 'abc':
+        (tmp_path / name).write_text(name)
+    out = tmp_path / 'out'
+    moves = [(tmp_path / name, out / name) for name in 'abc']
+
+    lstat, move_path = os.lstat, moving.move_path
+    def other_device(path, *args, **kwargs):
+        stat = lstat(path, *args, **kwargs)
+        if os.path.dirname(path) == str(tmp_path):
+            return os.stat_result((*stat[:2], stat.st_dev + 1, *stat[3:]))
+        return stat
+    def broken(src, dst):
+        if src.name == 'b':
+            raise OSError('disk full')
+        return move_path(src, dst)
+    monkeypatch.setattr(os, 'lstat', other_device)
+    monkeypatch.setattr(moving, 'move_path', broken)
+
+    journal = MoveJournal(tmp_path / 'journal.jsonl')
+    with pytest.raises(OSError, match='disk full'):
+        move_paths(moves, journal, workers=2)
+    journal.close()
+    journal = MoveJournal(tmp_path / 'journal.jsonl')
+    assert sorted(journal.done) == [str(tmp_path / 'a'), str(tmp_path / 'c')]
+    assert [src.name for src, _ in journal.pending()] == ['b']
+
+    failed = []
+    assert move_paths(moves, journal, workers=2, failed=failed) == []
+    assert [(src.name, str(error)) for src, _, error in failed] == [('b', 'disk full')]
+    monkeypatch.undo()
+    assert [src.name for src, _ in move_paths(moves, journal)] == ['b']
+    journal.close()
+    assert sorted(path.name for path in out.iterdir()) == ['a', 'b', 'c']
+
+
+def test_quarantine_and_restore(tmp_path, sample_tree, run_add):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    db.close()
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False}
+
+    fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))
+    fig.quick_run('quarantine', **args, **{'in': str(tmp_path / 'candidates.json'), 'auto-confirm': True,
+                                           'quarantine-root': str(tmp_path / 'quarantine')})
+    content = tmp_path / 'quarantine' / 'content'
+    assert sorted(path.name for path in content.iterdir()) == ['x.txt', 'y.txt']
+    assert not (sample_tree / 'a' / 'c' / 'y.txt').exists()
+
+    db = FileDatabase(tmp_path / 'files.db')
+    assert db.find_path(sample_tree / 'a' / 'c' / 'y.txt') is None
+    assert db.find_path(content / 'y.txt') is None
+    assert db.exists(content / 'y.txt', status='quarantined')
+    assert db.find_path(sample_tree / 'a').size == 0
+    db.close()
+
+    # quarantined copies are not duplicates of the kept files, and a later run keeps the earlier names
+    assert fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json')) == []
+    (sample_tree / 'b' / 'z.txt').write_text('something else')
+    fig.quick_run('add', **args, refresh=True)
+    fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))
+    fig.quick_run('quarantine', **args, **{'in': str(tmp_path / 'candidates.json'), 'auto-confirm': True,
+                                           'quarantine-root': str(tmp_path / 'quarantine')})
+    assert sorted(path.name for path in content.iterdir()) == ['x.txt', 'y.txt', 'z.txt']
+    info = json.loads((tmp_path / 'quarantine' / 'info.json').read_text())
+    assert sorted(info['quarantine']) == ['x.txt', 'y.txt', 'z.txt']
+
+    assert fig.quick_run('restore', **args, **{'in': str(tmp_path / 'quarantine')}) == 3
+    assert (sample_tree / 'a' / 'c' / 'y.txt').read_text() == 'something else'
+    db = FileDatabase(tmp_path / 'files.db')
+    assert db.find_path(sample_tree / 'a' / 'c' / 'y.txt').size == 14
+    assert db.find_path(sample_tree / 'a').size == 27
+    assert not (tmp_path / 'quarantine' / 'info.json').exists()
+    assert len(fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))) == 2
+
+
+def test_link_duplicates(tmp_path, sample_tree, run_add):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    db.close()
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False}
+    fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))
+    results = fig.quick_run('link', **args, **{'in': str(tmp_path / 'candidates.json'), 'auto-confirm': True})
+
+    assert len(results['reflink']) + len(results['hardlink']) == 2 and not results['failed']
+    for keep, target in results['reflink'] + results['hardlink']:
+        assert keep.read_bytes() == target.read_bytes()
+    for keep, target in results['hardlink']:
+        assert keep.stat().st_ino == target.stat().st_ino
+        assert FileDatabase(tmp_path / 'files.db').find_path(target).inode == keep.stat().st_ino
+
+    again = fig.quick_run('link', **args, **{'in': str(tmp_path / 'candidates.json'), 'auto-confirm': True,
+                                             'mode': 'hardlink'})
+    assert len(again['skipped']) == len(results['hardlink'])
+    assert len(again['hardlink']) == len(results['reflink'])
+
+
+def test_candidates_are_prefetched(tmp_path, sample_tree, run_add, monkeypatch):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    db.close()
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False}
+    fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))
+
+    lookups = []
+    find_path_raw = FileDatabase._find_path_raw
+    def counted(self, path, *args, **kwargs):
+        lookups.append(path)
+        return find_path_raw(self, path, *args, **kwargs)
+    monkeypatch.setattr(FileDatabase, '_find_path_raw', counted)
+    fig.quick_run('link', **args, **{'in': str(tmp_path / 'candidates.json'), 'auto-confirm': True})
+    assert lookups == []
+
+
+def test_link_skips_mismatches(tmp_path):
+    (tmp_path / 'a').write_bytes(b'same size 1')
+    (tmp_path / 'b').write_bytes(b'same size 2')
+    results = link_duplicates([[tmp_path / 'a', tmp_path / 'b']], mode='hardlink', verify='bytes')
+    assert results['skipped'] == [(tmp_path / 'a', tmp_path / 'b')]
+    assert (tmp_path / 'b').read_bytes() == b'same size 2'
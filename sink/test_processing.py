@@ -0,0 +1,441 @@
+import os
+import pytest
+import shutil
+import numpy as np
+from pathlib import Path
+import omnifig as fig
+
+from . import scripts, misc
+from .database import FileDatabase
+from .processing import mark_crawl, process_marked, identify_duplicates, IOScheduler
+
+
+@pytest.mark.parametrize('workers,pool', [(2, 'thread'), (3, 'process')])
+def test_parallel_matches_serial(tmp_path, sample_tree, run_add, snapshot, workers, pool):
+    serial = FileDatabase(tmp_path / 'serial.db')
+    run_add(serial, sample_tree)
+
+    parallel = FileDatabase(tmp_path / 'parallel.db')
+    marked = run_add(parallel, sample_tree, workers=workers, pool=pool)
+
+    assert len(marked) == 9
+    assert snapshot(parallel, sample_tree) == snapshot(serial, sample_tree)
+    assert parallel.find_path(sample_tree).count == 5
+
+
+def test_directories_wait_for_children(tmp_path, sample_tree):
+    db = FileDatabase(tmp_path / 'files.db')
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set())
+
+    finished = set()
+    for mark, savepath, info in process_marked(db, marked, set(), workers=4):
+        if mark.is_dir():
+            assert all(sub in finished for sub in mark.iterdir())
+        finished.add(mark)
+        db.save_file_info(savepath, info)
+
+
+def test_unknown_pool(tmp_path, sample_tree):
+    db = FileDatabase(tmp_path / 'files.db')
+    with pytest.raises(ValueError):
+        list(process_marked(db, [sample_tree], set(), workers=2, pool='fibers'))
+
+
+def test_refresh_marks_only_changes(tmp_path, sample_tree, run_add, snapshot):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    before = snapshot(db, sample_tree)
+
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set(), refresh=True)
+    assert marked == []
+
+    (sample_tree / 'a' / 'c' / 'y.txt').write_text('something new')
+    (sample_tree / 'b' / 'empty' / 'z.txt').write_text('z')
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set(), refresh=True)
+    assert {mark.path.relative_to(sample_tree) for mark in marked} == {
+        Path('a/c/y.txt'), Path('a/c'), Path('a'), Path('b/empty/z.txt'), Path('b/empty'), Path('b'), Path('.')}
+
+    for mark, savepath, info in process_marked(db, marked, set()):
+        db.save_file_info(savepath, info)
+    after = snapshot(db, sample_tree)
+    assert after[str(sample_tree / 'x.txt')] == before[str(sample_tree / 'x.txt')]
+    assert after[str(sample_tree)] != before[str(sample_tree)]
+    assert after[str(sample_tree / 'b' / 'empty')][1] == 1
+
+
+def test_refresh_ancestors(tmp_path, sample_tree, run_add):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    (sample_tree / 'a' / 'c' / 'y.txt').write_text('something new')
+    old = db.find_all(sample_tree)
+    old = {str(item.path): item.code for item in old}
+
+    db.save_file_info(*db.process_file(sample_tree / 'a' / 'c' / 'y.txt'))
+    assert db.refresh_ancestors([sample_tree / 'a' / 'c' / 'y.txt'], set()) == 3
+    new = {str(item.path): item.code for item in db.find_all(sample_tree)}
+    assert new[str(sample_tree / 'a')] != old[str(sample_tree / 'a')]
+    assert new[str(sample_tree / 'b')] == old[str(sample_tree / 'b')]
+
+
+def test_mark_crawl_deep_tree(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db')
+    root = tmp_path / 'deep'
+    path = root
+    for _ in range(1200):
+        path = path / 'd'
+    path.mkdir(parents=True)
+    (path / 'leaf.txt').write_text('leaf')
+
+    marked, skipped = [], []
+    assert mark_crawl(db, marked, skipped, root, ignore_names=set())
+    assert len(marked) == 1202
+    assert marked[0].path.name == 'leaf.txt' and not marked[0].is_dir and marked[0].stat.st_size == 4
+    assert marked[-1].path == root and marked[-1].is_dir
+
+
+@pytest.mark.parametrize('refresh', [False, True])
+def test_marking_uses_one_query(tmp_path, sample_tree, run_add, refresh):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    (sample_tree / 'b' / 'new.txt').write_text('new')
+
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set(), refresh=refresh)
+    db.conn.set_trace_callback(None)
+
+    assert len([query for query in queries if 'SELECT' in query]) == 1
+    assert [mark.path.name for mark in marked] == (['new.txt', 'b', 'root'] if refresh else [])
+
+
+def test_new_directories_need_no_queries(tmp_path, sample_tree):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=1000)
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set())
+
+    queries = []
+    db.conn.set_trace_callback(queries.append)
+    for mark, savepath, info in process_marked(db, marked, set()):
+        db.save_file_info(savepath, info)
+    db.conn.set_trace_callback(None)
+    assert not any('SELECT' in query for query in queries)
+
+    db.flush()
+    assert db.find_path(sample_tree).count == 5
+    assert sorted(db._find_children_raw(sample_tree)) == ['a', 'b', 'x.txt']
+
+
+def test_refresh_removes_deleted_entries(tmp_path, sample_tree, run_add, snapshot):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    (sample_tree / 'a' / 'c' / 'y.txt').unlink()
+    (sample_tree / 'a' / 'c').rmdir()
+
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set(), refresh=True)
+    for mark, savepath, info in process_marked(db, marked, set()):
+        db.save_file_info(savepath, info)
+
+    assert str(sample_tree / 'a' / 'c' / 'y.txt') not in snapshot(db, sample_tree)
+    assert str(sample_tree / 'a' / 'c') not in snapshot(db, sample_tree)
+    assert snapshot(db, sample_tree)[str(sample_tree / 'a')][1] == 1
+
+
+def test_dedupe_works_offline(tmp_path, sample_tree, run_add):
+    db = FileDatabase(tmp_path / 'files.db')
+    run_add(db, sample_tree)
+    (sample_tree / 'c').mkdir()
+    (sample_tree / 'c' / 'y.txt').write_text('something else')
+    run_add(db, sample_tree / 'c')
+    db.close()
+    shutil.rmtree(sample_tree)
+
+    groups = fig.quick_run('dedupe', **{'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree),
+                                        'out': str(tmp_path / 'candidates.json'), 'pbar': False})
+    assert sorted(sorted(Path(path).relative_to(sample_tree).as_posix() for path in group) for group in groups) == [
+        ['a/c', 'c'], ['a/x.txt', 'x.txt']]
+
+
+def test_vectorized_identify_duplicates(tmp_path):
+    db = FileDatabase(tmp_path / 'files.db', batch_size=100)
+    rows = {
+        '/x/a/same.txt': ('01', 5, 1.), '/x/b/same.txt': ('01', 5, 1.),
+        '/x/a/one.txt': ('02', 5, 1.), '/x/b/two.txt': ('02', 5, 1.),
+        '/x/a/old.txt': ('03', 5, 1.), '/x/b/old.txt': ('03', 5, 2.),
+        '/x/a/big.txt': ('04', 5, 1.), '/x/b/big.txt': ('04', 6, 1.),
+    }
+    for path, (code, size, modtime) in rows.items():
+        db.save_file_info(path, (code, (None, size, modtime)))
+
+    table = db.export_table('/x', duplicates=True)
+    assert len(table) == 8 and len(table.dirs) == 2 and len(table.codes) == 4
+    assert sorted(str(row.path) for row in table) == sorted(rows)
+
+    codes = {}
+    for item in db.find_all_duplicates('/x'):
+        codes.setdefault(item.code, []).append(item)
+    expected = identify_duplicates(codes)
+    result = identify_duplicates(table)
+    for groups, table_groups in zip(expected, result):
+        assert {code: sorted(str(item.path) for item in items) for code, items in groups.items()} == \
+               {code: sorted(str(table.path(index)) for index in indices) for code, indices in table_groups.items()}
+    assert list(result[0]) == ['01'] and sorted(result[1]) == ['02', '03'] and list(result[2]) == ['04']
+
+
+def test_interrupted_add_resumes(tmp_path, sample_tree, run_add, snapshot, monkeypatch):
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False, 'batch-size': 1}
+    original = scripts.process_marked
+
+    def interrupted(*args, **kwargs):
+        for i, result in enumerate(original(*args, **kwargs)):
+            if i == 4:
+                raise KeyboardInterrupt
+            yield result
+
+    monkeypatch.setattr(scripts, 'process_marked', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        fig.quick_run('add', **args)
+    db = FileDatabase(tmp_path / 'files.db')
+    report_id, items = db.queued(sample_tree)
+    assert len(items) == 5
+    db.close()
+
+    def no_crawl(*args, **kwargs):
+        raise AssertionError('resumed runs must not crawl')
+
+    monkeypatch.setattr(scripts, 'process_marked', original)
+    monkeypatch.setattr(scripts, 'mark_crawl', no_crawl)
+    fig.quick_run('add', **args)
+
+    serial = FileDatabase(tmp_path / 'serial.db')
+    run_add(serial, sample_tree)
+    db = FileDatabase(tmp_path / 'files.db')
+    assert snapshot(db, sample_tree) == snapshot(serial, sample_tree)
+    assert db.queued(sample_tree) == (None, [])
+    assert {item.path: item for item in db.find_all(sample_tree)}[sample_tree].count == 5
+
+
+def test_special_files_do_not_abort_add(tmp_path, sample_tree, run_add, snapshot):
+    os.mkfifo(sample_tree / 'b' / 'pipe')
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False}
+    fig.quick_run('add', **args)
+
+    db = FileDatabase(tmp_path / 'files.db')
+    serial = FileDatabase(tmp_path / 'serial.db')
+    (sample_tree / 'b' / 'pipe').unlink()
+    run_add(serial, sample_tree)
+    assert snapshot(db, sample_tree) == snapshot(serial, sample_tree)
+    assert db.find_path(sample_tree / 'b' / 'pipe') is None
+    failed = set()
+    db.known_paths(sample_tree, failed=failed)
+    assert failed == {str(sample_tree / 'b' / 'pipe')}
+    assert db.queued(sample_tree) == (None, [])
+
+
+def test_resume_after_queued_file_was_deleted(tmp_path, sample_tree, run_add, snapshot, monkeypatch):
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False, 'batch-size': 1}
+    original = scripts.process_marked
+
+    def interrupted(*args, **kwargs):
+        for i, result in enumerate(original(*args, **kwargs)):
+            if i == 1:
+                raise KeyboardInterrupt
+            yield result
+
+    monkeypatch.setattr(scripts, 'process_marked', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        fig.quick_run('add', **args)
+    db = FileDatabase(tmp_path / 'files.db')
+    queued = [Path(path) for path, *_ in db.queued(sample_tree)[1]]
+    db.close()
+    deleted = next(path for path in queued if path.is_file())
+    deleted.unlink()
+
+    monkeypatch.setattr(scripts, 'process_marked', original)
+    fig.quick_run('add', **args)
+
+    db = FileDatabase(tmp_path / 'files.db')
+    serial = FileDatabase(tmp_path / 'serial.db')
+    run_add(serial, sample_tree)
+    assert snapshot(db, sample_tree) == snapshot(serial, sample_tree)
+    assert db.queued(sample_tree) == (None, [])
+
+
+def test_promoted_files_next_to_unrecorded_entries(tmp_path):
+    root = tmp_path / 'root'
+    for name, content in [('first', b'x'), ('second', b'x'), ('third', b'y')]:
+        (root / name).mkdir(parents=True)
+        (root / name / 'data.bin').write_bytes(content * 1000)
+        (root / name / 'dangling').symlink_to(root / 'missing') # never recorded
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False}
+    fig.quick_run('add', **args, tiered=True)
+
+    db = FileDatabase(tmp_path / 'files.db')
+    assert db.find_path(root / 'first' / 'data.bin').tier == 2
+    assert db.find_path(root / 'first').code == db.find_path(root / 'second').code
+    assert db.find_path(root / 'first').code != db.find_path(root / 'third').code
+    db.close()
+    groups = fig.quick_run('dedupe', **args, out=str(tmp_path / 'candidates.json'))
+    assert [sorted(path.name for path in group) for group in groups] == [['first', 'second']]
+
+
+def test_symlink_loops_do_not_abort_add(tmp_path, sample_tree, run_add, snapshot):
+    (sample_tree / 'loop_a').symlink_to(sample_tree / 'loop_b')
+    (sample_tree / 'loop_b').symlink_to(sample_tree / 'loop_a')
+    (sample_tree / 'a' / 'up').symlink_to('..')
+    (sample_tree / 'b' / 'link.txt').symlink_to(sample_tree / 'x.txt')
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(sample_tree), 'pbar': False}
+    fig.quick_run('add', **args)
+
+    db = FileDatabase(tmp_path / 'files.db')
+    assert db.find_path(sample_tree / 'b' / 'link.txt').code == db.find_path(sample_tree / 'x.txt').code
+    assert db.find_path(sample_tree / 'a' / 'up') is None
+    skipped = set()
+    db.known_paths(sample_tree, failed=skipped)
+    assert skipped == {str(sample_tree / 'loop_a'), str(sample_tree / 'loop_b')}
+
+
+def test_failed_paths_are_not_retried(tmp_path, sample_tree):
+    db = FileDatabase(tmp_path / 'files.db')
+    db.save_file_info(sample_tree / 'b' / 'y.txt', (None, ()), status='failed')
+
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set())
+    assert sample_tree / 'b' / 'y.txt' not in {mark.path for mark in marked}
+    assert [mark.names for mark in marked if mark.path == sample_tree / 'b'] == [('empty',)]
+
+    marked, skipped = [], []
+    mark_crawl(db, marked, skipped, sample_tree, ignore_names=set(), retry=True)
+    assert sample_tree / 'b' / 'y.txt' in {mark.path for mark in marked}
+
+
+def test_io_scheduler(monkeypatch):
+    monkeypatch.setattr(misc, 'device_kind', lambda device: 'hdd' if device == 1 else 'ssd')
+    scheduler = IOScheduler({'ssd': 2})
+    for inode in [5, 3, 9]:
+        scheduler.push(1, inode, f'hdd-{inode}')
+        scheduler.push(2, inode, f'ssd-{inode}')
+    assert len(scheduler) == 6
+
+    assert sorted(scheduler.pop()) == [(1, 'hdd-3'), (2, 'ssd-3'), (2, 'ssd-5')]
+    assert scheduler.pop() == []
+    scheduler.release(1)
+    assert scheduler.pop() == [(1, 'hdd-5')]
+    scheduler.release(2)
+    scheduler.release(2)
+    assert scheduler.pop() == [(2, 'ssd-9')]
+    assert len(scheduler) == 1
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_roots_on_different_devices_overlap(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(misc, 'device_kind', lambda device: 'hdd')
+    db = FileDatabase(tmp_path / 'files.db')
+    marks = []
+    for i, name in enumerate(['first', 'second']):
+        root = tmp_path / name
+        root.mkdir()
+        for j in range(20):
+            (root / f'{j:02d}.txt').write_text(f'{name} {j}')
+        root_marks = []
+        mark_crawl(db, root_marks, [], root, ignore_names=set())
+        for mark in root_marks: # pretend the second root is on another disk
+            stat = list(mark.stat)
+            stat[2] += i
+            marks.append(mark._replace(stat=os.stat_result(stat)))
+
+    order = [path for path, _, _ in process_marked(db, marks, set(), workers=workers, window=4)]
+    files = [path for path in order if path.suffix == '.txt']
+    assert min(i for i, path in enumerate(files) if path.parent.name == 'second') < 5
+    assert len(files) == 40
+    assert order.index(tmp_path / 'first') > max(order.index(path) for path in files if path.parent.name == 'first')
+
+    if not workers: # within each device the files are read in inode order
+        files = [path for path, _, _ in process_marked(db, marks, set()) if path.suffix == '.txt']
+        for name in ['first', 'second']:
+            inodes = [path.stat().st_ino for path in files if path.parent.name == name]
+            assert inodes == sorted(inodes)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_refresh_updates_known_directories_incrementally(tmp_path, snapshot, monkeypatch, workers):
+    root = tmp_path / 'root'
+    (root / 'big' / 'sub').mkdir(parents=True)
+    for i in range(50):
+        (root / 'big' / f'{i}.txt').write_text(f'content {i}')
+    (root / 'big' / 'sub' / 'z.txt').write_text('other')
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False, 'dir-hash': 'multiset',
+            'workers': workers}
+    fig.quick_run('add', **args)
+
+    processed = []
+    process_dir = FileDatabase.process_dir
+    def recorded(self, dir_path, *args, **kwargs):
+        processed.append(dir_path.name)
+        return process_dir(self, dir_path, *args, **kwargs)
+    monkeypatch.setattr(FileDatabase, 'process_dir', recorded)
+
+    def compare(name):
+        full = tmp_path / f'{name}.db'
+        fig.quick_run('add', **{**args, 'db-path': str(full)})
+        assert snapshot(FileDatabase(tmp_path / 'files.db'), root) == snapshot(FileDatabase(full), root)
+
+    (root / 'big' / '0.txt').write_text('changed content') # the directories themselves are unchanged
+    (root / 'big' / 'sub' / 'z.txt').write_text('changed')
+    fig.quick_run('add', **args, refresh=True)
+    assert processed == []
+    compare('first')
+
+    processed.clear()
+    (root / 'big' / '1.txt').unlink()
+    (root / 'big' / '2.txt').write_text('changed again')
+    fig.quick_run('add', **args, refresh=True)
+    assert 'big' in processed
+    compare('second')
+
+
+def test_add_several_roots(tmp_path, sample_tree, run_add, snapshot):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'z.txt').write_text('Hello, world!')
+    fig.quick_run('add', **{'db-path': str(tmp_path / 'files.db'), 'path': [str(sample_tree), str(other),
+                            str(sample_tree / 'a')], 'pbar': False, 'workers': 2, 'io-limits': {'hdd': 2}})
+
+    db = FileDatabase(tmp_path / 'files.db')
+    serial = FileDatabase(tmp_path / 'serial.db')
+    run_add(serial, sample_tree)
+    assert snapshot(db, sample_tree) == snapshot(serial, sample_tree)
+    assert db.find_path(other / 'z.txt').code == db.find_path(sample_tree / 'x.txt').code
+    assert db.queued(sample_tree) == (None, []) and db.queued(other) == (None, [])
+
+
+
+def test_chunked_files_share_bytes(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    data = np.random.default_rng(0).integers(0, 256, 1 << 20, dtype=np.uint8).tobytes()
+    (root / 'image.bin').write_bytes(data)
+    (root / 'edited.bin').write_bytes(data[:300000] + b'x' * 1000 + data[300000:])
+    (root / 'small.bin').write_bytes(data[:1000])
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False}
+    fig.quick_run('add', **args, **{'chunk-threshold': 100000, 'chunk-size': 32 * 1024, 'workers': 2})
+
+    total, others = fig.quick_run('shared', **{**args, 'path': str(root / 'image.bin')})
+    assert list(others) == [root / 'edited.bin']
+    assert len(data) - 2 * 128 * 1024 < total == others[root / 'edited.bin'] < len(data)
+
+    db = FileDatabase(tmp_path / 'files.db')
+    assert db.unchunked(root, 100000) == []
+    with db.conn: # bytes shared only with quarantined copies are not counted
+        db.conn.execute("UPDATE files SET status = 'quarantined' WHERE name = 'edited.bin'")
+    assert db.shared_chunks(root / 'image.bin') == (0, {})
+    with db.conn:
+        db.conn.execute("UPDATE files SET status = 'completed' WHERE name = 'edited.bin'")
+    (root / 'edited.bin').write_bytes(b'y' * 200000)
+    fig.quick_run('add', **args, refresh=True)
+    assert [path for _, path, _ in db.unchunked(root, 100000)] == [root / 'edited.bin']
+    assert db.shared_chunks(root / 'image.bin') == (0, {})
@@ -0,0 +1,77 @@
+import shutil
+import numpy as np
+import omnifig as fig
+
+from . import scripts
+from .database import FileDatabase
+from .similarity import minhash_signatures, index_directories, similar_directories
+
+
+def make_tree(root):
+    for i in range(20):
+        (root / 'orig' / 'sub').mkdir(parents=True, exist_ok=True)
+        (root / 'orig' / ('sub' if i % 2 else '') / f'{i}.txt').write_text(f'content {i}\n' * (i + 1))
+    shutil.copytree(root / 'orig', root / 'same')
+    shutil.copytree(root / 'orig', root / 'backup')
+    (root / 'backup' / '0.txt').unlink()
+    (root / 'backup' / 'extra.txt').write_text('something new')
+    (root / 'other').mkdir()
+    (root / 'other' / 'x.txt').write_text('unrelated')
+
+
+def test_signatures_cover_subtrees(tmp_path):
+    make_tree(tmp_path / 'root')
+    fig.quick_run('add', **{'db-path': str(tmp_path / 'files.db'), 'path': str(tmp_path / 'root'), 'pbar': False})
+    table = FileDatabase(tmp_path / 'files.db').export_table(tmp_path / 'root')
+    rows, signatures = minhash_signatures(table)
+    signatures = {table.path(index).relative_to(tmp_path / 'root').as_posix(): signature
+                  for index, signature in zip(rows, signatures)}
+    assert (signatures['orig'] == signatures['same']).all()
+    assert (signatures['orig'] == np.minimum(signatures['orig/sub'], signatures['orig'])).all()
+    assert 0.7 < np.mean(signatures['orig'] == signatures['backup']) < 1
+    assert np.mean(signatures['orig'] == signatures['other']) < 0.2
+
+
+def test_similar_directories(tmp_path):
+    root = tmp_path / 'root'
+    make_tree(root)
+    args = {'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False}
+    fig.quick_run('add', **args)
+
+    pairs = fig.quick_run('similar', **args, **{'min-size': 0, 'out': str(tmp_path / 'similar.json')})
+    assert [pair['paths'] for pair in pairs] == [[str(root / 'backup'), str(root / 'orig')],
+                                                 [str(root / 'backup'), str(root / 'same')]]
+    assert pairs[0]['jaccard'] == 19 / 21
+    assert pairs[0]['shared'] == sum(len(f'content {i}\n') * (i + 1) for i in range(1, 20))
+    assert (tmp_path / 'similar.json').exists()
+
+    db = FileDatabase(tmp_path / 'files.db')
+    assert index_directories(db, root) == 0
+    (root / 'same' / 'extra.txt').write_text('something new')
+    fig.quick_run('add', **args, refresh=True)
+    assert index_directories(db, root) == 2 # same and root
+    pairs = {tuple(pair['paths']): pair['jaccard'] for pair in similar_directories(db, root)}
+    assert pairs == {(str(root / 'backup'), str(root / 'orig')): 19 / 21,
+                     (str(root / 'backup'), str(root / 'same')): 20 / 21,
+                     (str(root / 'orig'), str(root / 'same')): 20 / 21}
+
+    db.remove_paths([root / 'same'])
+    assert db.conn.execute('SELECT COUNT(*) FROM minhashes').fetchone()[0] == 6
+
+
+def test_copies_are_paired_once(tmp_path):
+    root = tmp_path / 'root'
+    for i in range(150):
+        (root / f'copy{i}').mkdir(parents=True)
+        for j in range(9):
+            (root / f'copy{i}' / f'{j}.txt').write_text(f'content {j}')
+    shutil.copytree(root / 'copy0', root / 'changed')
+    (root / 'changed' / 'extra.txt').write_text('something new')
+    fig.quick_run('add', **{'db-path': str(tmp_path / 'files.db'), 'path': str(root), 'pbar': False})
+
+    db = FileDatabase(tmp_path / 'files.db')
+    index_directories(db, root)
+    pairs = similar_directories(db, root)
+    assert len(pairs) == 150
+    assert all(str(root / 'changed') in pair['paths'] and pair['jaccard'] == 0.9 for pair in pairs)
+    assert similar_directories(db, root, max_bucket=1) == []